@@ -0,0 +1,304 @@
+"""
+Booking Histogram Module
+Số video air / deal theo nhân sự × ngày, lưu dạng mảng + prefix sum
+Version 5.9.0
+
+- Mỗi (metric, nhân sự) là 1 mảng đếm theo ngày (index = số ngày kể từ HISTOGRAM_START)
+- Prefix sum tính lại (lazy) khi mảng thay đổi → đếm khoảng ngày bất kỳ là O(1)
+- Build 1 lần từ Booking, cập nhật theo delta từ webhook table-changed,
+  build lại mỗi lượt quét của báo cáo hàng ngày
+- Dùng cho: báo cáo hàng ngày, backfill nhiều ngày, "X air bao nhiêu video từ ngày A đến B"
+"""
+import os
+import time
+from datetime import date, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from daily_booking_report import (
+    DAILY_KPI,
+    DAILY_DEAL_KPI,
+    normalize_staff_name_for_aggregation,
+    _content_type,
+)
+from vn_day import day_of, parse_vn_day
+
+# ============ CONFIG ============
+# Ngày đầu tiên của histogram (record trước ngày này bỏ qua)
+HISTOGRAM_START = date.fromisoformat(os.getenv("BOOKING_HISTOGRAM_START", "2025-01-01"))
+
+METRICS = ("air", "cart", "text", "deal")
+
+# Giới hạn độ dài mảng (ngày nhập sai kiểu năm 2099 không làm phình histogram)
+MAX_DAYS = 366 * 10
+
+# Đóng góp của 1 record: [(metric, số ngày giờ VN, nhân sự)]
+DayContribution = List[Tuple[str, int, str]]
+
+
+def booking_day_contribution(fields: Dict[str, Any]) -> DayContribution:
+    """
+    Sự kiện theo ngày của 1 record Booking (cùng điều kiện với báo cáo hàng ngày)
+
+    - air (+ cart/text): có Link air bài, tính theo Thời gian air
+    - deal: có Link social + Phân loại sp, tính theo Ngày deal
+    """
+    from lark_base import safe_extract_person_name
+
+    nhan_su = safe_extract_person_name(fields.get("Nhân sự book"))
+    if not nhan_su:
+        return []
+    nhan_su = normalize_staff_name_for_aggregation(nhan_su.strip())
+
+    events: DayContribution = []
+    link_air = fields.get("Link air bài") or fields.get("link_air_bai") or fields.get("Link air")
+    if link_air:
+        air_day = parse_vn_day(
+            fields.get("Thời gian air") or fields.get("thoi_gian_air") or fields.get("Thoi gian air")
+        )
+        if air_day is not None:
+            events.append(("air", air_day, nhan_su))
+            content_type = _content_type(fields.get("Content"))
+            if "cart" in content_type:
+                events.append(("cart", air_day, nhan_su))
+            elif "text" in content_type:
+                events.append(("text", air_day, nhan_su))
+
+    if fields.get("Link social") and fields.get("Phân loại sp (Chỉ được chọn - Không được add mới)"):
+        deal_day = parse_vn_day(fields.get("Ngày deal") or fields.get("Ngày deal (gần nhất)"))
+        if deal_day is not None:
+            events.append(("deal", deal_day, nhan_su))
+
+    return events
+
+
+class _Series:
+    """Mảng đếm theo ngày + prefix sum (tính lại khi dirty)"""
+
+    __slots__ = ("counts", "prefix", "dirty")
+
+    def __init__(self):
+        self.counts: List[int] = []
+        self.prefix: List[int] = [0]
+        self.dirty = False
+
+    def add(self, index: int, value: int):
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += value
+        self.dirty = True
+
+    def range_sum(self, start: int, end: int) -> int:
+        """Tổng các ngày [start, end] (index, gồm cả 2 đầu)"""
+        if self.dirty:
+            prefix = [0] * (len(self.counts) + 1)
+            for i, c in enumerate(self.counts):
+                prefix[i + 1] = prefix[i] + c
+            self.prefix = prefix
+            self.dirty = False
+        last = len(self.prefix) - 1
+        start, end = max(start, 0), min(end + 1, last)
+        return self.prefix[end] - self.prefix[start] if end > start else 0
+
+
+class BookingHistogram:
+    """
+    Histogram (metric, nhân sự) → số sự kiện theo ngày
+
+    _records giữ đóng góp của phiên bản gần nhất mỗi record → update / delete trừ đúng phần cũ
+    """
+
+    def __init__(self, start: date = HISTOGRAM_START):
+        self.start = start
+        self._start_day = day_of(start)
+        self._series: Dict[Tuple[str, str], _Series] = {}
+        self._records: Dict[str, DayContribution] = {}
+        self.built_at: Optional[float] = None
+        self.deltas_applied = 0
+
+    @property
+    def is_built(self) -> bool:
+        return self.built_at is not None
+
+    def _index(self, day: date) -> int:
+        return day_of(day) - self._start_day
+
+    def _add(self, events: DayContribution, sign: int):
+        for metric, day, nhan_su in events:
+            index = day - self._start_day
+            if index < 0 or index >= MAX_DAYS:
+                continue
+            series = self._series.get((metric, nhan_su))
+            if series is None:
+                series = self._series[(metric, nhan_su)] = _Series()
+            series.add(index, sign)
+
+    def upsert(self, record_id: str, fields: Dict[str, Any]):
+        old = self._records.pop(record_id, None)
+        if old:
+            self._add(old, -1)
+        new = booking_day_contribution(fields or {})
+        if new:
+            self._records[record_id] = new
+            self._add(new, +1)
+        self.deltas_applied += 1
+
+    def delete(self, record_id: str):
+        old = self._records.pop(record_id, None)
+        if old:
+            self._add(old, -1)
+        self.deltas_applied += 1
+
+    def apply(self, action: str, record_id: str, fields: Optional[Dict[str, Any]] = None):
+        if action == "delete":
+            self.delete(record_id)
+        else:
+            self.upsert(record_id, fields or {})
+
+    def rebuild(self, records: Iterable[Dict]) -> int:
+        """Tính lại toàn bộ từ danh sách records Booking, trả về số record đã quét"""
+        self._series = {}
+        self._records = {}
+        count = 0
+        for record in records:
+            events = booking_day_contribution(record.get("fields", {}))
+            if events:
+                self._records[record.get("record_id")] = events
+                self._add(events, +1)
+            count += 1
+        self.built_at = time.time()
+        print(f"🗓️ Booking histogram: rebuilt from {count} records, {len(self._series)} series")
+        return count
+
+    # ----- Truy vấn -----
+
+    def staff_names(self) -> List[str]:
+        return sorted({nhan_su for _, nhan_su in self._series})
+
+    def range_count(self, nhan_su: str, metric: str, start: date, end: date) -> int:
+        """Số sự kiện metric của nhân sự trong [start, end]"""
+        series = self._series.get((metric, nhan_su))
+        if series is None:
+            return 0
+        return series.range_sum(self._index(start), self._index(end))
+
+    def range_by_staff(self, metric: str, start: date, end: date) -> Dict[str, int]:
+        """Dict[nhân sự, số sự kiện] trong [start, end] (bỏ nhân sự = 0)"""
+        result = {}
+        for (m, nhan_su), series in self._series.items():
+            if m != metric:
+                continue
+            value = series.range_sum(self._index(start), self._index(end))
+            if value:
+                result[nhan_su] = value
+        return result
+
+    def day_air(self, day: date) -> Dict[str, Dict[str, int]]:
+        """Video air trong 1 ngày: Dict[nhân sự, {"count", "cart", "text"}] """
+        air = self.range_by_staff("air", day, day)
+        return {
+            nhan_su: {
+                "count": count,
+                "cart": self.range_count(nhan_su, "cart", day, day),
+                "text": self.range_count(nhan_su, "text", day, day),
+            }
+            for nhan_su, count in air.items()
+        }
+
+    def month_to_date(self, nhan_su: str, day: date) -> Dict[str, int]:
+        """Air / deal từ đầu tháng tới hết ngày `day` + thiếu so với KPI ngày"""
+        first = day.replace(day=1)
+        days = day.day
+        air = self.range_count(nhan_su, "air", first, day)
+        deal = self.range_count(nhan_su, "deal", first, day)
+        return {
+            "days": days,
+            "air": air,
+            "deal": deal,
+            "air_deficit": max(0, days * DAILY_KPI - air),
+            "deal_deficit": max(0, days * DAILY_DEAL_KPI - deal),
+        }
+
+    def backfill(self, start: date, end: date, staff: Optional[Iterable[str]] = None) -> List[Dict[str, Any]]:
+        """Số liệu từng ngày trong [start, end] cho từng nhân sự (không quét lại Booking)"""
+        names = list(staff) if staff else self.staff_names()
+        rows = []
+        day = start
+        while day <= end:
+            for nhan_su in names:
+                air = self.range_count(nhan_su, "air", day, day)
+                deal = self.range_count(nhan_su, "deal", day, day)
+                mtd = self.month_to_date(nhan_su, day)
+                rows.append({
+                    "date": day.isoformat(),
+                    "nhan_su": nhan_su,
+                    "air": air,
+                    "deal": deal,
+                    "air_deficit_today": max(0, DAILY_KPI - air),
+                    "deal_month": mtd["deal"],
+                    "deal_deficit_month": mtd["deal_deficit"],
+                })
+            day += timedelta(days=1)
+        return rows
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "built": self.is_built,
+            "start": self.start.isoformat(),
+            "records": len(self._records),
+            "series": len(self._series),
+            "days": max((len(s.counts) for s in self._series.values()), default=0),
+            "deltas_applied": self.deltas_applied,
+        }
+
+
+_booking_histogram = BookingHistogram()
+
+
+def get_booking_histogram() -> BookingHistogram:
+    return _booking_histogram
+
+
+async def _fetch_booking_records() -> List[Dict]:
+    from lark_base import get_all_records, BOOKING_BASE
+    return await get_all_records(
+        app_token=BOOKING_BASE["app_token"],
+        table_id=BOOKING_BASE["table_id"],
+        max_records=50000
+    )
+
+
+async def refresh_booking_histogram() -> BookingHistogram:
+    """Tính lại histogram từ dữ liệu Booking mới nhất (dùng chung fetch nếu trong shared_fetches)"""
+    histogram = get_booking_histogram()
+    histogram.rebuild(await _fetch_booking_records())
+    return histogram
+
+
+async def ensure_booking_histogram() -> BookingHistogram:
+    """Build histogram lần đầu (lazy) nếu chưa có"""
+    histogram = get_booking_histogram()
+    if not histogram.is_built:
+        await refresh_booking_histogram()
+    return histogram
+
+
+async def apply_booking_change(action: str, record_id: str):
+    """
+    Áp dụng thay đổi của 1 record Booking (webhook table-changed) vào histogram nếu đã build
+    Luôn đọc lại record từ Lark: webhook có thể chỉ gửi các field vừa đổi (hoặc bị giả mạo),
+    delta phải tính từ trạng thái đầy đủ của record
+    """
+    from lark_base import get_record, BOOKING_BASE
+
+    histogram = get_booking_histogram()
+    if not histogram.is_built:
+        return  # Lần build đầu (lazy) sẽ đọc dữ liệu mới nhất
+
+    record = await get_record(BOOKING_BASE["app_token"], BOOKING_BASE["table_id"], record_id)
+    if record is not None:
+        histogram.upsert(record_id, record.get("fields", {}))
+    elif action == "delete":
+        histogram.delete(record_id)
+    else:
+        # Không đọc được record (lỗi Lark) → bỏ qua, lượt quét báo cáo hàng ngày sẽ build lại
+        print(f"⚠️ Booking record {record_id} not readable, skipping histogram delta")
@@ -7,14 +7,16 @@ Features:
 2. Báo cáo team: Tình hình booking tháng hiện tại gửi vào nhóm 9h
 """
 
-import os
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import pytz
 
 # Vietnam timezone
 VN_TZ = pytz.timezone('Asia/Ho_Chi_Minh')
 from typing import Dict, List, Optional
-import httpx
+
+from staff_index import StaffAliasIndex
+from lark_messenger import OutgoingMessage, fan_out_messages
+from vn_day import day_to_date, parse_vn_day
 
 # ============ STAFF MAPPING ============
 # Map từ User ID Lark -> Tên trong Dashboard/Booking
@@ -83,6 +85,9 @@ BOOKING_STAFF = {
     },
 }
 
+# v5.9.0: Index tên → staff ID, build 1 lần khi import
+BOOKING_STAFF_INDEX = StaffAliasIndex(BOOKING_STAFF)
+
 # ============ CONFIG ============
 BOOKING_GROUP_CHAT_ID = "oc_7356c37c72891ea5314507d78ab2e937"  # Nhóm "Kalle - Booking k sếp"
 DAILY_KPI = 2  # KPI: 2 video/ngày
@@ -91,132 +96,6 @@ DAILY_DEAL_KPI = 5  # KPI: 5 deal/ngày
 # Schedule end date (stop sending reports after this date)
 SCHEDULE_END_DATE = datetime(2026, 2, 14, 0, 0, 0, tzinfo=VN_TZ)
 
-# Lark API
-LARK_APP_ID = os.getenv("LARK_APP_ID")
-LARK_APP_SECRET = os.getenv("LARK_APP_SECRET")
-LARK_API_BASE = "https://open.larksuite.com/open-apis"
-
-
-async def get_tenant_access_token() -> str:
-    """Get Lark tenant access token"""
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{LARK_API_BASE}/auth/v3/tenant_access_token/internal",
-            json={
-                "app_id": LARK_APP_ID,
-                "app_secret": LARK_APP_SECRET
-            }
-        )
-        data = response.json()
-        return data.get("tenant_access_token", "")
-
-
-async def send_message_to_user(user_id: str, message: str) -> bool:
-    """
-    Gửi tin nhắn đến user qua user_id
-    """
-    try:
-        token = await get_tenant_access_token()
-        
-        # Escape special characters for JSON
-        escaped_message = message.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{LARK_API_BASE}/im/v1/messages?receive_id_type=user_id",
-                headers={
-                    "Authorization": f"Bearer {token}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "receive_id": user_id,
-                    "msg_type": "text",
-                    "content": f'{{"text": "{escaped_message}"}}'
-                }
-            )
-            result = response.json()
-            
-            if result.get("code") == 0:
-                print(f"✅ Sent message to user {user_id}")
-                return True
-            else:
-                print(f"❌ Failed to send to {user_id}: {result}")
-                return False
-    except Exception as e:
-        print(f"❌ Error sending to {user_id}: {e}")
-        return False
-
-
-async def send_message_to_chat(chat_id: str, message: str) -> bool:
-    """Gửi tin nhắn đến group chat"""
-    try:
-        token = await get_tenant_access_token()
-        
-        # Escape special characters for JSON
-        escaped_message = message.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{LARK_API_BASE}/im/v1/messages?receive_id_type=chat_id",
-                headers={
-                    "Authorization": f"Bearer {token}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "receive_id": chat_id,
-                    "msg_type": "text",
-                    "content": f'{{"text": "{escaped_message}"}}'
-                }
-            )
-            result = response.json()
-            
-            if result.get("code") == 0:
-                print(f"✅ Sent message to chat {chat_id}")
-                return True
-            else:
-                print(f"❌ Failed to send to chat {chat_id}: {result}")
-                return False
-    except Exception as e:
-        print(f"❌ Error sending to chat {chat_id}: {e}")
-        return False
-
-
-def normalize_name(name: str) -> str:
-    """Normalize tên để so sánh"""
-    import re
-    # Lấy phần trước " - "
-    name = name.split(" - ")[0].strip()
-    # Loại bỏ phần trong ngoặc
-    name = re.sub(r'\s*\([^)]*\)', '', name).strip()
-    return name.lower()
-
-
-def match_staff_name(search_name: str, dashboard_names: List[str]) -> bool:
-    """
-    Kiểm tra tên có match không
-    """
-    search_normalized = normalize_name(search_name)
-    
-    for dash_name in dashboard_names:
-        dash_normalized = normalize_name(dash_name)
-        
-        # Exact match
-        if search_normalized == dash_normalized:
-            return True
-        
-        # Partial match - có ít nhất 2 từ giống nhau
-        search_parts = set(search_normalized.split())
-        dash_parts = set(dash_normalized.split())
-        common = search_parts & dash_parts
-        if len(common) >= 2:
-            return True
-        
-        # Contains match
-        if search_normalized in dash_normalized or dash_normalized in search_normalized:
-            return True
-    
-    return False
-
 
 def normalize_staff_name_for_aggregation(raw_name: str) -> str:
     """
@@ -228,464 +107,101 @@ def normalize_staff_name_for_aggregation(raw_name: str) -> str:
         return raw_name
     
     raw_name = raw_name.strip()
-    raw_name_lower = raw_name.lower()
     
-    # Tìm trong BOOKING_STAFF xem raw_name có match với dashboard_names không
-    for user_id, staff_info in BOOKING_STAFF.items():
-        dashboard_names = staff_info.get("dashboard_names", [])
-        for db_name in dashboard_names:
-            # Case-insensitive comparison
-            if raw_name_lower == db_name.lower():
-                # Trả về tên đầu tiên (chuẩn) trong dashboard_names
-                return dashboard_names[0]
+    # v5.9.0: Hash lookup trong index - chỉ khớp đúng tên trong dashboard_names (không phân biệt hoa thường)
+    # Không dùng biệt danh / khớp gần đúng ở đây để không gộp nhầm nhân sự ngoài BOOKING_STAFF
+    staff_id = BOOKING_STAFF_INDEX.resolve_exact(raw_name)
+    if staff_id:
+        # Trả về tên đầu tiên (chuẩn) trong dashboard_names
+        return BOOKING_STAFF_INDEX.canonical_name(staff_id)
     
     # Nếu không match, trả về tên gốc
     return raw_name
 
 
-async def get_video_air_by_date(target_date: datetime) -> Dict[str, Dict]:
+def parse_booking_date(value) -> Optional[date]:
     """
-    Lấy số video air theo ngày từ Booking table
-    
-    Returns:
-        Dict[nhan_su_name, {"count": int, "cart": int, "text": int}]
+    Parse field ngày trong Booking table → date (giờ Việt Nam)
+    Hỗ trợ: timestamp ms/s, timestamp dạng chuỗi, "YYYY/MM/DD", "YYYY-MM-DD", "DD/MM/YYYY"
+    (so sánh / gom theo ngày nên dùng thẳng vn_day.parse_vn_day → số nguyên)
     """
-    from lark_base import get_all_records, BOOKING_BASE, safe_extract_person_name
-    
-    target_date_str = target_date.strftime("%Y/%m/%d")
-    # Also prepare alternate format for comparison
-    target_ts_start = int(target_date.replace(hour=0, minute=0, second=0).timestamp() * 1000)
-    target_ts_end = int(target_date.replace(hour=23, minute=59, second=59).timestamp() * 1000)
-    
-    print(f"📅 Getting video air for date: {target_date_str}")
-    print(f"📅 Target timestamp range: {target_ts_start} - {target_ts_end}")
-    
-    # Get all records (without sort to avoid API error)
-    records = await get_all_records(
-        app_token=BOOKING_BASE["app_token"],
-        table_id=BOOKING_BASE["table_id"],
-        max_records=50000  # Increased significantly to ensure we get all records
-    )
-    
-    print(f"📊 Total records from Booking: {len(records)}")
-    
-    # Debug: Count records with Thời gian air in January 2026
-    jan_2026_start = int(datetime(2026, 1, 1).timestamp() * 1000)
-    jan_2026_end = int(datetime(2026, 1, 31, 23, 59, 59).timestamp() * 1000)
-    jan_2026_records = 0
-    jan_2026_with_link = 0
-    sample_timestamps = []
-    
-    for r in records:
-        f = r.get("fields", {})
-        thoi_gian_air = f.get("Thời gian air")
-        link_air = f.get("Link air bài")
-        
-        if isinstance(thoi_gian_air, (int, float)) and jan_2026_start <= thoi_gian_air <= jan_2026_end:
-            jan_2026_records += 1
-            if link_air:
-                jan_2026_with_link += 1
-                # Collect sample timestamps (first 10)
-                if len(sample_timestamps) < 10:
-                    ts = thoi_gian_air / 1000 if thoi_gian_air > 1e12 else thoi_gian_air
-                    date_str = datetime.fromtimestamp(ts, VN_TZ).strftime("%Y/%m/%d %H:%M:%S")
-                    sample_timestamps.append(f"{thoi_gian_air} ({date_str})")
-    
-    print(f"📊 Records with Thời gian air in Jan 2026: {jan_2026_records}")
-    print(f"📊 Records with Thời gian air in Jan 2026 AND Link air bài: {jan_2026_with_link}")
-    print(f"📊 Sample timestamps from Jan 2026: {sample_timestamps}")
-    print(f"📊 Target range: {target_ts_start} - {target_ts_end}")
-    
-    # Debug: Print all field names from FIRST record (regardless of content)
-    if records:
-        first_record_fields = records[0].get("fields", {})
-        print(f"🔍 ALL field names in first record: {list(first_record_fields.keys())}")
-        
-        # Find ALL records of Thảo/Châu that have Link air bài
-        thao_chau_count = 0
-        for r in records:
-            f = r.get("fields", {})
-            nhan_su_raw = f.get("Nhân sự book")
-            link_air = f.get("Link air bài")
-            thoi_gian_air = f.get("Thời gian air")
-            
-            if nhan_su_raw and link_air:
-                nhan_su_str = str(nhan_su_raw)
-                if "Thảo" in nhan_su_str or "Châu" in nhan_su_str:
-                    thao_chau_count += 1
-                    if thao_chau_count <= 5:  # Print first 5 records
-                        # Parse the date
-                        date_str = "N/A"
-                        if isinstance(thoi_gian_air, (int, float)) and thoi_gian_air > 0:
-                            ts = thoi_gian_air / 1000 if thoi_gian_air > 1e12 else thoi_gian_air
-                            date_str = datetime.fromtimestamp(ts, VN_TZ).strftime("%Y/%m/%d")
-                        print(f"   🔍 Thảo/Châu record #{thao_chau_count}: Nhân sự={safe_extract_person_name(nhan_su_raw)}, Thời gian air={thoi_gian_air} ({date_str})")
-        
-        print(f"📊 Total Thảo/Châu records with Link air bài: {thao_chau_count}")
-    
-    result = {}
-    debug_count = 0
-    matched_count = 0
-    records_with_link_air = 0
-    records_with_thoi_gian = 0
-    unique_raw_names = set()  # Track all unique raw names on this date
-    
-    for record in records:
-        fields = record.get("fields", {})
-        
-        # Chỉ đếm records đã air (có Link air bài)
-        link_air = fields.get("Link air bài") or fields.get("link_air_bai") or fields.get("Link air")
-        if not link_air:
-            continue
-        
-        records_with_link_air += 1
-        
-        # Check thời gian air - try multiple field names
-        thoi_gian_air = fields.get("Thời gian air") or fields.get("thoi_gian_air") or fields.get("Thoi gian air")
-        if not thoi_gian_air:
-            continue
-        
-        records_with_thoi_gian += 1
-        
-        # Parse date - handle multiple formats
-        air_date_str = None
-        
-        if isinstance(thoi_gian_air, (int, float)):
-            # Lark Date field returns timestamp in milliseconds
-            try:
-                # Convert milliseconds to seconds
-                ts = thoi_gian_air / 1000 if thoi_gian_air > 1e12 else thoi_gian_air
-                # Use Vietnam timezone for conversion
-                dt = datetime.fromtimestamp(ts, VN_TZ)
-                air_date_str = dt.strftime("%Y/%m/%d")
-                
-                # Debug: Check if timestamp is in target range
-                if target_ts_start <= thoi_gian_air <= target_ts_end:
-                    nhan_su_debug = safe_extract_person_name(fields.get("Nhân sự book"))
-                    id_koc = fields.get("ID KOC") or fields.get("id_koc") or "N/A"
-                    print(f"   ✅ Found match: ID_KOC={id_koc}, Nhân sự={nhan_su_debug}, ts={thoi_gian_air}, date={air_date_str}")
-                
-            except Exception as e:
-                print(f"   ⚠️ Failed to parse timestamp {thoi_gian_air}: {e}")
-                continue
-        elif isinstance(thoi_gian_air, str):
-            # String format - could be "2026/01/30" or "30/01/2026" or timestamp as string
-            thoi_gian_air = thoi_gian_air.strip()
-            
-            # Check if it's a timestamp string
-            if thoi_gian_air.isdigit():
-                try:
-                    ts = int(thoi_gian_air)
-                    ts = ts / 1000 if ts > 1e12 else ts
-                    dt = datetime.fromtimestamp(ts, VN_TZ)
-                    air_date_str = dt.strftime("%Y/%m/%d")
-                except:
-                    pass
-            # Check format YYYY/MM/DD or YYYY-MM-DD
-            elif len(thoi_gian_air) >= 10 and (thoi_gian_air[4] == '/' or thoi_gian_air[4] == '-'):
-                air_date_str = thoi_gian_air[:10].replace('-', '/')
-            # Check format DD/MM/YYYY
-            elif len(thoi_gian_air) >= 10 and thoi_gian_air[2] == '/':
-                parts = thoi_gian_air[:10].split('/')
-                if len(parts) == 3:
-                    air_date_str = f"{parts[2]}/{parts[1]}/{parts[0]}"
-        
-        # Debug: In ra 5 records đầu tiên để xem format
-        if debug_count < 5:
-            nhan_su_debug = safe_extract_person_name(fields.get("Nhân sự book"))
-            print(f"   🔍 Debug record: Nhân sự={nhan_su_debug}, Thời gian air={thoi_gian_air} (type={type(thoi_gian_air).__name__}) -> parsed={air_date_str}")
-            debug_count += 1
-        
-        if not air_date_str:
-            continue
-            
-        # Compare dates
-        if air_date_str != target_date_str:
-            continue
-        
-        matched_count += 1
-        
-        # Lấy nhân sự
-        nhan_su = safe_extract_person_name(fields.get("Nhân sự book"))
-        if not nhan_su:
-            # Debug: Record matched but no Nhân sự book
-            id_koc = fields.get("ID KOC") or fields.get("id_koc") or "N/A"
-            print(f"   ⚠️ Record matched but no Nhân sự book: ID_KOC={id_koc}, date={air_date_str}")
-            continue
-        nhan_su = nhan_su.strip()
-        
-        # Track unique raw names
-        unique_raw_names.add(nhan_su)
-        
-        # Normalize tên để merge các cách viết khác nhau
-        # Ví dụ: "PR Bookingg" và "PR Booking" → merge vào cùng 1 entry
-        nhan_su_normalized = normalize_staff_name_for_aggregation(nhan_su)
-        
-        # Debug: Show normalize result for first 15 records
-        if matched_count <= 15:
-            print(f"   🔄 Normalize: '{nhan_su}' → '{nhan_su_normalized}'")
-        
-        # Lấy loại content (Cart/Text/Video)
-        content_raw = fields.get("Content")
-        content_type = "video"  # default
-        
-        if content_raw:
-            # Handle different formats from Lark Select/Option field
-            if isinstance(content_raw, str):
-                content_type = content_raw.strip().lower()
-            elif isinstance(content_raw, list) and len(content_raw) > 0:
-                first_item = content_raw[0]
-                if isinstance(first_item, str):
-                    content_type = first_item.strip().lower()
-                elif isinstance(first_item, dict):
-                    content_type = first_item.get("text", "video").strip().lower()
-            elif isinstance(content_raw, dict):
-                content_type = content_raw.get("text", "video").strip().lower()
-        
-        # Debug: Log content type for matched records
-        if matched_count <= 10:
-            print(f"   📝 Content debug: raw={content_raw}, parsed={content_type}")
-        
-        # Aggregate using normalized name
-        if nhan_su_normalized not in result:
-            result[nhan_su_normalized] = {"count": 0, "cart": 0, "text": 0}
-        
-        result[nhan_su_normalized]["count"] += 1
-        if "cart" in content_type:
-            result[nhan_su_normalized]["cart"] += 1
-        elif "text" in content_type:
-            result[nhan_su_normalized]["text"] += 1
-    
-    print(f"📊 Records with Link air: {records_with_link_air}")
-    print(f"📊 Records with Thời gian air: {records_with_thoi_gian}")
-    print(f"📊 Matched records for {target_date_str}: {matched_count}")
-    
-    # Debug: Show all unique raw names found on this date
-    print(f"📋 Unique raw names on {target_date_str}: {list(unique_raw_names)}")
-    
-    print(f"📊 Video air on {target_date_str}: {result}")
-    return result
-
-
-async def get_deal_by_date(target_date: datetime) -> Dict[str, int]:
+    day = parse_vn_day(value)
+    return day_to_date(day) if day is not None else None
+
+
+def _content_type(raw) -> str:
+    """Loại content (cart/text/video) từ field "Content" của Booking"""
+    if isinstance(raw, str):
+        return raw.strip().lower()
+    if isinstance(raw, list) and raw:
+        first = raw[0]
+        if isinstance(first, str):
+            return first.strip().lower()
+        if isinstance(first, dict):
+            return str(first.get("text", "video")).strip().lower()
+    if isinstance(raw, dict):
+        return str(raw.get("text", "video")).strip().lower()
+    return "video"
+
+
+async def scan_booking_for_daily_report(target_date: datetime, month_of: Optional[datetime] = None) -> Dict[str, Dict]:
     """
-    Đếm số deal theo ngày từ Booking table
-    Deal được tính khi record có đủ 3 cột:
-    1. Link social
-    2. Thông tin nhận hàng  
-    3. Phân loại sp gửi hàng (Chỉ được chọn - Không được add mới)
+    v5.9.0: 1 lượt quét Booking → mọi số liệu theo nhân sự cho báo cáo hàng ngày
+    (video air / deal trong ngày + deal cả tháng)
     
-    Filter theo cột "Ngày deal (gần nhất)"
+    Lượt quét đồng thời build lại booking histogram → các ngày / khoảng ngày khác
+    (backfill, "từ ngày A đến ngày B") đọc thẳng từ histogram, không quét lại
     
     Returns:
-        Dict[nhan_su_name, deal_count]
+        {
+            "air": Dict[nhan_su, {"count", "cart", "text"}],  # video air ngày target_date
+            "deal": Dict[nhan_su, int],                       # deal ngày target_date
+            "monthly_deal": Dict[nhan_su, int],               # deal cả tháng của month_of
+            "records": int,
+        }
     """
-    from lark_base import get_all_records, BOOKING_BASE, safe_extract_person_name
+    from booking_histogram import get_booking_histogram, _fetch_booking_records
     
-    target_date_str = target_date.strftime("%Y/%m/%d")
-    target_ts_start = int(target_date.replace(hour=0, minute=0, second=0).timestamp() * 1000)
-    target_ts_end = int(target_date.replace(hour=23, minute=59, second=59).timestamp() * 1000)
+    target_day = target_date.date()
+    month_of = month_of or target_date
     
-    print(f"📅 Getting deal count for date: {target_date_str}")
-    
-    # Get all records
-    records = await get_all_records(
-        app_token=BOOKING_BASE["app_token"],
-        table_id=BOOKING_BASE["table_id"],
-        max_records=50000
-    )
-    
-    # Debug: Find and print records that have "Ngày deal" field
-    debug_count = 0
-    records_with_ngay_deal = 0
-    for r in records:
-        f = r.get("fields", {})
-        ngay_deal = f.get("Ngày deal")
-        if ngay_deal:
-            records_with_ngay_deal += 1
-            if debug_count < 3:
-                print(f"   🔍 Record with Ngày deal:")
-                print(f"      - Ngày deal: {ngay_deal}")
-                print(f"      - Nhân sự book: {f.get('Nhân sự book')}")
-                print(f"      - Link social: {f.get('Link social')}")
-                print(f"      - Phân loại sp: {f.get('Phân loại sp (Chỉ được chọn - Không được add mới)')}")
-                debug_count += 1
-    
-    print(f"📊 Total records with 'Ngày deal': {records_with_ngay_deal}/{len(records)}")
-    
-    result = {}
-    matched_count = 0
-    
-    for record in records:
-        fields = record.get("fields", {})
-        
-        # Check 2 required fields (Option B: Link social + Phân loại sp)
-        link_social = fields.get("Link social")
-        phan_loai_sp = fields.get("Phân loại sp (Chỉ được chọn - Không được add mới)")
-        
-        # Both fields must have value
-        if not link_social or not phan_loai_sp:
-            continue
-        
-        # Get deal date - prioritize "Ngày deal"
-        ngay_deal = fields.get("Ngày deal") or fields.get("Ngày deal (gần nhất)")
-        if not ngay_deal:
-            continue
-        
-        # Parse date
-        deal_date_str = None
-        
-        if isinstance(ngay_deal, (int, float)):
-            try:
-                ts = ngay_deal / 1000 if ngay_deal > 1e12 else ngay_deal
-                dt = datetime.fromtimestamp(ts, VN_TZ)
-                deal_date_str = dt.strftime("%Y/%m/%d")
-            except:
-                continue
-        elif isinstance(ngay_deal, str):
-            ngay_deal = ngay_deal.strip()
-            if ngay_deal.isdigit():
-                try:
-                    ts = int(ngay_deal)
-                    ts = ts / 1000 if ts > 1e12 else ts
-                    dt = datetime.fromtimestamp(ts, VN_TZ)
-                    deal_date_str = dt.strftime("%Y/%m/%d")
-                except:
-                    pass
-            elif len(ngay_deal) >= 10 and (ngay_deal[4] == '/' or ngay_deal[4] == '-'):
-                deal_date_str = ngay_deal[:10].replace('-', '/')
-            elif len(ngay_deal) >= 10 and ngay_deal[2] == '/':
-                parts = ngay_deal[:10].split('/')
-                if len(parts) == 3:
-                    deal_date_str = f"{parts[2]}/{parts[1]}/{parts[0]}"
-        
-        if not deal_date_str or deal_date_str != target_date_str:
-            continue
-        
-        matched_count += 1
-        
-        # Get staff name
-        nhan_su = safe_extract_person_name(fields.get("Nhân sự book"))
-        if not nhan_su:
-            continue
-        nhan_su = nhan_su.strip()
-        
-        # Normalize name
-        nhan_su_normalized = normalize_staff_name_for_aggregation(nhan_su)
-        
-        if nhan_su_normalized not in result:
-            result[nhan_su_normalized] = 0
-        result[nhan_su_normalized] += 1
+    histogram = get_booking_histogram()
+    record_count = histogram.rebuild(await _fetch_booking_records())
+    result = daily_report_data(histogram, target_day, month_of.date())
+    result["records"] = record_count
     
-    print(f"📊 Deal count on {target_date_str}: {result}")
+    print(f"📊 Booking scan ({record_count} records) for {target_day}: air={result['air']}, deal={result['deal']}")
+    print(f"📊 Monthly deals {month_of.month}/{month_of.year}: {result['monthly_deal']}")
     return result
 
 
-async def get_monthly_deal_stats(target_month: int) -> Dict[str, int]:
-    """
-    Đếm tổng số deal trong tháng (cộng dồn) theo nhân sự
+def daily_report_data(histogram, target_day: date, month_day: date) -> Dict[str, Dict]:
+    """Số liệu báo cáo hàng ngày của target_day đọc từ booking histogram (O(1) mỗi nhân sự)"""
+    import calendar
     
-    Returns:
-        Dict[nhan_su_name, total_deal_count_in_month]
-    """
-    from lark_base import get_all_records, BOOKING_BASE, safe_extract_person_name
-    
-    print(f"📅 Getting monthly deal stats for month: {target_month}")
-    
-    # Get all records
-    records = await get_all_records(
-        app_token=BOOKING_BASE["app_token"],
-        table_id=BOOKING_BASE["table_id"],
-        max_records=50000
-    )
-    
-    result = {}
-    matched_count = 0
-    
-    for record in records:
-        fields = record.get("fields", {})
-        
-        # Check 2 required fields (Option B: Link social + Phân loại sp)
-        link_social = fields.get("Link social")
-        phan_loai_sp = fields.get("Phân loại sp (Chỉ được chọn - Không được add mới)")
-        
-        # Both fields must have value
-        if not link_social or not phan_loai_sp:
-            continue
-        
-        # Get deal date - prioritize "Ngày deal"
-        ngay_deal = fields.get("Ngày deal") or fields.get("Ngày deal (gần nhất)")
-        if not ngay_deal:
-            continue
-        
-        # Parse month from deal date
-        deal_month = None
-        
-        if isinstance(ngay_deal, (int, float)):
-            try:
-                ts = ngay_deal / 1000 if ngay_deal > 1e12 else ngay_deal
-                dt = datetime.fromtimestamp(ts, VN_TZ)
-                deal_month = dt.month
-            except:
-                continue
-        elif isinstance(ngay_deal, str):
-            ngay_deal = ngay_deal.strip()
-            if ngay_deal.isdigit():
-                try:
-                    ts = int(ngay_deal)
-                    ts = ts / 1000 if ts > 1e12 else ts
-                    dt = datetime.fromtimestamp(ts, VN_TZ)
-                    deal_month = dt.month
-                except:
-                    pass
-            elif len(ngay_deal) >= 10 and (ngay_deal[4] == '/' or ngay_deal[4] == '-'):
-                # Format YYYY/MM/DD or YYYY-MM-DD
-                try:
-                    deal_month = int(ngay_deal[5:7])
-                except:
-                    pass
-            elif len(ngay_deal) >= 10 and ngay_deal[2] == '/':
-                # Format DD/MM/YYYY
-                try:
-                    deal_month = int(ngay_deal[3:5])
-                except:
-                    pass
-        
-        if deal_month != target_month:
-            continue
-        
-        matched_count += 1
-        
-        # Get staff name
-        nhan_su = safe_extract_person_name(fields.get("Nhân sự book"))
-        if not nhan_su:
-            continue
-        nhan_su = nhan_su.strip()
-        
-        # Normalize name
-        nhan_su_normalized = normalize_staff_name_for_aggregation(nhan_su)
-        
-        if nhan_su_normalized not in result:
-            result[nhan_su_normalized] = 0
-        result[nhan_su_normalized] += 1
-    
-    print(f"📊 Monthly deal stats (month {target_month}): {result}")
-    print(f"📊 Total matched deal records: {matched_count}")
-    return result
+    month_start = month_day.replace(day=1)
+    month_end = month_day.replace(day=calendar.monthrange(month_day.year, month_day.month)[1])
+    return {
+        "air": histogram.day_air(target_day),
+        "deal": histogram.range_by_staff("deal", target_day, target_day),
+        "monthly_deal": histogram.range_by_staff("deal", month_start, month_end),
+    }
 
 
 async def get_monthly_stats() -> Optional[Dict]:
     """
     Lấy thống kê tháng hiện tại từ Dashboard
     """
-    from lark_base import generate_dashboard_summary
+    # v5.9.0: Báo cáo gửi cả team + lưu lại → luôn lấy số mới (force_refresh), không dùng summary pre-warm / stale
+    # (trong shared_fetches của lượt gửi báo cáo nên không fetch Booking lần 2)
+    from summaries import get_kalle_dashboard_summary
     
     now = datetime.now(VN_TZ)
     month = now.month
     
     print(f"📊 Getting monthly stats for month {month}...")
     
-    data = await generate_dashboard_summary(month=month)
+    data = await get_kalle_dashboard_summary(month=month, force_refresh=True)
     
     if not data:
         print("❌ Failed to get dashboard data")
@@ -727,14 +243,10 @@ def find_staff_data(staff_info: Dict, data_dict: Dict, monthly_list: List[Dict])
     """
     Tìm data của nhân sự từ yesterday_data và monthly_stats
     """
-    dashboard_names = staff_info.get("dashboard_names", [])
+    staff_id = BOOKING_STAFF_INDEX.resolve_any([staff_info.get("name")] + staff_info.get("dashboard_names", []))
     
     # Tìm trong yesterday_data
-    yesterday_stats = None
-    for key, value in data_dict.items():
-        if match_staff_name(key, dashboard_names):
-            yesterday_stats = value
-            break
+    yesterday_stats = BOOKING_STAFF_INDEX.lookup(staff_id, data_dict) if staff_id else None
     
     if not yesterday_stats:
         yesterday_stats = {"count": 0, "cart": 0, "text": 0}
@@ -742,8 +254,7 @@ def find_staff_data(staff_info: Dict, data_dict: Dict, monthly_list: List[Dict])
     # Tìm trong monthly_list
     monthly_personal = None
     for staff in monthly_list:
-        staff_name = staff.get("name", "")
-        if match_staff_name(staff_name, dashboard_names):
+        if staff_id and BOOKING_STAFF_INDEX.resolve(staff.get("name", "")) == staff_id:
             monthly_personal = staff
             break
     
@@ -790,17 +301,13 @@ async def generate_personal_report(
     deal_yesterday = 0
     deal_month_total = 0
     
-    if yesterday_deal_data:
-        for deal_name, count in yesterday_deal_data.items():
-            if match_staff_name(deal_name, dashboard_names):
-                deal_yesterday = count
-                break
+    staff_id = BOOKING_STAFF_INDEX.resolve_any([staff_info.get("name")] + dashboard_names)
+    
+    if yesterday_deal_data and staff_id:
+        deal_yesterday = BOOKING_STAFF_INDEX.lookup(staff_id, yesterday_deal_data) or 0
     
-    if monthly_deal_data:
-        for deal_name, count in monthly_deal_data.items():
-            if match_staff_name(deal_name, dashboard_names):
-                deal_month_total = count
-                break
+    if monthly_deal_data and staff_id:
+        deal_month_total = BOOKING_STAFF_INDEX.lookup(staff_id, monthly_deal_data) or 0
     
     # Logic deal: Tính KPI deal theo ngày trong tháng
     # Số ngày đã qua trong tháng (tính đến hôm qua)
@@ -882,14 +389,75 @@ async def generate_team_report(monthly_stats: Dict) -> str:
     return message
 
 
-async def send_daily_booking_reports():
+DAILY_REPORT_JOB = "daily_booking"
+
+
+async def build_daily_messages(yesterday: datetime, now: datetime) -> Optional[tuple]:
+    """
+    Tính số liệu + soạn toàn bộ tin của báo cáo hàng ngày
+    
+    Returns:
+        (List[OutgoingMessage] - cá nhân + team, aggregates) hoặc None nếu không lấy được dashboard
+    """
+    # v5.9.0: 1 lượt quét Booking cho air / deal hôm qua + deal cả tháng;
+    # dashboard (nếu phải tính lại) dùng chung lần fetch Booking đó
+    from lark_base import shared_fetches
+    with shared_fetches():
+        scan = await scan_booking_for_daily_report(yesterday, month_of=now)
+        monthly_stats = await get_monthly_stats()
+    
+    yesterday_data = scan["air"]
+    yesterday_deal_data = scan["deal"]
+    monthly_deal_data = scan["monthly_deal"]
+    
+    if not monthly_stats:
+        print("❌ Failed to get monthly stats, aborting...")
+        return None
+    
+    # 1. Thông báo cá nhân
+    messages = []
+    for user_id, staff_info in BOOKING_STAFF.items():
+        try:
+            message = await generate_personal_report(
+                user_id, 
+                staff_info, 
+                yesterday_data, 
+                monthly_stats,
+                yesterday_deal_data,
+                monthly_deal_data
+            )
+            messages.append(OutgoingMessage(user_id, message, "user_id", label=staff_info["name"]))
+        except Exception as e:
+            print(f"   ❌ {staff_info['name']} - Error: {e}")
+    
+    # 2. Báo cáo team
+    try:
+        team_message = await generate_team_report(monthly_stats)
+        messages.append(OutgoingMessage(BOOKING_GROUP_CHAT_ID, team_message, "chat_id", label="Team report"))
+    except Exception as e:
+        print(f"   ❌ Team report error: {e}")
+    
+    aggregates = {"air": yesterday_data, "deal": yesterday_deal_data, "monthly_deal": monthly_deal_data}
+    return messages, aggregates
+
+
+async def send_daily_booking_reports(force: bool = False) -> Optional[Dict]:
     """
     Main function: Gửi báo cáo hàng ngày
     1. Gửi thông báo cá nhân cho từng nhân sự
     2. Gửi báo cáo team vào nhóm
     
     Schedule: 9h00 sáng hàng ngày, kết thúc 14/2/2026
+    
+    v5.9.0: mỗi lượt khoá theo (ngày dữ liệu, job) và lưu checkpoint (report_runs):
+    chạy lại / restart giữa chừng → dùng lại tin đã soạn, chỉ gửi người chưa nhận;
+    lượt đã xong thì bỏ qua. force=True: tính lại và gửi lại từ đầu.
+    
+    Returns:
+        {"date", "resumed", "personal": tổng kết fan-out, "run"} (None nếu không chạy / lỗi)
     """
+    from report_runs import RUN_COMPLETED, get_run, pending_messages, record_results, save_run
+    
     now = datetime.now(VN_TZ)
     
     print(f"\n{'='*50}")
@@ -900,71 +468,58 @@ async def send_daily_booking_reports():
     if now >= SCHEDULE_END_DATE:
         print(f"⏰ Schedule ended. Current: {now}, End date: {SCHEDULE_END_DATE}")
         print("📊 Daily booking reports are no longer scheduled.")
-        return
+        return None
     
     try:
         # Lấy data - use Vietnam timezone
         yesterday = now - timedelta(days=1)
-        current_month = now.month
-        print(f"📅 Getting data for yesterday: {yesterday.strftime('%Y/%m/%d')}")
-        
-        # Get video air data
-        yesterday_data = await get_video_air_by_date(yesterday)
-        monthly_stats = await get_monthly_stats()
-        
-        # Get deal data
-        print(f"📅 Getting deal data...")
-        yesterday_deal_data = await get_deal_by_date(yesterday)
-        monthly_deal_data = await get_monthly_deal_stats(current_month)
-        
-        if not monthly_stats:
-            print("❌ Failed to get monthly stats, aborting...")
-            return
-        
-        # 1. Gửi thông báo cá nhân
-        print(f"\n📤 Sending personal reports to {len(BOOKING_STAFF)} staff members...")
-        success_count = 0
-        for user_id, staff_info in BOOKING_STAFF.items():
-            try:
-                message = await generate_personal_report(
-                    user_id, 
-                    staff_info, 
-                    yesterday_data, 
-                    monthly_stats,
-                    yesterday_deal_data,
-                    monthly_deal_data
-                )
-                result = await send_message_to_user(user_id, message)
-                if result:
-                    success_count += 1
-                    print(f"   ✅ {staff_info['name']}")
-                else:
-                    print(f"   ❌ {staff_info['name']} - Failed to send")
-            except Exception as e:
-                print(f"   ❌ {staff_info['name']} - Error: {e}")
-        
-        print(f"📊 Personal reports sent: {success_count}/{len(BOOKING_STAFF)}")
-        
-        # 2. Gửi báo cáo team
-        print(f"\n📤 Sending team report to group...")
-        try:
-            team_message = await generate_team_report(monthly_stats)
-            result = await send_message_to_chat(BOOKING_GROUP_CHAT_ID, team_message)
-            if result:
-                print("   ✅ Team report sent successfully")
-            else:
-                print("   ❌ Failed to send team report")
-        except Exception as e:
-            print(f"   ❌ Team report error: {e}")
+        run_date = yesterday.strftime("%Y-%m-%d")
+        
+        run = None if force else get_run(run_date, DAILY_REPORT_JOB)
+        if run and run["status"] == RUN_COMPLETED:
+            print(f"⏭️ Daily booking reports for {run_date} already sent, skipping")
+            return {"date": run_date, "resumed": False, "skipped": True, "run": run}
+        
+        resumed = run is not None
+        if resumed:
+            print(f"♻️ Resuming daily booking reports for {run_date}: {run['deliveries']}")
+        else:
+            print(f"📅 Getting data for yesterday: {yesterday.strftime('%Y/%m/%d')}")
+            built = await build_daily_messages(yesterday, now)
+            if built is None:
+                return None
+            messages, aggregates = built
+            save_run(run_date, DAILY_REPORT_JOB, messages, payload=aggregates)
+        
+        # Gửi song song có giới hạn (fan-out + retry), ghi checkpoint ngay khi từng người nhận xong
+        pending = pending_messages(run_date, DAILY_REPORT_JOB)
+        print(f"\n📤 Sending {len(pending)} daily booking messages...")
+        summary = await fan_out_messages(
+            pending,
+            on_result=lambda result: record_results(run_date, DAILY_REPORT_JOB, [result]),
+        )
+        run = get_run(run_date, DAILY_REPORT_JOB)
         
         print(f"\n{'='*50}")
-        print(f"📊 Daily booking reports completed at {datetime.now(VN_TZ)}")
+        print(f"📊 Daily booking reports completed at {datetime.now(VN_TZ)}: {run['deliveries']}")
         print(f"{'='*50}\n")
+        return {"date": run_date, "resumed": resumed, "personal": summary, "run": run}
         
     except Exception as e:
         print(f"❌ Error in daily booking reports: {e}")
         import traceback
         traceback.print_exc()
+        return None
+
+
+async def resume_daily_booking_reports():
+    """Startup: lượt gửi của hôm nay bị dừng giữa chừng (restart) → gửi tiếp người chưa nhận"""
+    from report_runs import incomplete_runs
+    
+    yesterday = (datetime.now(VN_TZ) - timedelta(days=1)).strftime("%Y-%m-%d")
+    if incomplete_runs(DAILY_REPORT_JOB, since=yesterday):
+        print("♻️ Found unfinished daily booking run, resuming...")
+        await send_daily_booking_reports()
 
 
 # For testing
@@ -0,0 +1,122 @@
+"""
+Event Workers Module
+Hàng đợi + pool worker xử lý event Lark ở nền
+Version 5.9.0
+
+- /lark/events chỉ kiểm tra, giải mã, lọc trùng rồi đưa job vào hàng đợi → trả 200 ngay
+  (Lark coi phản hồi chậm là lỗi và gửi lại event → tính cùng 1 câu hỏi nhiều lần)
+- EVENT_WORKERS worker chạy các job song song
+- Metrics: độ sâu hàng đợi, thời gian chờ, thời gian xử lý, job lỗi / bị từ chối
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# ============ CONFIG ============
+EVENT_WORKERS = int(os.getenv("EVENT_WORKERS", "4"))
+EVENT_QUEUE_MAX = int(os.getenv("EVENT_QUEUE_MAX", "500"))
+
+Job = Callable[[], Awaitable[Any]]
+
+
+def _percentiles(values) -> Dict[str, float]:
+    values = sorted(values)
+    if not values:
+        return {"count": 0, "avg": 0, "p50": 0, "p95": 0}
+    return {
+        "count": len(values),
+        "avg": round(sum(values) / len(values), 1),
+        "p50": round(values[len(values) // 2], 1),
+        "p95": round(values[int(len(values) * 0.95)], 1),
+    }
+
+
+class EventWorkerPool:
+    """asyncio.Queue + N worker; mỗi job là 1 coroutine function không tham số"""
+
+    def __init__(self, workers: int = EVENT_WORKERS, max_queue: int = EVENT_QUEUE_MAX):
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._wait_ms: deque = deque(maxlen=500)
+        self._run_ms: deque = deque(maxlen=500)
+        self.busy = 0
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+
+    def start(self):
+        """Chạy các worker (cần event loop đang chạy; gọi lại nhiều lần không sao)"""
+        if self._tasks and not all(t.done() for t in self._tasks):
+            return
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        print(f"👷 Event workers started: {self.workers} workers, queue max {self.max_queue}")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, job: Job, label: str = "") -> bool:
+        """Đưa job vào hàng đợi; False nếu hàng đợi đầy"""
+        self.start()
+        try:
+            self._queue.put_nowait((job, label, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            print(f"⚠️ Event queue full ({self.max_queue}), rejected {label}")
+            return False
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    async def _worker(self, index: int):
+        while True:
+            job, label, enqueued_at = await self._queue.get()
+            started = time.perf_counter()
+            self._wait_ms.append((started - enqueued_at) * 1000)
+            self.busy += 1
+            try:
+                await job()
+                self.processed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                print(f"❌ Event job {label} failed: {e}")
+                import traceback
+                traceback.print_exc()
+            finally:
+                self.busy -= 1
+                self._run_ms.append((time.perf_counter() - started) * 1000)
+                self._queue.task_done()
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "running": bool(self._tasks) and not all(t.done() for t in self._tasks),
+            "busy": self.busy,
+            "depth": self._queue.qsize() if self._queue else 0,
+            "max_depth": self.max_depth,
+            "submitted": self.submitted,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait_ms": _percentiles(self._wait_ms),
+            "run_ms": _percentiles(self._run_ms),
+        }
+
+
+_pool = EventWorkerPool()
+
+
+def get_event_pool() -> EventWorkerPool:
+    return _pool
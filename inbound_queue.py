@@ -0,0 +1,262 @@
+"""
+Inbound Queue Module
+Lưu event tin nhắn Lark xuống SQLite trước khi trả 200, worker nhận job theo lease
+Version 5.9.0
+
+- Event được ghi (commit) vào inbound.db rồi mới ack Lark → deploy / OOM giữa lúc tính báo cáo
+  không làm mất câu hỏi: restart xong event chưa xong được chạy lại
+- Mỗi job được claim với lease; job đang chạy gia hạn lease định kỳ, lease hết hạn (process chết)
+  → job quay lại hàng đợi
+- Lỗi → thử lại tối đa INBOUND_MAX_ATTEMPTS lần
+- Thực thi qua event worker pool (event_workers); pump() đưa các job còn tồn / hết lease vào pool
+- Backpressure: hàng đợi vượt INBOUND_BUSY_THRESHOLD → không nhận thêm, trả lời "đang bận"
+- Tin placeholder "đang tổng hợp…" của job được lưu kèm job → chạy lại sau restart thì sửa đúng tin cũ
+"""
+import asyncio
+import contextvars
+import json
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from local_store import get_connection
+from event_workers import get_event_pool
+
+# ============ CONFIG ============
+INBOUND_LEASE_SECONDS = float(os.getenv("INBOUND_LEASE_SECONDS", "120"))
+INBOUND_MAX_ATTEMPTS = int(os.getenv("INBOUND_MAX_ATTEMPTS", "3"))
+INBOUND_BUSY_THRESHOLD = int(os.getenv("INBOUND_BUSY_THRESHOLD", "50"))
+INBOUND_RETENTION_HOURS = float(os.getenv("INBOUND_RETENTION_HOURS", "24"))
+INBOUND_PUMP_SECONDS = int(os.getenv("INBOUND_PUMP_SECONDS", "30"))
+
+BUSY_TEXT = "⏳ Jarvis đang bận xử lý nhiều yêu cầu, bạn vui lòng hỏi lại sau ít phút nhé."
+
+_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS inbound_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_key TEXT UNIQUE,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER DEFAULT 0,
+        lease_until REAL DEFAULT 0,
+        created_at REAL NOT NULL,
+        updated_at REAL,
+        last_error TEXT,
+        placeholder_outbox_id INTEGER
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_inbound_status ON inbound_events (status, id)",
+)
+
+Handler = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+# Job inbound đang chạy trong context hiện tại (None nếu không chạy qua inbound queue)
+_current_job: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("inbound_job", default=None)
+
+
+def _db():
+    conn = get_connection("inbound")
+    for statement in _SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+class InboundQueue:
+    """Hàng đợi event vào bền vững; handler(event) xử lý 1 event"""
+
+    def __init__(self):
+        self.handler: Optional[Handler] = None
+        self._scheduled: Set[int] = set()
+        self.accepted = 0
+        self.busy_rejected = 0
+        self.replayed = 0
+        self.completed = 0
+        self.failed = 0
+
+    def set_handler(self, handler: Handler):
+        self.handler = handler
+
+    # ----- Producer -----
+
+    def depth(self) -> int:
+        return _db().execute(
+            "SELECT COUNT(*) FROM inbound_events WHERE status IN ('queued', 'processing')"
+        ).fetchone()[0]
+
+    def is_busy(self) -> bool:
+        return self.depth() >= INBOUND_BUSY_THRESHOLD
+
+    def note_busy_rejection(self):
+        self.busy_rejected += 1
+
+    def accept(self, event_key: Optional[str], event: Dict[str, Any]) -> Optional[int]:
+        """
+        Ghi event xuống disk rồi đưa vào worker pool
+        Returns: id của job, None nếu event_key đã có (Lark gửi lại event cũ)
+        """
+        now = time.time()
+        conn = _db()
+        with conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO inbound_events (event_key, payload, created_at, updated_at) "
+                "VALUES (?,?,?,?)",
+                (event_key, json.dumps(event, ensure_ascii=False), now, now)
+            )
+        if cursor.rowcount == 0:
+            return None
+        self.accepted += 1
+        self._schedule(cursor.lastrowid)
+        return cursor.lastrowid
+
+    def _schedule(self, job_id: int) -> bool:
+        if job_id in self._scheduled:
+            return True
+        if not get_event_pool().submit(lambda: self._run(job_id), label=f"inbound#{job_id}"):
+            return False  # Pool đầy → job vẫn nằm trong DB, pump() đưa vào sau
+        self._scheduled.add(job_id)
+        return True
+
+    # ----- Worker -----
+
+    def _claim(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """Nhận job nếu còn chờ hoặc lease cũ đã hết hạn"""
+        now = time.time()
+        conn = _db()
+        with conn:
+            claimed = conn.execute(
+                "UPDATE inbound_events SET status='processing', lease_until=?, attempts=attempts+1, updated_at=? "
+                "WHERE id=? AND (status='queued' OR (status='processing' AND lease_until < ?))",
+                (now + INBOUND_LEASE_SECONDS, now, job_id, now)
+            ).rowcount
+        if not claimed:
+            return None
+        row = conn.execute("SELECT payload, attempts FROM inbound_events WHERE id=?", (job_id,)).fetchone()
+        return {"event": json.loads(row["payload"]), "attempts": row["attempts"]}
+
+    async def _heartbeat(self, job_id: int):
+        """Gia hạn lease trong lúc job còn chạy"""
+        while True:
+            await asyncio.sleep(INBOUND_LEASE_SECONDS / 3)
+            conn = _db()
+            with conn:
+                conn.execute("UPDATE inbound_events SET lease_until=? WHERE id=? AND status='processing'",
+                             (time.time() + INBOUND_LEASE_SECONDS, job_id))
+
+    async def _run(self, job_id: int):
+        try:
+            job = self._claim(job_id)
+            if job is None or self.handler is None:
+                return
+            heartbeat = asyncio.create_task(self._heartbeat(job_id))
+            token = _current_job.set(job_id)
+            try:
+                await self.handler(job["event"])
+            except Exception as e:
+                self._finish(job_id, job["attempts"], error=str(e))
+                raise
+            finally:
+                _current_job.reset(token)
+                heartbeat.cancel()
+            self._finish(job_id, job["attempts"])
+        finally:
+            self._scheduled.discard(job_id)
+
+    def _finish(self, job_id: int, attempts: int, error: Optional[str] = None):
+        if error is None:
+            status = "done"
+            self.completed += 1
+        elif attempts >= INBOUND_MAX_ATTEMPTS:
+            status = "failed"
+            self.failed += 1
+        else:
+            status = "queued"  # pump() chạy lại
+        conn = _db()
+        with conn:
+            conn.execute(
+                "UPDATE inbound_events SET status=?, lease_until=0, updated_at=?, last_error=? WHERE id=?",
+                (status, time.time(), error, job_id)
+            )
+
+    # ----- Replay -----
+
+    def recover(self) -> int:
+        """Startup: job 'processing' là của process trước (đã chết) → trả về hàng đợi ngay"""
+        conn = _db()
+        with conn:
+            return conn.execute(
+                "UPDATE inbound_events SET status='queued', lease_until=0 WHERE status='processing'"
+            ).rowcount
+
+    def pump(self) -> int:
+        """Đưa các job đang chờ / hết lease (chưa có trong pool) vào worker pool, dọn job cũ"""
+        now = time.time()
+        conn = _db()
+        rows = conn.execute(
+            "SELECT id FROM inbound_events WHERE status='queued' OR (status='processing' AND lease_until < ?) "
+            "ORDER BY id",
+            (now,)
+        ).fetchall()
+        scheduled = 0
+        for row in rows:
+            if row["id"] in self._scheduled:
+                continue
+            if not self._schedule(row["id"]):
+                break
+            scheduled += 1
+        if scheduled:
+            self.replayed += scheduled
+            print(f"♻️ Inbound queue: replayed {scheduled} pending events")
+        with conn:
+            conn.execute("DELETE FROM inbound_events WHERE status IN ('done', 'failed') AND updated_at < ?",
+                         (now - INBOUND_RETENTION_HOURS * 3600,))
+        return scheduled
+
+    def metrics(self) -> Dict[str, Any]:
+        conn = _db()
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM inbound_events GROUP BY status").fetchall())
+        oldest = conn.execute(
+            "SELECT MIN(created_at) FROM inbound_events WHERE status IN ('queued', 'processing')"
+        ).fetchone()[0]
+        return {
+            "depth": counts.get("queued", 0) + counts.get("processing", 0),
+            "busy_threshold": INBOUND_BUSY_THRESHOLD,
+            "statuses": counts,
+            "oldest_pending_age_s": round(time.time() - oldest, 1) if oldest else 0,
+            "accepted": self.accepted,
+            "busy_rejected": self.busy_rejected,
+            "replayed": self.replayed,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+
+def get_job_placeholder() -> Optional[int]:
+    """Outbox id của tin placeholder mà job đang chạy đã gửi ở lượt trước (trước khi restart)"""
+    job_id = _current_job.get()
+    if job_id is None:
+        return None
+    row = _db().execute("SELECT placeholder_outbox_id FROM inbound_events WHERE id=?", (job_id,)).fetchone()
+    return row[0] if row else None
+
+
+def set_job_placeholder(outbox_id: int):
+    """Lưu tin placeholder vào job đang chạy (không làm gì nếu không chạy qua inbound queue)"""
+    job_id = _current_job.get()
+    if job_id is None:
+        return
+    conn = _db()
+    with conn:
+        conn.execute("UPDATE inbound_events SET placeholder_outbox_id=? WHERE id=?", (outbox_id, job_id))
+
+
+_inbound_queue = InboundQueue()
+
+
+def get_inbound_queue() -> InboundQueue:
+    return _inbound_queue
+
+
+async def pump_inbound_events() -> int:
+    """Job định kỳ (async → chạy trên event loop, pool dùng asyncio.Queue)"""
+    return _inbound_queue.pump()
@@ -5,7 +5,7 @@ Version 5.7.13 - Fixed CHENG staff KPI routing (is_dashboard flag)
 """
 import re
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Callable, List, Optional, Tuple
 
 # ============ INTENT TYPES ============
 INTENT_KOC_REPORT = "KOC_REPORT"  # Báo cáo KOC Kalle (mặc định)
@@ -15,6 +15,8 @@ INTENT_TASK_SUMMARY = "TASK_SUMMARY"  # Phân tích task theo vị trí
 INTENT_GENERAL_SUMMARY = "GENERAL_SUMMARY"
 INTENT_GPT_CHAT = "GPT_CHAT"  # Hỏi ChatGPT trực tiếp
 INTENT_DASHBOARD = "DASHBOARD"  # Dashboard tổng hợp
+INTENT_TREND = "TREND"  # v5.9.0: Xu hướng KPI nhiều tháng (đọc từ lịch sử cục bộ)
+INTENT_KOC_CHANNEL = "KOC_CHANNEL"  # v5.9.0: GMV của 1 kênh KOC qua các tháng (ledger)
 INTENT_UNKNOWN = "UNKNOWN"
 
 # Keywords để nhận dạng brand Cheng
@@ -72,6 +74,40 @@ DASHBOARD_KEYWORDS = [
     "báo cáo team", "bao cao team", "booking tháng"
 ]
 
+# v5.9.0: Keywords cho xu hướng nhiều tháng
+TREND_KEYWORDS = [
+    "xu hướng", "xu huong", "lịch sử kpi", "lich su kpi",
+]
+
+# Khoảng nhiều tháng: chỉ là xu hướng khi câu hỏi không nhắm 1 báo cáo dashboard cụ thể
+TREND_PERIOD_KEYWORDS = [
+    "so sánh các tháng", "so sanh cac thang", "qua các tháng", "qua cac thang",
+    "tháng gần đây", "thang gan day",
+]
+
+# Báo cáo dashboard cụ thể: "top KOC 3 tháng gần đây" là top KOC, không phải xu hướng KPI
+SPECIFIC_DASHBOARD_KEYWORDS = [
+    "top koc", "doanh số", "doanh so", "doanh thu", "gmv",
+    "liên hệ", "lien he", "tỷ lệ deal", "ty le deal",
+]
+
+# "trend" (nguyên từ) chỉ tính là xu hướng KPI khi đi kèm 1 trong các từ này ("trending koc", "trend content" thì không)
+TREND_CONTEXT_KEYWORDS = [
+    "kpi", "gmv", "doanh số", "doanh so", "doanh thu", "booking", "deal",
+    "liên hệ", "lien he", "nhân sự", "nhan su",
+] + BRAND_KEYWORDS + CHENG_KEYWORDS
+
+_TREND_WORD = re.compile(r'\btrend\b')
+
+# v5.9.0: Số liệu từng tuần / so sánh tuần (report_type "theo_tuan")
+WEEK_BREAKDOWN_KEYWORDS = [
+    "theo tuần", "theo tuan", "từng tuần", "tung tuan", "các tuần", "cac tuan",
+    "so sánh tuần", "so sanh tuan", "week over week",
+]
+
+# Loại dashboard mà "theo tuần" được phép thay bằng "theo_tuan" (liên hệ, KPI nhân sự... giữ nguyên)
+WEEK_BREAKDOWN_REPORT_TYPES = {"full", "top_koc", "kpi_team"}
+
 # ============ NHÂN SỰ MAPPING ============
 # Danh sách nhân sự CHENG (để detect và route sang CHENG_REPORT)
 # Updated v5.7.13 - Danh sách đầy đủ từ bảng CHENG Dashboard
@@ -155,6 +191,25 @@ VI_TRI_MAPPING = {
     "pr": ["pr", "pr booking"],
 }
 
+# v5.9.0: Sort theo độ dài + compile regex 1 lần khi import (không làm lại mỗi câu hỏi)
+def _compile_nhan_su_patterns(mapping: Dict[str, str]):
+    return [
+        (short_name, full_name, re.compile(r'\b' + re.escape(short_name) + r'\b'))
+        for short_name, full_name in sorted(mapping.items(), key=lambda x: len(x[0]), reverse=True)
+    ]
+
+
+_KALLE_NHAN_SU_PATTERNS = _compile_nhan_su_patterns(NHAN_SU_MAPPING)
+_CHENG_NHAN_SU_PATTERNS = _compile_nhan_su_patterns(CHENG_NHAN_SU_MAPPING)
+
+
+def _detect_nhan_su(text_lower: str, patterns) -> Optional[str]:
+    """Tên nhân sự dài nhất xuất hiện trong câu (theo word boundary)"""
+    for short_name, full_name, pattern in patterns:
+        if short_name in text_lower and pattern.search(text_lower):
+            return full_name
+    return None
+
 # ============ TIME PARSING ============
 def parse_month(text: str) -> Optional[int]:
     """Extract tháng từ text"""
@@ -178,6 +233,51 @@ def parse_month(text: str) -> Optional[int]:
     # Tháng hiện tại nếu không tìm thấy
     return None
 
+def parse_month_range(text: str) -> Optional[tuple]:
+    """Khoảng tháng: "từ tháng 9 đến tháng 12", "tháng 9-12" → (9, 12)"""
+    text = text.lower()
+    patterns = [
+        r'(?:từ|tu)\s*(?:tháng|thang|t)\s*(\d{1,2})\s*(?:đến|den|tới|toi|-)\s*(?:tháng|thang|t)?\s*(\d{1,2})',
+        r'(?:tháng|thang)\s*(\d{1,2})\s*(?:-|đến|den|tới|toi)\s*(?:tháng|thang)?\s*(\d{1,2})',
+    ]
+    for pattern in patterns:
+        match = re.search(pattern, text)
+        if match:
+            start, end = int(match.group(1)), int(match.group(2))
+            if 1 <= start <= end <= 12:
+                return (start, end)
+    return None
+
+
+# Từ không phải ID kênh (tên sàn, mention "@_all" / "@_user_1" của Lark...)
+_CHANNEL_STOPWORDS = {
+    "nào", "nao", "koc", "top", "tháng", "thang", "này", "nay", "đó", "do",
+    "tiktok", "shopee", "lazada", "youtube", "facebook", "instagram", "tiki", "sendo",
+    "_all", "all", "jarvis",
+}
+
+# "@handle" chỉ được coi là kênh KOC khi câu hỏi có 1 trong các từ này
+_CHANNEL_CONTEXT_KEYWORDS = ["koc", "gmv"]
+
+
+def _is_channel_token(token: str) -> bool:
+    token = token.lower()
+    return token not in _CHANNEL_STOPWORDS and not re.fullmatch(r'_user_\d+', token)
+
+
+def parse_koc_channel(text: str) -> Optional[str]:
+    """ID kênh KOC trong câu hỏi: "id kênh abc_xyz", hoặc "@abc.xyz" đi kèm từ KOC / GMV"""
+    match = re.search(r'(?:id kênh|id kenh)\s*:?\s*@?([A-Za-z0-9_.]{3,})', text, re.IGNORECASE)
+    if match and _is_channel_token(match.group(1)):
+        return match.group(1)
+    text_lower = text.lower()
+    if any(kw in text_lower for kw in _CHANNEL_CONTEXT_KEYWORDS):
+        for match in re.finditer(r'(?<![\w.])@([A-Za-z0-9_.]{2,})', text):
+            if _is_channel_token(match.group(1)):
+                return match.group(1)
+    return None
+
+
 def parse_week(text: str) -> Optional[int]:
     """Extract tuần từ text"""
     text = text.lower()
@@ -204,6 +304,37 @@ def parse_week(text: str) -> Optional[int]:
     
     return None
 
+def parse_previous_week(text: str, today: Optional[datetime] = None) -> Optional[Tuple[int, int, int]]:
+    """"tuần trước" → (năm, tháng, tuần) của tuần liền trước tuần hiện tại (cùng cách đánh số với "tuần này")"""
+    text = text.lower()
+    if "tuần trước" not in text and "tuan truoc" not in text and "last week" not in text:
+        return None
+    today = today or datetime.now()
+    week = min((today.day - 1) // 7 + 1, 4) - 1
+    if week >= 1:
+        return today.year, today.month, week
+    if today.month == 1:
+        return today.year - 1, 12, 4
+    return today.year, today.month - 1, 4
+
+
+def parse_month_span(text: str) -> Optional[int]:
+    """Extract số tháng cho câu hỏi nhiều tháng: "6 tháng gần đây", "3 tháng qua" """
+    match = re.search(r'(\d{1,2})\s*(?:tháng|thang)\s*(?:gần|gan|qua|trước|truoc|vừa|vua|liên tiếp|lien tiep)', text.lower())
+    if match:
+        months = int(match.group(1))
+        if 1 <= months <= 36:
+            return months
+    return None
+
+
+def parse_year(text: str) -> Optional[int]:
+    """Extract năm từ text: "năm 2025", "2024" """
+    match = re.search(r'(?:năm|nam)\s*(\d{4})', text.lower()) or re.search(r'\b(20\d{2})\b', text)
+    if match:
+        return int(match.group(1))
+    return None
+
 def parse_team(text: str) -> Optional[str]:
     """Extract team từ text"""
     text = text.lower()
@@ -273,12 +404,13 @@ def extract_gpt_question(text: str) -> str:
     return result.strip()
 
 
-def classify_intent(text: str) -> Dict[str, Any]:
+def classify_intent(text: str, channel_lookup: Optional[Callable[[str], List[str]]] = None) -> Dict[str, Any]:
     """
     Phân loại intent từ câu hỏi
     
     Args:
         text: Câu hỏi của người dùng
+        channel_lookup: Tra kênh KOC (TopKocIndex.find_channels); chỉ route KOC_CHANNEL khi tra ra kênh
     
     Returns:
         Dict chứa intent và các parameters
@@ -347,6 +479,11 @@ def classify_intent(text: str) -> Dict[str, Any]:
     current_month = datetime.now().month
     year = datetime.now().year
     
+    # v5.9.0: "tuần trước" → tuần cụ thể (có thể thuộc tháng / năm trước)
+    previous_week = parse_previous_week(text)
+    if previous_week and not month and not week:
+        year, month, week = previous_week
+    
     # ========== DETERMINE INTENT ==========
     
     # 0. Dashboard - khi hỏi về KPI, top KOC, doanh số, liên hệ nhân sự
@@ -359,10 +496,45 @@ def classify_intent(text: str) -> Dict[str, Any]:
         "tình hình booking", "tinh hinh booking"
     ])
     
+    # v5.9.0: Xu hướng nhiều tháng / nhiều năm
+    # Tháng cụ thể / câu hỏi lịch content (không có từ KPI) được ưu tiên hơn xu hướng
+    # Khoảng tháng ("3 tháng gần đây") + báo cáo dashboard cụ thể → vẫn là báo cáo đó, trừ khi hỏi rõ xu hướng
+    month_span = parse_month_span(text)
+    has_trend_context = any(kw in text_lower for kw in TREND_CONTEXT_KEYWORDS)
+    has_specific_dashboard = any(kw in text_lower for kw in SPECIFIC_DASHBOARD_KEYWORDS)
+    has_explicit_trend = any(kw in text_lower for kw in TREND_KEYWORDS) or (
+        bool(_TREND_WORD.search(text_lower)) and has_trend_context)
+    has_trend_phrase = has_explicit_trend or (
+        any(kw in text_lower for kw in TREND_PERIOD_KEYWORDS) and not has_specific_dashboard)
+    is_trend = (month_span is not None and (has_explicit_trend or not has_specific_dashboard)) or (
+        has_trend_phrase and month is None and not (content_score > 0 and not has_trend_context))
+    
+    # v5.9.0: Hỏi về 1 kênh KOC cụ thể (tra được trong ledger) → GMV theo kênh × tháng
+    koc_channel = parse_koc_channel(text)
+    month_range = parse_month_range(text)
+    if month_range is None and month_span and not is_trend:
+        # "top KOC 3 tháng gần đây" → khoảng tháng tới tháng hiện tại (trong năm nay)
+        month_range = (max(1, current_month - month_span + 1), current_month)
+    if koc_channel and channel_lookup and channel_lookup(koc_channel):
+        start_month, end_month = month_range or ((month, month) if month else (1, current_month))
+        return {
+            "intent": INTENT_KOC_CHANNEL,
+            "channel": koc_channel,
+            "brand": "CHENG" if any(kw in text_lower for kw in CHENG_KEYWORDS) else None,
+            "start_month": start_month,
+            "end_month": end_month,
+            "original_text": text
+        }
+    
+    # v5.9.0: Từng tuần / so sánh tuần → dashboard "theo_tuan" (câu hỏi báo cáo KOC vẫn là KOC_REPORT)
+    is_week_breakdown = any(kw in text_lower for kw in WEEK_BREAKDOWN_KEYWORDS)
+    if is_week_breakdown and koc_score == 0:
+        is_dashboard = True
+    
     # === CHECK CHENG TRƯỚC - nếu có keyword "cheng" ===
     is_cheng = any(kw in text_lower for kw in CHENG_KEYWORDS)
     
-    if is_cheng:
+    if is_cheng and not is_trend:
         # Nếu có "cheng" + (booking/koc/báo cáo/cập nhật) → CHENG_REPORT
         if koc_score > 0 or has_tong_hop or has_report_keywords or is_dashboard:
             return {
@@ -370,6 +542,10 @@ def classify_intent(text: str) -> Dict[str, Any]:
                 "month": month if month else current_month,
                 "week": week,
                 "year": year,
+                "report_type": "theo_tuan" if is_week_breakdown else (
+                    "top_koc_range" if month_range and ("top koc" in text_lower or "doanh số" in text_lower) else "full"),
+                "start_month": month_range[0] if month_range else None,
+                "end_month": month_range[1] if month_range else None,
                 "group_by": "product",
                 "product_filter": product_filter,
                 "original_text": text
@@ -380,29 +556,38 @@ def classify_intent(text: str) -> Dict[str, Any]:
     # This prevents "phương" matching when "phương thảo" was intended
     
     # Check KALLE staff FIRST (because has longer specific names like "phương thảo")
-    kalle_nhan_su_detected = None
-    sorted_kalle_mapping = sorted(NHAN_SU_MAPPING.items(), key=lambda x: len(x[0]), reverse=True)
-    for short_name, full_name in sorted_kalle_mapping:
-        if short_name in text_lower:
-            pattern = r'\b' + re.escape(short_name) + r'\b'
-            if re.search(pattern, text_lower):
-                kalle_nhan_su_detected = full_name
-                is_dashboard = True
-                break
+    kalle_nhan_su_detected = _detect_nhan_su(text_lower, _KALLE_NHAN_SU_PATTERNS)
+    if kalle_nhan_su_detected:
+        is_dashboard = True
     
     # Check CHENG staff (only if no KALLE match found)
     # FIX v5.7.13: Set is_dashboard=True when CHENG staff is detected
     cheng_nhan_su_detected = None
     if not kalle_nhan_su_detected:
-        sorted_cheng_mapping = sorted(CHENG_NHAN_SU_MAPPING.items(), key=lambda x: len(x[0]), reverse=True)
-        for short_name, full_name in sorted_cheng_mapping:
-            if short_name in text_lower:
-                pattern = r'\b' + re.escape(short_name) + r'\b'
-                if re.search(pattern, text_lower):
-                    cheng_nhan_su_detected = full_name
-                    # FIX v5.7.13: Set is_dashboard=True for CHENG staff KPI queries
-                    is_dashboard = True
-                    break
+        cheng_nhan_su_detected = _detect_nhan_su(text_lower, _CHENG_NHAN_SU_PATTERNS)
+        if cheng_nhan_su_detected:
+            # FIX v5.7.13: Set is_dashboard=True for CHENG staff KPI queries
+            is_dashboard = True
+    
+    if is_trend:
+        trend_year = parse_year(text)
+        if trend_year and not month_span:
+            # "xu hướng năm 2025" → cả năm (tới tháng hiện tại nếu là năm nay)
+            end_month = current_month if trend_year == year else 12
+            months = end_month
+        else:
+            trend_year = year
+            end_month = current_month
+            months = month_span or 6
+        return {
+            "intent": INTENT_TREND,
+            "brand": "CHENG" if (is_cheng or cheng_nhan_su_detected) else "KALLE",
+            "months": months,
+            "end_month": end_month,
+            "year": trend_year,
+            "nhan_su": kalle_nhan_su_detected or cheng_nhan_su_detected,
+            "original_text": text
+        }
     
     # Nếu detect được nhân sự CHENG → route sang CHENG_REPORT với nhan_su_filter
     if cheng_nhan_su_detected and is_dashboard:
@@ -430,20 +615,28 @@ def classify_intent(text: str) -> Dict[str, Any]:
         elif kalle_nhan_su_detected:
             report_type = "kpi_ca_nhan"
         elif "top koc" in text_lower or "doanh số" in text_lower or "doanh so" in text_lower or "gmv" in text_lower:
-            report_type = "top_koc"
+            report_type = "top_koc_range" if month_range else "top_koc"
         elif "liên hệ" in text_lower or "lien he" in text_lower or "tỷ lệ deal" in text_lower:
             report_type = "lien_he"
         elif "kpi" in text_lower and ("nhân sự" in text_lower or "nhan su" in text_lower):
             report_type = "kpi_nhan_su"
         elif "cảnh báo" in text_lower or "canh bao" in text_lower or "warning" in text_lower or "alert" in text_lower:
             report_type = "canh_bao"
+        elif "chi tiết content" in text_lower or "chi tiet content" in text_lower:
+            report_type = "content_detail"
+        
+        # v5.9.0: Từng tuần chỉ thay báo cáo tổng / top KOC / team, không đè loại báo cáo cụ thể khác
+        if is_week_breakdown and report_type in WEEK_BREAKDOWN_REPORT_TYPES:
+            report_type = "theo_tuan"
         
         return {
             "intent": INTENT_DASHBOARD,
             "month": month if month else current_month,
             "week": week,
             "year": year,
-            "report_type": report_type,  # "full", "top_koc", "lien_he", "kpi_nhan_su", "kpi_ca_nhan", "canh_bao"
+            "report_type": report_type,  # "full", "top_koc", "top_koc_range", "lien_he", "kpi_nhan_su", "kpi_ca_nhan", "canh_bao", "content_detail", "theo_tuan"
+            "start_month": month_range[0] if month_range else None,
+            "end_month": month_range[1] if month_range else None,
             "nhan_su": kalle_nhan_su_detected,  # Tên nhân sự cụ thể (nếu có)
             "original_text": text
         }
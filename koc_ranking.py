@@ -0,0 +1,266 @@
+"""
+KOC Ranking Module
+Sổ GMV theo kênh KOC × tháng (ledger) cho câu hỏi theo từng kênh / top KOC nhiều tháng
+Version 5.9.0
+
+- Ledger: kênh (đã chuẩn hoá) → {(brand, tháng): [GMV, số record]}
+  → tổng GMV, tháng tốt nhất, % đóng góp, xếp hạng khoảng tháng bất kỳ chỉ là tra index
+- Record doanh thu thêm / sửa / xoá → trừ đóng góp cũ, cộng đóng góp mới
+- Top KOC của 1 tháng / tuần trong summary tính từ chính các dòng doanh thu của summary (lark_base)
+- Định kỳ (KOC_RANKING_VERIFY_HOURS) tính lại toàn bộ để kiểm tra lệch
+"""
+import heapq
+import os
+import re
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from lark_base import (
+    get_all_records,
+    get_record,
+    safe_extract_text,
+    safe_number,
+    DOANH_THU_KOC_TABLE,
+    CHENG_DOANH_THU_KOC_TABLE,
+)
+
+# ============ CONFIG ============
+KOC_RANKING_VERIFY_HOURS = int(os.getenv("KOC_RANKING_VERIFY_HOURS", "6"))
+
+# table_id → (brand, bảng, max_records như hàm get_*_doanh_thu_* để dùng chung fetch)
+RANKING_TABLES = {
+    DOANH_THU_KOC_TABLE["table_id"]: ("KALLE", DOANH_THU_KOC_TABLE, 1000),
+    CHENG_DOANH_THU_KOC_TABLE["table_id"]: ("CHENG", CHENG_DOANH_THU_KOC_TABLE, 2000),
+}
+
+
+def _parse_int(value) -> Optional[int]:
+    text = safe_extract_text(value)
+    if text is None:
+        return None
+    if isinstance(text, (int, float)):
+        return int(text)
+    match = re.search(r'\d+', str(text))
+    return int(match.group()) if match else None
+
+
+def normalize_channel(channel: Any) -> str:
+    """ID kênh chuẩn hoá: bỏ @, khoảng trắng, lowercase"""
+    return str(channel or "").strip().lstrip("@").strip().lower()
+
+
+def revenue_contribution(brand: str, fields: Dict[str, Any]) -> Optional[Tuple[int, str, float]]:
+    """(tháng, kênh, GMV) của 1 record doanh thu KOC, None nếu không tính vào ledger"""
+    month = _parse_int(fields.get("Tháng báo cáo"))
+    id_kenh = safe_extract_text(fields.get("ID kênh"))
+    if not month or not id_kenh:
+        return None
+    return month, str(id_kenh), float(safe_number(fields.get("GMV")))
+
+
+class TopKocIndex:
+    """
+    GMV theo kênh × (brand, tháng)
+
+    _records giữ đóng góp gần nhất của mỗi record → update / delete trừ đúng phần cũ
+    """
+
+    def __init__(self):
+        self._records: Dict[str, Tuple[str, Tuple[int, str, float]]] = {}
+        self._built_brands: Dict[str, float] = {}
+        # Ledger: kênh chuẩn hoá → {(brand, tháng): [gmv, số record]}; tổng GMV của (brand, tháng)
+        self._ledger: Dict[str, Dict[Tuple[str, int], List[float]]] = {}
+        self._month_totals: Dict[Tuple[str, int], float] = {}
+        self._display_names: Dict[str, str] = {}
+        self.deltas_applied = 0
+        self.last_verify: Optional[Dict[str, Any]] = None
+
+    def is_built(self, brand: str) -> bool:
+        return brand in self._built_brands
+
+    def _add(self, brand: str, contribution, sign: int):
+        month, channel, gmv = contribution
+        norm = normalize_channel(channel)
+        self._display_names.setdefault(norm, channel)
+        months = self._ledger.setdefault(norm, {})
+        entry = months.setdefault((brand, month), [0.0, 0])
+        entry[0] += sign * gmv
+        entry[1] += sign
+        if entry[1] <= 0:
+            del months[(brand, month)]
+            if not months:
+                del self._ledger[norm]
+        self._month_totals[(brand, month)] = self._month_totals.get((brand, month), 0.0) + sign * gmv
+
+    def upsert(self, brand: str, record_id: str, fields: Dict[str, Any]):
+        old = self._records.pop(record_id, None)
+        if old:
+            self._add(old[0], old[1], -1)
+        new = revenue_contribution(brand, fields or {})
+        if new:
+            self._records[record_id] = (brand, new)
+            self._add(brand, new, +1)
+        self.deltas_applied += 1
+
+    def delete(self, record_id: str):
+        old = self._records.pop(record_id, None)
+        if old:
+            self._add(old[0], old[1], -1)
+        self.deltas_applied += 1
+
+    def rebuild(self, brand: str, records: Iterable[Dict]):
+        """Tính lại toàn bộ ledger của 1 brand"""
+        self._records = {rid: v for rid, v in self._records.items() if v[0] != brand}
+        for months in self._ledger.values():
+            for key in [k for k in months if k[0] == brand]:
+                del months[key]
+        self._ledger = {ch: months for ch, months in self._ledger.items() if months}
+        self._month_totals = {k: v for k, v in self._month_totals.items() if k[0] != brand}
+        count = 0
+        for record in records:
+            contribution = revenue_contribution(brand, record.get("fields", {}))
+            if contribution:
+                self._records[record.get("record_id")] = (brand, contribution)
+                self._add(brand, contribution, +1)
+                count += 1
+        self._built_brands[brand] = time.time()
+        print(f"🏆 KOC ranking '{brand}': rebuilt from {count} revenue rows")
+
+    def snapshot(self, brand: str) -> Dict[Tuple[str, int], Tuple[float, int]]:
+        """(kênh, tháng) → (GMV làm tròn, số record) của 1 brand - để so sánh khi verify"""
+        return {
+            (channel, month): (round(gmv, 2), int(count))
+            for channel, months in self._ledger.items()
+            for (b, month), (gmv, count) in months.items() if b == brand
+        }
+
+    # ----- Ledger theo kênh -----
+
+    def find_channels(self, query: str, limit: int = 5) -> List[str]:
+        """Kênh chuẩn hoá khớp query (khớp đúng trước, sau đó chứa chuỗi)"""
+        norm = normalize_channel(query)
+        if not norm:
+            return []
+        if norm in self._ledger:
+            return [norm]
+        return sorted(ch for ch in self._ledger if norm in ch)[:limit]
+
+    def channel_summary(self, channel: str, brand: Optional[str] = None,
+                        start_month: int = 1, end_month: int = 12) -> Optional[Dict[str, Any]]:
+        """
+        GMV của 1 kênh theo tháng trong khoảng [start_month, end_month]
+
+        Returns: tổng GMV, tháng tốt nhất, % đóng góp vào GMV KOC của brand (từng tháng + cả khoảng)
+        """
+        months = self._ledger.get(normalize_channel(channel))
+        if not months:
+            return None
+        rows = []
+        total = 0.0
+        brand_total = 0.0
+        for (b, month), (gmv, count) in sorted(months.items(), key=lambda x: (x[0][1], x[0][0])):
+            if (brand and b != brand.upper()) or not start_month <= month <= end_month:
+                continue
+            month_total = self._month_totals.get((b, month), 0.0)
+            rows.append({
+                "brand": b,
+                "month": month,
+                "gmv": gmv,
+                "videos": int(count),
+                "share": round(gmv / month_total * 100, 1) if month_total else 0,
+            })
+            total += gmv
+            brand_total += month_total
+        if not rows:
+            return None
+        best = max(rows, key=lambda r: r["gmv"])
+        return {
+            "channel": self._display_names.get(normalize_channel(channel), channel),
+            "months": rows,
+            "total_gmv": total,
+            "best_month": best,
+            "share": round(total / brand_total * 100, 1) if brand_total else 0,
+        }
+
+    def rank_range(self, brand: str, start_month: int, end_month: int, n: int = 10) -> List[Tuple[str, float]]:
+        """Top n kênh theo tổng GMV trong khoảng tháng (cộng từ ledger, chọn bằng heap)"""
+        brand = brand.upper()
+        wanted = [(brand, m) for m in range(start_month, end_month + 1)]
+        totals = []
+        for channel, months in self._ledger.items():
+            gmv = sum(months[key][0] for key in wanted if key in months)
+            if gmv:
+                totals.append((gmv, channel))
+        return [(self._display_names.get(ch, ch), gmv) for gmv, ch in heapq.nlargest(n, totals)]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "built": {brand: at for brand, at in self._built_brands.items()},
+            "records": len(self._records),
+            "ledger_channels": len(self._ledger),
+            "deltas_applied": self.deltas_applied,
+            "last_verify": self.last_verify,
+        }
+
+
+_koc_ranking = TopKocIndex()
+
+
+def get_koc_ranking() -> TopKocIndex:
+    return _koc_ranking
+
+
+async def _fetch_revenue_records(table_id: str) -> Tuple[str, List[Dict]]:
+    brand, table, max_records = RANKING_TABLES[table_id]
+    records = await get_all_records(table["app_token"], table["table_id"], max_records=max_records)
+    return brand, records
+
+
+async def ensure_koc_ranking(*brands: str, force_refresh: bool = False) -> TopKocIndex:
+    """
+    Build index lần đầu (lazy) cho các brand chưa có (mặc định: tất cả)
+    force_refresh ("làm mới"): tính lại từ dữ liệu mới nhất kể cả khi đã build
+    """
+    ranking = get_koc_ranking()
+    wanted = {b.upper() for b in brands} or {b for b, _, _ in RANKING_TABLES.values()}
+    for table_id, (brand, _, _) in RANKING_TABLES.items():
+        if brand in wanted and (force_refresh or not ranking.is_built(brand)):
+            ranking.rebuild(brand, (await _fetch_revenue_records(table_id))[1])
+    return ranking
+
+
+async def apply_revenue_change(table_id: str, action: str, record_id: str):
+    """
+    Áp dụng thay đổi 1 record doanh thu KOC (webhook table-changed)
+    Luôn đọc lại record từ Lark: webhook chỉ gửi field vừa đổi sẽ làm mất kênh khỏi ledger
+    """
+    brand, table, _ = RANKING_TABLES[table_id]
+    ranking = get_koc_ranking()
+    if not ranking.is_built(brand):
+        return  # Lần build đầu (lazy) sẽ đọc dữ liệu mới nhất
+
+    record = await get_record(table["app_token"], table["table_id"], record_id)
+    if record is not None:
+        ranking.upsert(brand, record_id, record.get("fields", {}))
+    elif action == "delete":
+        ranking.delete(record_id)
+    else:
+        # Không đọc được record (lỗi Lark) → bỏ qua, lượt verify sẽ sửa
+        print(f"⚠️ Revenue record {record_id} not readable, skipping KOC ranking delta")
+
+
+async def verify_koc_ranking() -> Dict[str, int]:
+    """Scheduler job: tính lại các brand đã build, đếm số (kênh, tháng) bị lệch"""
+    ranking = get_koc_ranking()
+    drifted = {}
+    for table_id, (brand, _, _) in RANKING_TABLES.items():
+        if not ranking.is_built(brand):
+            continue
+        before = ranking.snapshot(brand)
+        ranking.rebuild(brand, (await _fetch_revenue_records(table_id))[1])
+        after = ranking.snapshot(brand)
+        drifted[brand] = sum(1 for key in set(before) | set(after) if before.get(key) != after.get(key))
+        if drifted[brand]:
+            print(f"⚠️ KOC ranking '{brand}': {drifted[brand]} channel-months drifted, replaced with full recompute")
+    ranking.last_verify = {"at": time.time(), "drifted_entries": drifted}
+    return drifted
@@ -0,0 +1,240 @@
+"""
+KPI History Module
+Lưu lịch sử KPI / GMV theo tháng, nhân sự, brand vào SQLite cục bộ
+Version 5.9.0
+
+- Bảng Dashboard Tháng chỉ có "Tháng báo cáo" (không có năm) → Lark chỉ trả lời được 1 tháng
+- Mỗi khi chốt tháng (đầu tháng sau) lưu lại số liệu tháng đó → truy vấn xu hướng
+  nhiều tháng / nhiều năm đọc từ store, không gọi Lark
+- Tháng hiện tại được cập nhật (chưa chốt) mỗi lần tính summary cả tháng
+"""
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import pytz
+
+from local_store import get_connection
+
+VN_TZ = pytz.timezone("Asia/Ho_Chi_Minh")
+
+# Dòng tổng của brand lưu với nhan_su = TEAM_KEY
+TEAM_KEY = ""
+
+HISTORY_BRANDS = ("KALLE", "CHENG")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS kpi_monthly (
+    brand TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    nhan_su TEXT NOT NULL,
+    kpi_so_luong INTEGER DEFAULT 0,
+    so_luong_air INTEGER DEFAULT 0,
+    kpi_ngan_sach INTEGER DEFAULT 0,
+    ngan_sach_air INTEGER DEFAULT 0,
+    gmv REAL DEFAULT 0,
+    closed INTEGER DEFAULT 0,
+    updated_at REAL,
+    PRIMARY KEY (brand, year, month, nhan_su)
+)
+"""
+
+
+def _db():
+    conn = get_connection("kpi_history")
+    conn.execute(_SCHEMA)
+    return conn
+
+
+def _pct(done, kpi) -> float:
+    return round(done / kpi * 100, 1) if kpi else 0
+
+
+def record_summary(brand: str, year: int, month: int, summary: Dict[str, Any], closed: bool = False) -> int:
+    """
+    Lưu số liệu 1 tháng từ summary (generate_dashboard_summary / generate_cheng_koc_summary)
+    Tháng đã chốt (closed) không bị ghi đè bởi snapshot chưa chốt
+    """
+    if not summary or not month:
+        return 0
+
+    brand = brand.upper()
+    now = time.time()
+    tong_quan = summary.get("tong_quan", {})
+    rows = [(
+        brand, year, month, TEAM_KEY,
+        int(tong_quan.get("kpi_so_luong") or 0), int(tong_quan.get("so_luong_air") or 0),
+        int(tong_quan.get("kpi_ngan_sach") or 0), int(tong_quan.get("ngan_sach_air") or 0),
+        float(tong_quan.get("total_gmv") or 0), int(closed), now,
+    )]
+    for nhan_su, data in (summary.get("kpi_nhan_su") or {}).items():
+        if not nhan_su:
+            continue
+        rows.append((
+            brand, year, month, nhan_su.strip(),
+            int(data.get("kpi_so_luong") or 0), int(data.get("so_luong_air") or 0),
+            int(data.get("kpi_ngan_sach") or 0), int(data.get("ngan_sach_air") or 0),
+            0, int(closed), now,
+        ))
+
+    conn = _db()
+    with conn:
+        if not closed:
+            already_closed = conn.execute(
+                "SELECT 1 FROM kpi_monthly WHERE brand=? AND year=? AND month=? AND closed=1 LIMIT 1",
+                (brand, year, month)
+            ).fetchone()
+            if already_closed:
+                return 0
+        conn.execute("DELETE FROM kpi_monthly WHERE brand=? AND year=? AND month=?", (brand, year, month))
+        conn.executemany(
+            "INSERT INTO kpi_monthly (brand, year, month, nhan_su, kpi_so_luong, so_luong_air, "
+            "kpi_ngan_sach, ngan_sach_air, gmv, closed, updated_at) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+            rows
+        )
+    return len(rows)
+
+
+def record_current_month(brand: str, month: Optional[int], week: Any, summary: Dict[str, Any]):
+    """Hook cho summary cả tháng: chỉ lưu khi là tháng hiện tại (biết chắc năm)"""
+    now = datetime.now(VN_TZ)
+    if week or month != now.month:
+        return
+    try:
+        record_summary(brand, now.year, month, summary, closed=False)
+    except Exception as e:
+        print(f"⚠️ KPI history snapshot failed: {e}")
+
+
+def _month_range(end_year: int, end_month: int, months: int) -> List[Tuple[int, int]]:
+    """Danh sách (năm, tháng) gồm `months` tháng kết thúc ở end_month/end_year"""
+    result = []
+    y, m = end_year, end_month
+    for _ in range(max(1, months)):
+        result.append((y, m))
+        m -= 1
+        if m == 0:
+            y, m = y - 1, 12
+    return list(reversed(result))
+
+
+def _match_staff(name: str, query: str) -> bool:
+    name, query = name.lower(), query.lower()
+    return name == query or query in name or name in query
+
+
+def get_kpi_trend(
+    brand: str = "KALLE",
+    months: int = 6,
+    end_year: Optional[int] = None,
+    end_month: Optional[int] = None,
+    nhan_su: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Xu hướng KPI theo tháng từ store (không gọi Lark)
+
+    nhan_su=None → số liệu tổng của brand
+    """
+    now = datetime.now(VN_TZ)
+    end_year = end_year or now.year
+    end_month = end_month or now.month
+    periods = _month_range(end_year, end_month, months)
+    brand = brand.upper()
+
+    (start_year, start_month), _ = periods[0], periods[-1]
+    rows = _db().execute(
+        "SELECT * FROM kpi_monthly WHERE brand=? AND (year*100+month) BETWEEN ? AND ?",
+        (brand, start_year * 100 + start_month, end_year * 100 + end_month)
+    ).fetchall()
+
+    by_period: Dict[Tuple[int, int], Dict[str, Any]] = {}
+    matched_name = None
+    for row in rows:
+        if nhan_su:
+            if row["nhan_su"] == TEAM_KEY or not _match_staff(row["nhan_su"], nhan_su):
+                continue
+            matched_name = matched_name or row["nhan_su"]
+        elif row["nhan_su"] != TEAM_KEY:
+            continue
+        bucket = by_period.setdefault((row["year"], row["month"]), {
+            "kpi_so_luong": 0, "so_luong_air": 0, "kpi_ngan_sach": 0, "ngan_sach_air": 0,
+            "gmv": 0, "closed": True,
+        })
+        for field in ("kpi_so_luong", "so_luong_air", "kpi_ngan_sach", "ngan_sach_air", "gmv"):
+            bucket[field] += row[field] or 0
+        bucket["closed"] = bucket["closed"] and bool(row["closed"])
+
+    result_periods = []
+    missing = []
+    for year, month in periods:
+        data = by_period.get((year, month))
+        if data is None:
+            missing.append((year, month))
+            continue
+        data.update({
+            "year": year,
+            "month": month,
+            "pct_kpi_so_luong": _pct(data["so_luong_air"], data["kpi_so_luong"]),
+            "pct_kpi_ngan_sach": _pct(data["ngan_sach_air"], data["kpi_ngan_sach"]),
+        })
+        result_periods.append(data)
+
+    return {
+        "brand": brand,
+        "nhan_su": matched_name or nhan_su,
+        "months": months,
+        "start": periods[0],
+        "end": periods[-1],
+        "periods": result_periods,
+        "missing": missing,
+    }
+
+
+def latest_year_of_month(month: int, now: Optional[datetime] = None) -> int:
+    """Năm của lần gần nhất có tháng `month` (tháng chưa tới trong năm nay → năm trước)"""
+    now = now or datetime.now(VN_TZ)
+    return now.year if month <= now.month else now.year - 1
+
+
+async def close_month(year: int, month: int) -> Dict[str, int]:
+    """
+    Chốt số liệu 1 tháng cho các brand (lấy dữ liệu mới từ Lark)
+
+    Bảng Dashboard không có cột năm, getter chỉ lọc theo tháng → chỉ chốt được
+    lần gần nhất của tháng đó (tháng 12 chốt vào tháng 1 là năm trước); năm khác bị từ chối
+    """
+    from summaries import BRAND_SUMMARIES
+
+    expected_year = latest_year_of_month(month)
+    if year != expected_year:
+        raise ValueError(f"Chỉ chốt được tháng {month}/{expected_year} (Dashboard không lọc theo năm)")
+
+    saved = {}
+    for brand in HISTORY_BRANDS:
+        getter = BRAND_SUMMARIES.get(brand)
+        if getter is None:
+            continue
+        try:
+            summary = await getter(month=month, week=None, force_refresh=True)
+            saved[brand] = record_summary(brand, year, month, summary, closed=True)
+            print(f"📚 KPI history: closed {brand} {month}/{year} ({saved[brand]} rows)")
+        except Exception as e:
+            print(f"❌ KPI history close {brand} {month}/{year} failed: {e}")
+            saved[brand] = 0
+    return saved
+
+
+async def close_previous_month() -> Dict[str, int]:
+    """Scheduler job (đầu tháng): chốt số liệu tháng trước"""
+    now = datetime.now(VN_TZ)
+    year, month = (now.year, now.month - 1) if now.month > 1 else (now.year - 1, 12)
+    return await close_month(year, month)
+
+
+def get_history_stats() -> Dict[str, Any]:
+    rows = _db().execute(
+        "SELECT brand, COUNT(DISTINCT year*100+month) AS months, MIN(year*100+month) AS first, "
+        "MAX(year*100+month) AS last, SUM(closed) AS closed_rows FROM kpi_monthly GROUP BY brand"
+    ).fetchall()
+    return {row["brand"]: dict(row) for row in rows}
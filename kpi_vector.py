@@ -0,0 +1,147 @@
+"""
+KPI Vector Module
+Tính bảng KPI nhân sự / team dạng vector
+Version 5.9.0
+
+Input: danh sách nhân sự với video_kpi, video_done, budget_kpi, budget_done
+Output (cho từng nhân sự): % video, % ngân sách, tiến độ, còn thiếu, hạng,
+trạng thái, icon, cảnh báo + tổng team.
+
+Dùng NumPy nếu có cài, không thì tính bằng Python thuần (kết quả giống nhau).
+"""
+from typing import Any, Dict, List, Tuple
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:  # pragma: no cover - numpy là optional
+    np = None
+    HAS_NUMPY = False
+
+# Tiến độ (TB % video + % ngân sách) dưới ngưỡng này → cảnh báo (chỉ nhân sự có KPI)
+CANH_BAO_PERCENT = 50
+
+MEASURES = ("video_kpi", "video_done", "budget_kpi", "budget_done")
+
+
+def status_text(progress: float) -> str:
+    """Trạng thái theo tiến độ (TB % video và % ngân sách)"""
+    if progress >= 100:
+        return "🟢 Đạt"
+    if progress >= 80:
+        return "🟢 Gần đạt"
+    if progress >= 50:
+        return "🟡 Đang tiến hành"
+    return "🔴 Cần cố gắng"
+
+
+def status_icon(video_percent: float) -> str:
+    """Icon theo % video"""
+    if video_percent >= 100:
+        return "🟢"
+    if video_percent >= 80:
+        return "🟡"
+    return "🔴"
+
+
+def _pct(done: float, kpi: float) -> float:
+    return round(done / kpi * 100, 1) if kpi > 0 else 0
+
+
+def _progress(video_percent: float, budget_percent: float) -> float:
+    # Tính theo phần mười (số nguyên) để NumPy và Python thuần làm tròn giống nhau
+    tenths = round(video_percent * 10) + round(budget_percent * 10)
+    return ((tenths + 1) // 2) / 10
+
+
+def _compute_numpy(values: Dict[str, List[float]]) -> Dict[str, List[Any]]:
+    video_kpi = np.asarray(values["video_kpi"], dtype=float)
+    video_done = np.asarray(values["video_done"], dtype=float)
+    budget_kpi = np.asarray(values["budget_kpi"], dtype=float)
+    budget_done = np.asarray(values["budget_done"], dtype=float)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        video_percent = np.where(video_kpi > 0, np.round(video_done / video_kpi * 100, 1), 0.0)
+        budget_percent = np.where(budget_kpi > 0, np.round(budget_done / budget_kpi * 100, 1), 0.0)
+    tenths = np.rint(video_percent * 10).astype(np.int64) + np.rint(budget_percent * 10).astype(np.int64)
+    progress = ((tenths + 1) // 2) / 10
+
+    # Hạng theo video đã air (giảm dần), cùng số thì giữ thứ tự ban đầu
+    order = np.argsort(-video_done, kind="stable")
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = np.arange(1, len(order) + 1)
+
+    return {
+        "video_percent": video_percent.tolist(),
+        "budget_percent": budget_percent.tolist(),
+        "progress": progress.tolist(),
+        "video_remaining": np.maximum(video_kpi - video_done, 0).astype(int).tolist(),
+        "budget_remaining": np.maximum(budget_kpi - budget_done, 0).astype(int).tolist(),
+        "rank": rank.tolist(),
+        "canh_bao": ((progress < CANH_BAO_PERCENT) & ((video_kpi > 0) | (budget_kpi > 0))).tolist(),
+    }
+
+
+def _compute_python(values: Dict[str, List[float]]) -> Dict[str, List[Any]]:
+    n = len(values["video_kpi"])
+    video_percent = [_pct(values["video_done"][i], values["video_kpi"][i]) for i in range(n)]
+    budget_percent = [_pct(values["budget_done"][i], values["budget_kpi"][i]) for i in range(n)]
+    progress = [_progress(video_percent[i], budget_percent[i]) for i in range(n)]
+
+    order = sorted(range(n), key=lambda i: -values["video_done"][i])
+    rank = [0] * n
+    for position, i in enumerate(order, 1):
+        rank[i] = position
+
+    return {
+        "video_percent": video_percent,
+        "budget_percent": budget_percent,
+        "progress": progress,
+        "video_remaining": [int(max(values["video_kpi"][i] - values["video_done"][i], 0)) for i in range(n)],
+        "budget_remaining": [int(max(values["budget_kpi"][i] - values["budget_done"][i], 0)) for i in range(n)],
+        "rank": rank,
+        "canh_bao": [
+            progress[i] < CANH_BAO_PERCENT and (values["video_kpi"][i] > 0 or values["budget_kpi"][i] > 0)
+            for i in range(n)
+        ],
+    }
+
+
+def _number(value) -> float:
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def compute_kpi_table(staff_list: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Tính toàn bộ chỉ số KPI cho danh sách nhân sự
+
+    Returns:
+        (staff_list đã bổ sung chỉ số và sort theo hạng, totals của team)
+    """
+    values = {m: [_number(s.get(m)) for s in staff_list] for m in MEASURES}
+
+    computed = _compute_numpy(values) if HAS_NUMPY and staff_list else _compute_python(values)
+
+    rows = []
+    for i, staff in enumerate(staff_list):
+        row = dict(staff)
+        for field, column in computed.items():
+            row[field] = column[i]
+        row["status"] = status_text(row["progress"])
+        row["icon"] = status_icon(row["video_percent"])
+        rows.append(row)
+    rows.sort(key=lambda r: r["rank"])
+
+    totals = {m: int(sum(values[m])) for m in MEASURES}
+    totals["video_percent"] = _pct(totals["video_done"], totals["video_kpi"])
+    totals["budget_percent"] = _pct(totals["budget_done"], totals["budget_kpi"])
+    totals["progress"] = _progress(totals["video_percent"], totals["budget_percent"])
+    totals["video_remaining"] = max(totals["video_kpi"] - totals["video_done"], 0)
+    totals["budget_remaining"] = max(totals["budget_kpi"] - totals["budget_done"], 0)
+    totals["status"] = status_text(totals["progress"])
+    totals["canh_bao_count"] = sum(1 for r in rows if r["canh_bao"])
+
+    return rows, totals
@@ -5,12 +5,21 @@ Version 5.7.20 - Fix content matching between Dashboard and Booking names
 """
 import os
 import re
+import json
+import heapq
+import asyncio
 import logging
 import httpx
 import aiohttp
 import pytz
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 from datetime import datetime, timedelta
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from kpi_vector import compute_kpi_table
+from report_details import store_details, register_detail_loader
+from vn_day import day_to_ymd, parse_vn_day
 
 # Vietnam timezone
 VN_TZ = pytz.timezone('Asia/Ho_Chi_Minh')
@@ -103,6 +112,23 @@ NOTES_TABLE = {
 # === CALENDAR CONFIG ===
 JARVIS_CALENDAR_ID = "7585485663517069021"
 
+# === TABLE DEPENDENCIES (v5.9.0) ===
+# Các bảng mà mỗi loại báo cáo đọc - dùng để invalidate report cache khi bảng thay đổi
+KALLE_KOC_TABLE_IDS = [BOOKING_BASE["table_id"]]
+KALLE_DASHBOARD_TABLE_IDS = [
+    DASHBOARD_THANG_TABLE["table_id"],
+    BOOKING_BASE["table_id"],
+    DOANH_THU_KOC_TABLE["table_id"],
+    LIEN_HE_TUAN_TABLE["table_id"],
+]
+CHENG_REPORT_TABLE_IDS = [
+    CHENG_DASHBOARD_THANG_TABLE["table_id"],
+    CHENG_LIEN_HE_TABLE["table_id"],
+    CHENG_DOANH_THU_KOC_TABLE["table_id"],
+    CHENG_DOANH_THU_TONG_TABLE["table_id"],
+]
+TASK_TABLE_IDS = [TASK_BASE["table_id"]]
+
 
 async def create_calendar_event(
     summary: str,
@@ -202,6 +228,12 @@ async def get_tenant_access_token() -> str:
         else:
             raise Exception(f"Failed to get token: {data}")
 
+
+def invalidate_tenant_access_token():
+    """Bỏ token đang cache (Lark báo token không hợp lệ) → lần gọi sau lấy token mới"""
+    _token_cache["token"] = None
+    _token_cache["expires_at"] = None
+
 # ============ BASE API ============
 async def get_table_records(
     app_token: str,
@@ -282,6 +314,26 @@ async def get_table_records(
     
     raise Exception(f"Lark Base API Error after {max_retries} retries")
 
+# v5.9.0: Trong 1 lượt batch (shared_fetches), cùng 1 truy vấn chỉ gọi Lark 1 lần
+_fetch_memo: ContextVar[Optional[Dict[Tuple, "asyncio.Future"]]] = ContextVar("_fetch_memo", default=None)
+
+
+@contextmanager
+def shared_fetches():
+    """
+    Các get_all_records giống nhau (bảng, filter, sort) trong khối này dùng chung 1 lần fetch
+    - kể cả khi chạy song song; lần fetch max_records lớn hơn phục vụ luôn lần nhỏ hơn
+    """
+    if _fetch_memo.get() is not None:
+        yield  # Đã ở trong 1 lượt batch → dùng chung memo bên ngoài
+        return
+    token = _fetch_memo.set({})
+    try:
+        yield
+    finally:
+        _fetch_memo.reset(token)
+
+
 async def get_all_records(
     app_token: str,
     table_id: str,
@@ -290,6 +342,36 @@ async def get_all_records(
     sort: Optional[List[Dict]] = None
 ) -> List[Dict[str, Any]]:
     """Lấy tất cả records (với pagination)"""
+    memo = _fetch_memo.get()
+    if memo is None:
+        return await _fetch_all_records(app_token, table_id, filter_formula, max_records, sort)
+
+    query = (app_token, table_id, filter_formula, json.dumps(sort, sort_keys=True) if sort else None)
+    key, future = next(
+        ((k, f) for k, f in memo.items() if k[0] == query and k[1] >= max_records), (None, None)
+    )
+    if future is None:
+        key = (query, max_records)
+        future = asyncio.ensure_future(_fetch_all_records(app_token, table_id, filter_formula, max_records, sort))
+        memo[key] = future
+    else:
+        print(f"♻️ Shared fetch: {table_id}")
+    try:
+        records = await asyncio.shield(future)
+    except Exception:
+        if memo.get(key) is future:
+            del memo[key]  # Lỗi không được nhớ lại → lần sau fetch lại
+        raise
+    return records[:max_records]
+
+
+async def _fetch_all_records(
+    app_token: str,
+    table_id: str,
+    filter_formula: Optional[str],
+    max_records: int,
+    sort: Optional[List[Dict]]
+) -> List[Dict[str, Any]]:
     all_records = []
     page_token = None
     
@@ -387,6 +469,27 @@ async def delete_record(app_token: str, table_id: str, record_id: str) -> Dict:
         return {"deleted": True, "record_id": record_id}
 
 
+async def get_record(app_token: str, table_id: str, record_id: str) -> Optional[Dict]:
+    """Lấy 1 record theo record_id (None nếu không tồn tại / đã bị xoá)"""
+    token = await get_tenant_access_token()
+
+    url = f"{LARK_API_BASE}/bitable/v1/apps/{app_token}/tables/{table_id}/records/{record_id}"
+
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        response = await client.get(
+            url,
+            headers={"Authorization": f"Bearer {token}"}
+        )
+
+        data = response.json()
+
+        if data.get("code") != 0:
+            print(f"❌ Get record error: {data}")
+            return None
+
+        return data.get("data", {}).get("record")
+
+
 # ============ HELPER FUNCTIONS ============
 def safe_extract_text(value):
     """Extract text value from Lark field (handles list, dict, string)"""
@@ -1112,8 +1215,8 @@ async def generate_cheng_koc_summary(month: int = None, week: int = None) -> Dic
                 koc_gmv[id_kenh] = 0
             koc_gmv[id_kenh] += r.get("gmv") or 0
     
-    # Sort by GMV
-    top_koc = sorted(koc_gmv.items(), key=lambda x: x[1], reverse=True)[:10]
+    # v5.9.0: Top 10 bằng heap trên chính các dòng doanh thu vừa lấy (khớp total_gmv), không sort toàn bộ
+    top_koc = heapq.nlargest(10, koc_gmv.items(), key=lambda x: x[1])
     
     # === TÍNH GMV TỪ BẢNG DOANH THU TỔNG (chính xác) ===
     total_gmv = sum(r.get("gmv", 0) for r in doanh_thu_tong_records)
@@ -1192,7 +1295,7 @@ async def generate_cheng_koc_summary(month: int = None, week: int = None) -> Dic
 async def get_booking_records(
     month: Optional[int] = None,
     week: Optional[int] = None,
-    year: int = 2025
+    year: Optional[int] = None
 ) -> List[Dict[str, Any]]:
     """Lấy records từ bảng Booking/KOC KALLE"""
     records = await get_all_records(
@@ -1491,6 +1594,10 @@ async def generate_koc_summary(
     missing_link_kocs = []
     missing_gio_kocs = []
     
+    # v5.9.0: Danh sách KOC chi tiết không nằm trong summary - lưu riêng (lazy drill-down)
+    kocs_by_product = {}
+    kocs_by_brand = {}
+    
     def safe_string(value):
         if value is None:
             return "Không xác định"
@@ -1531,11 +1638,11 @@ async def generate_koc_summary(
             phan_loai = san_pham
         
         if san_pham not in by_product:
-            by_product[san_pham] = {"count": 0, "chi_phi": 0, "da_air": 0, "chua_air": 0, "kocs": []}
+            by_product[san_pham] = {"count": 0, "chi_phi": 0, "da_air": 0, "chua_air": 0}
         by_product[san_pham]["count"] += 1
         
         if phan_loai not in by_brand:
-            by_brand[phan_loai] = {"count": 0, "chi_phi": 0, "da_air": 0, "chua_air": 0, "kocs": []}
+            by_brand[phan_loai] = {"count": 0, "chi_phi": 0, "da_air": 0, "chua_air": 0}
         by_brand[phan_loai]["count"] += 1
         
         if da_deal:
@@ -1560,8 +1667,8 @@ async def generate_koc_summary(
             "trang_thai_gio": koc.get("trang_thai_gan_gio"),
             "chi_phi": da_deal
         }
-        by_product[san_pham]["kocs"].append(koc_info)
-        by_brand[phan_loai]["kocs"].append(koc_info)
+        kocs_by_product.setdefault(san_pham, []).append(koc_info)
+        kocs_by_brand.setdefault(phan_loai, []).append(koc_info)
         
         if has_aired:
             da_air += 1
@@ -1589,6 +1696,13 @@ async def generate_koc_summary(
     by_group = by_brand if group_by == "brand" else by_product
     group_label = "phân loại sản phẩm" if group_by == "brand" else "sản phẩm"
     
+    detail = store_details(
+        "kalle_koc",
+        {"records": records, "kocs_by_product": kocs_by_product, "kocs_by_brand": kocs_by_brand},
+        tables=KALLE_KOC_TABLE_IDS,
+        month=month, week=week, group_by=group_by, product_filter=product_filter,
+    )
+    
     return {
         "month": month,
         "week": week,
@@ -1608,7 +1722,7 @@ async def generate_koc_summary(
         "by_brand": by_brand,
         "missing_link_kocs": missing_link_kocs[:10],
         "missing_gio_kocs": missing_gio_kocs[:10],
-        "all_records": records
+        "detail": detail,
     }
 
 
@@ -1649,6 +1763,14 @@ async def generate_content_calendar(
         if overdue_field:
             overdue.append(task)
     
+    # v5.9.0: Summary chỉ giữ số lượng; task chi tiết lưu riêng (lazy drill-down)
+    detail = store_details(
+        "content_calendar",
+        {"records": records, "by_date": by_date, "by_vi_tri": by_vi_tri, "overdue_tasks": overdue},
+        tables=TASK_TABLE_IDS,
+        start_date=start_date, end_date=end_date, month=month, team=team, vi_tri=vi_tri,
+    )
+    
     return {
         "date_range": date_range,
         "month": month,
@@ -1660,10 +1782,10 @@ async def generate_content_calendar(
             "days_with_content": len(by_date),
             "vi_tri_count": len(by_vi_tri)
         },
-        "by_date": by_date,
-        "by_vi_tri": by_vi_tri,
-        "overdue_tasks": overdue,
-        "all_records": records
+        "by_date": {date_key: len(tasks) for date_key, tasks in by_date.items()},
+        "by_vi_tri": {vi_tri_key: len(tasks) for vi_tri_key, tasks in by_vi_tri.items()},
+        "overdue_tasks": overdue[:20],
+        "detail": detail,
     }
 
 
@@ -1941,24 +2063,9 @@ async def generate_dashboard_summary(month: Optional[int] = None, week: Optional
         if not link_air:
             continue
         
-        thoi_gian_air = fields.get("Thời gian air") or fields.get("thoi_gian_air")
-        thang_air = None
-        
-        if thoi_gian_air:
-            try:
-                if isinstance(thoi_gian_air, (int, float)):
-                    dt = datetime.fromtimestamp(thoi_gian_air / 1000, VN_TZ)
-                    thang_air = dt.month
-                elif isinstance(thoi_gian_air, str):
-                    for fmt in ["%Y-%m-%d", "%d/%m/%Y", "%Y/%m/%d"]:
-                        try:
-                            dt = datetime.strptime(thoi_gian_air[:10], fmt)
-                            thang_air = dt.month
-                            break
-                        except:
-                            continue
-            except:
-                pass
+        # v5.9.0: decode thẳng ra số ngày giờ VN (không tạo datetime cho mỗi record)
+        air_day = parse_vn_day(fields.get("Thời gian air") or fields.get("thoi_gian_air"))
+        thang_air = day_to_ymd(air_day)[1] if air_day is not None else None
         
         if thang_air is None:
             thang_du_kien_raw = fields.get("Tháng dự kiến") or fields.get("Tháng dự kiến air")
@@ -2048,7 +2155,8 @@ async def generate_dashboard_summary(month: Optional[int] = None, week: Optional
                 koc_gmv[id_kenh] = 0
             koc_gmv[id_kenh] += r["gmv"]
     
-    top_koc = sorted(koc_gmv.items(), key=lambda x: x[1], reverse=True)[:10]
+    # v5.9.0: Top 10 bằng heap trên chính các dòng doanh thu vừa lấy (khớp total_gmv), không sort toàn bộ
+    top_koc = heapq.nlargest(10, koc_gmv.items(), key=lambda x: x[1])
     
     # Tổng hợp liên hệ theo nhân sự
     lien_he_by_nhan_su = {}
@@ -2224,25 +2332,14 @@ async def generate_dashboard_summary(month: Optional[int] = None, week: Optional
         if content_breakdown.get("total", 0) > 0:
             print(f"   📦 {nhan_su_name}: content_total={content_breakdown.get('total', 0)}, items={len(content_items)}")
         
-        # Calculate percentages
-        video_kpi = kpi_data.get("kpi_so_luong", 0)
-        video_done = kpi_data.get("so_luong_air", 0)
-        budget_kpi = kpi_data.get("kpi_ngan_sach", 0)
-        budget_done = kpi_data.get("ngan_sach_air", 0)
-        
-        video_percent = round(video_done / video_kpi * 100, 1) if video_kpi > 0 else 0
-        budget_percent = round(budget_done / budget_kpi * 100, 1) if budget_kpi > 0 else 0
-        
         staff_list.append({
             "name": nhan_su_name,
             # Video KPI
-            "video_kpi": video_kpi,
-            "video_done": video_done,
-            "video_percent": video_percent,
+            "video_kpi": kpi_data.get("kpi_so_luong", 0),
+            "video_done": kpi_data.get("so_luong_air", 0),
             # Budget KPI
-            "budget_kpi": budget_kpi,
-            "budget_done": budget_done,
-            "budget_percent": budget_percent,
+            "budget_kpi": kpi_data.get("kpi_ngan_sach", 0),
+            "budget_done": kpi_data.get("ngan_sach_air", 0),
             # Contact info
             "contact_total": contact_info.get("tong_lien_he", 0),
             "contact_deal": contact_info.get("da_deal", 0),
@@ -2251,8 +2348,8 @@ async def generate_dashboard_summary(month: Optional[int] = None, week: Optional
             "content_breakdown": content_breakdown,
         })
     
-    # Sort by video_done descending
-    staff_list.sort(key=lambda x: x.get("video_done", 0), reverse=True)
+    # v5.9.0: %, tiến độ, còn thiếu, hạng, cảnh báo + tổng team tính 1 lần (sort theo video_done giảm dần)
+    staff_list, team_totals = compute_kpi_table(staff_list)
     
     print(f"📊 Staff list created: {len(staff_list)} items")
     for s in staff_list[:3]:
@@ -2265,12 +2362,7 @@ async def generate_dashboard_summary(month: Optional[int] = None, week: Optional
         # New format for report_generator (v5.7.16)
         "staff_list": staff_list,
         "totals": {
-            "video_kpi": total_kpi_so_luong,
-            "video_done": total_so_luong_air,
-            "video_percent": round(total_so_luong_air / total_kpi_so_luong * 100, 1) if total_kpi_so_luong > 0 else 0,
-            "budget_kpi": total_kpi_ngan_sach,
-            "budget_done": total_ngan_sach_air,
-            "budget_percent": round(total_ngan_sach_air / total_kpi_ngan_sach * 100, 1) if total_kpi_ngan_sach > 0 else 0,
+            **team_totals,
             "total_gmv": total_gmv,
         },
         # Keep old format for backward compatibility
@@ -2286,7 +2378,13 @@ async def generate_dashboard_summary(month: Optional[int] = None, week: Optional
         "kpi_nhan_su": kpi_by_nhan_su,
         "top_koc": top_koc,
         "lien_he_nhan_su": lien_he_by_nhan_su,
-        "content_by_nhan_su": content_by_nhan_su,
+        # v5.9.0: content chi tiết theo sản phẩm lưu riêng (content_breakdown đã nằm trong staff_list)
+        "detail": store_details(
+            "kalle_dashboard",
+            {"content_by_nhan_su": content_by_nhan_su},
+            tables=KALLE_DASHBOARD_TABLE_IDS,
+            month=month, week=week,
+        ),
     }
 
 
@@ -2622,3 +2720,9 @@ async def debug_notes_table():
             result["sample_records"].append(sample)
     
     return result
+
+
+# v5.9.0: Hàm tính lại details khi handle đã hết hạn trong cache
+register_detail_loader("kalle_koc", generate_koc_summary)
+register_detail_loader("content_calendar", generate_content_calendar)
+register_detail_loader("kalle_dashboard", generate_dashboard_summary)
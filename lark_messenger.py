@@ -0,0 +1,291 @@
+"""
+Lark Messenger Module
+Gửi tin nhắn Lark song song có giới hạn (fan-out) + retry + thống kê mỗi lượt gửi
+Version 5.9.0
+
+- Dùng chung 1 tenant token (cache trong lark_base) và 1 HTTP client cho cả lượt gửi
+- Tối đa MESSAGE_FANOUT_CONCURRENCY tin gửi cùng lúc → cả lượt ≈ thời gian 1 tin
+- Lỗi mạng / 429 / 5xx / rate limit / token hết hạn → retry với backoff (có jitter)
+- Trả về tổng kết: ai đã nhận, ai lỗi, mỗi tin mất bao lâu, message_id của từng người nhận
+- Mọi request IM đi qua 1 token bucket chung (MESSAGE_RATE_LIMIT_PER_SEC)
+- broadcast_to_chats: render 1 lần, gửi tới nhiều group song song, báo cáo latency + message_id từng nhóm
+"""
+import asyncio
+import json
+import os
+import random
+import time
+from dataclasses import dataclass, asdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+
+from lark_base import LARK_API_BASE, get_tenant_access_token, invalidate_tenant_access_token
+
+# ============ CONFIG ============
+MESSAGE_FANOUT_CONCURRENCY = int(os.getenv("MESSAGE_FANOUT_CONCURRENCY", "8"))
+MESSAGE_SEND_RETRIES = int(os.getenv("MESSAGE_SEND_RETRIES", "3"))
+MESSAGE_RETRY_BASE_DELAY = float(os.getenv("MESSAGE_RETRY_BASE_DELAY", "0.5"))
+MESSAGE_SEND_TIMEOUT = float(os.getenv("MESSAGE_SEND_TIMEOUT", "15"))
+
+# Giới hạn request IM của app (Lark: 50 req/s mỗi app) - token bucket dùng chung mọi lượt gửi
+MESSAGE_RATE_LIMIT_PER_SEC = float(os.getenv("MESSAGE_RATE_LIMIT_PER_SEC", "20"))
+
+# Lark code: rate limit / token không hợp lệ → nên thử lại
+RATE_LIMIT_CODES = {99991400}
+TOKEN_INVALID_CODES = {99991661, 99991663, 99991668}
+
+
+@dataclass
+class OutgoingMessage:
+    """1 tin cần gửi"""
+    receive_id: str
+    text: str
+    receive_id_type: str = "user_id"
+    label: str = ""
+
+
+@dataclass
+class SendResult:
+    receive_id: str
+    label: str
+    ok: bool
+    attempts: int
+    elapsed_ms: float
+    error: Optional[str] = None
+    message_id: Optional[str] = None
+
+
+class RateLimiter:
+    """Token bucket: tối đa `rate` request/giây, cho phép burst tới `burst` request"""
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self.waited_ms = 0.0
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+                self.waited_ms += wait * 1000
+                await asyncio.sleep(wait)
+
+
+_rate_limiter = RateLimiter(MESSAGE_RATE_LIMIT_PER_SEC)
+
+
+def text_payload(receive_id: str, text: str) -> Dict[str, Any]:
+    return {"receive_id": receive_id, "msg_type": "text", "content": json.dumps({"text": text})}
+
+
+async def _post_json(client: httpx.AsyncClient, url: str, body: Dict[str, Any],
+                     params: Optional[Dict[str, str]] = None, method: str = "POST") -> Dict[str, Any]:
+    await _rate_limiter.acquire()
+    token = await get_tenant_access_token()
+    response = await client.request(
+        method,
+        url,
+        params=params,
+        headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+        json=body,
+    )
+    if response.status_code == 429 or response.status_code >= 500:
+        raise httpx.HTTPStatusError(f"HTTP {response.status_code}", request=response.request, response=response)
+    return response.json()
+
+
+async def _call_with_retry(call: Callable[[], Awaitable[Dict[str, Any]]],
+                           retries: int) -> Tuple[Optional[Dict[str, Any]], int, Optional[str]]:
+    """
+    Gọi API Lark, retry lỗi tạm thời với backoff luỹ thừa
+
+    Returns:
+        (response thành công hoặc None, số lần gọi, lỗi cuối)
+    """
+    error = None
+    attempt = 0
+    for attempt in range(1, retries + 2):
+        try:
+            result = await call()
+            code = result.get("code")
+            if code == 0:
+                return result, attempt, None
+            error = f"code={code} {result.get('msg', '')}".strip()
+            if code in TOKEN_INVALID_CODES:
+                invalidate_tenant_access_token()
+            elif code not in RATE_LIMIT_CODES:
+                break  # Lỗi cố định (sai id, không có quyền...) → không retry
+        except (httpx.HTTPError, ValueError) as e:
+            error = str(e) or type(e).__name__
+
+        if attempt <= retries:
+            delay = MESSAGE_RETRY_BASE_DELAY * (2 ** (attempt - 1))
+            await asyncio.sleep(delay + random.uniform(0, delay / 2))
+
+    return None, attempt, error
+
+
+async def send_with_retry(
+    client: httpx.AsyncClient,
+    message: OutgoingMessage,
+    retries: int = MESSAGE_SEND_RETRIES,
+) -> SendResult:
+    """Gửi 1 tin qua /im/v1/messages"""
+    started = time.perf_counter()
+    result, attempts, error = await _call_with_retry(
+        lambda: _post_json(client, f"{LARK_API_BASE}/im/v1/messages",
+                           text_payload(message.receive_id, message.text),
+                           params={"receive_id_type": message.receive_id_type}),
+        retries,
+    )
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if result is None:
+        return SendResult(message.receive_id, message.label, False, attempts, elapsed_ms, error)
+    message_id = (result.get("data") or {}).get("message_id")
+    return SendResult(message.receive_id, message.label, True, attempts, elapsed_ms, message_id=message_id)
+
+
+async def fan_out_messages(
+    messages: Sequence[OutgoingMessage],
+    concurrency: int = MESSAGE_FANOUT_CONCURRENCY,
+    retries: int = MESSAGE_SEND_RETRIES,
+    on_result: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Dict[str, Any]:
+    """
+    Gửi nhiều tin song song (tối đa `concurrency` request cùng lúc)
+
+    on_result: gọi ngay khi từng người nhận có kết quả (dict như trong results) → lưu checkpoint
+
+    Returns:
+        {"total", "sent", "failed", "api_calls", "elapsed_ms", "results": [SendResult dict]}
+        (results theo thứ tự đầu vào)
+    """
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    results: List[Optional[SendResult]] = [None] * len(messages)
+    api_calls = 0
+
+    async with httpx.AsyncClient(timeout=MESSAGE_SEND_TIMEOUT) as client:
+        async def send_one(index: int):
+            nonlocal api_calls
+            async with semaphore:
+                results[index] = await send_with_retry(client, messages[index], retries=retries)
+                api_calls += results[index].attempts
+            if on_result:
+                on_result(asdict(results[index]))
+
+        await asyncio.gather(*(send_one(i) for i in range(len(messages))))
+
+    sent = sum(1 for r in results if r.ok)
+    summary = {
+        "total": len(results),
+        "sent": sent,
+        "failed": len(results) - sent,
+        "api_calls": api_calls,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        "results": [asdict(r) for r in results],
+    }
+    for r in results:
+        name = r.label or r.receive_id
+        if r.ok:
+            print(f"   ✅ {name} ({r.elapsed_ms:.0f}ms, {r.attempts} lần)")
+        else:
+            print(f"   ❌ {name} - {r.error} ({r.attempts} lần)")
+    print(f"📨 Fan-out: {sent}/{len(results)} sent in {summary['elapsed_ms']:.0f}ms "
+          f"({api_calls} API calls, concurrency={concurrency})")
+    return summary
+
+
+async def broadcast_to_chats(
+    targets: Sequence[Tuple[str, str]],
+    texts: Sequence[str],
+    concurrency: int = MESSAGE_FANOUT_CONCURRENCY,
+    retries: int = MESSAGE_SEND_RETRIES,
+) -> Dict[str, Any]:
+    """
+    Gửi cùng (các) nội dung đã render sẵn tới nhiều group chat
+
+    - Các nhóm gửi song song (tối đa `concurrency`, chung rate limit IM của app)
+    - Trong 1 nhóm các tin gửi lần lượt đúng thứ tự; 1 tin lỗi (sau retry) → dừng nhóm đó
+
+    Args:
+        targets: [(tên nhóm, chat_id)]
+        texts: nội dung cần gửi cho mỗi nhóm
+
+    Returns:
+        {"chats", "delivered", "failed", "elapsed_ms",
+         "report": [{"label", "chat_id", "ok", "latency_ms", "message_ids", "attempts", "error"}]}
+    """
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async with httpx.AsyncClient(timeout=MESSAGE_SEND_TIMEOUT) as client:
+        async def deliver(label: str, chat_id: str) -> Dict[str, Any]:
+            chat_started = time.perf_counter()
+            entry = {"label": label, "chat_id": chat_id, "ok": True, "message_ids": [], "attempts": 0, "error": None}
+            async with semaphore:
+                for text in texts:
+                    result = await send_with_retry(client, OutgoingMessage(chat_id, text, "chat_id", label),
+                                                   retries=retries)
+                    entry["attempts"] += result.attempts
+                    if not result.ok:
+                        entry["ok"], entry["error"] = False, result.error
+                        break
+                    entry["message_ids"].append(result.message_id)
+            entry["latency_ms"] = round((time.perf_counter() - chat_started) * 1000, 1)
+            return entry
+
+        report = await asyncio.gather(*(deliver(label, chat_id) for label, chat_id in targets))
+
+    delivered = sum(1 for entry in report if entry["ok"])
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+    for entry in report:
+        if entry["ok"]:
+            print(f"   ✅ {entry['label']} ({entry['latency_ms']:.0f}ms, {len(entry['message_ids'])} tin)")
+        else:
+            print(f"   ❌ {entry['label']} - {entry['error']}")
+    print(f"📢 Broadcast: {delivered}/{len(report)} chats in {elapsed_ms:.0f}ms "
+          f"({len(texts)} tin/nhóm, rate limit {MESSAGE_RATE_LIMIT_PER_SEC:g}/s)")
+    return {
+        "chats": len(report),
+        "delivered": delivered,
+        "failed": len(report) - delivered,
+        "elapsed_ms": elapsed_ms,
+        "report": list(report),
+    }
+
+
+async def update_text_message(message_id: str, text: str, retries: int = MESSAGE_SEND_RETRIES) -> bool:
+    """Sửa nội dung 1 tin text bot đã gửi (PUT /im/v1/messages/:message_id)"""
+    async with httpx.AsyncClient(timeout=MESSAGE_SEND_TIMEOUT) as client:
+        result, _, error = await _call_with_retry(
+            lambda: _post_json(client, f"{LARK_API_BASE}/im/v1/messages/{message_id}",
+                               {"msg_type": "text", "content": json.dumps({"text": text})}, method="PUT"),
+            retries,
+        )
+    if result is None:
+        print(f"❌ Failed to update message {message_id}: {error}")
+    return result is not None
+
+
+async def send_message(receive_id: str, text: str, receive_id_type: str = "user_id") -> bool:
+    """Gửi 1 tin (token cache + retry)"""
+    async with httpx.AsyncClient(timeout=MESSAGE_SEND_TIMEOUT) as client:
+        result = await send_with_retry(client, OutgoingMessage(receive_id, text, receive_id_type))
+    if result.ok:
+        print(f"✅ Sent message to {receive_id_type} {receive_id}")
+    else:
+        print(f"❌ Failed to send to {receive_id_type} {receive_id}: {result.error}")
+    return result.ok
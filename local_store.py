@@ -0,0 +1,76 @@
+"""
+Local Store Module
+SQLite cục bộ cho dữ liệu Jarvis tự tích luỹ (lịch sử KPI, checkpoint, hàng đợi...)
+Version 5.9.0
+
+Mỗi module dùng 1 file .db riêng trong JARVIS_DATA_DIR.
+JARVIS_DATA_DIR phải nằm trên volume (Docker volume / Railway Volume), nếu không mọi hàng đợi,
+outbox, checkpoint... mất khi redeploy → check_data_dir() cảnh báo lúc startup
+(JARVIS_DATA_REQUIRE_VOLUME=true → dừng hẳn).
+"""
+import os
+import sqlite3
+import threading
+from typing import Dict
+
+# ============ CONFIG ============
+JARVIS_DATA_DIR = os.getenv("JARVIS_DATA_DIR", "data")
+JARVIS_DATA_REQUIRE_VOLUME = os.getenv("JARVIS_DATA_REQUIRE_VOLUME", "false").lower() == "true"
+
+_connections: Dict[str, sqlite3.Connection] = {}
+_lock = threading.Lock()
+
+
+def get_db_path(name: str) -> str:
+    """Đường dẫn file .db của 1 store"""
+    return os.path.join(JARVIS_DATA_DIR, f"{name}.db")
+
+
+def is_on_volume(path: str = JARVIS_DATA_DIR) -> bool:
+    """path (hoặc 1 thư mục cha, trừ /) là mount point riêng → dữ liệu còn sau redeploy"""
+    path = os.path.abspath(path)
+    while path != os.path.dirname(path):
+        if os.path.ismount(path):
+            return True
+        path = os.path.dirname(path)
+    return False
+
+
+def check_data_dir() -> bool:
+    """
+    Gọi lúc startup: kiểm tra JARVIS_DATA_DIR có nằm trên volume không
+    Không có volume → cảnh báo (hoặc RuntimeError nếu JARVIS_DATA_REQUIRE_VOLUME=true)
+    """
+    if is_on_volume():
+        print(f"💾 Local store dir on volume: {os.path.abspath(JARVIS_DATA_DIR)}")
+        return True
+    message = (f"JARVIS_DATA_DIR={os.path.abspath(JARVIS_DATA_DIR)} is not on a mounted volume: "
+               f"inbound queue, outbox and checkpoints will be lost on redeploy")
+    if JARVIS_DATA_REQUIRE_VOLUME:
+        raise RuntimeError(message)
+    print(f"⚠️⚠️⚠️ {message}")
+    return False
+
+
+def get_connection(name: str) -> sqlite3.Connection:
+    """
+    Connection SQLite dùng chung cho 1 store (tạo lần đầu khi gọi)
+    Các thao tác đều ngắn nên gọi trực tiếp trong event loop
+    """
+    with _lock:
+        conn = _connections.get(name)
+        if conn is None:
+            os.makedirs(JARVIS_DATA_DIR, exist_ok=True)
+            conn = sqlite3.connect(get_db_path(name), check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            _connections[name] = conn
+            print(f"💾 Local store opened: {get_db_path(name)}")
+        return conn
+
+
+def close_all():
+    with _lock:
+        for conn in _connections.values():
+            conn.close()
+        _connections.clear()
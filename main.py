@@ -14,6 +14,7 @@ import os
 import json
 import base64
 import hashlib
+import hmac
 import time
 import re
 import asyncio
@@ -30,16 +31,35 @@ import httpx
 from dotenv import load_dotenv
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from apscheduler.triggers.date import DateTrigger
 
 # Load environment variables
 load_dotenv()
 
 # Import modules
-from intent_classifier import classify_intent, INTENT_KOC_REPORT, INTENT_CHENG_REPORT, INTENT_CONTENT_CALENDAR, INTENT_TASK_SUMMARY, INTENT_GENERAL_SUMMARY, INTENT_DASHBOARD, INTENT_UNKNOWN
-from lark_base import generate_koc_summary, generate_content_calendar, generate_task_summary, generate_dashboard_summary, test_connection
-from report_generator import generate_koc_report_text, generate_content_calendar_text, generate_task_summary_text, generate_general_summary_text, generate_dashboard_report_text, generate_cheng_report_text
+from intent_classifier import classify_intent, parse_koc_channel, INTENT_KOC_REPORT, INTENT_CHENG_REPORT, INTENT_CONTENT_CALENDAR, INTENT_TASK_SUMMARY, INTENT_GENERAL_SUMMARY, INTENT_DASHBOARD, INTENT_TREND, INTENT_KOC_CHANNEL, INTENT_UNKNOWN
+from lark_base import test_connection
+from lark_base import KALLE_KOC_TABLE_IDS, KALLE_DASHBOARD_TABLE_IDS, CHENG_REPORT_TABLE_IDS, TASK_TABLE_IDS
+from lark_base import BOOKING_BASE
+from koc_ranking import apply_revenue_change, get_koc_ranking, ensure_koc_ranking, verify_koc_ranking, RANKING_TABLES, KOC_RANKING_VERIFY_HOURS
+from report_cache import make_report_key, get_or_compute_report, get_report_cache, has_bypass_keyword, strip_bypass_keyword, format_data_age_note
+from report_details import get_detail_store
+from summaries import get_koc_summary, get_cheng_summary, get_content_calendar_summary, get_task_summary, get_kalle_dashboard_summary, get_week_breakdown
+from prewarm import prewarm_current_month, get_prewarm_status, PREWARM_ENABLED, PREWARM_HOUR, PREWARM_MINUTE
+from kpi_history import get_kpi_trend, close_month, close_previous_month, get_history_stats
+from report_batch import ReportRequest, generate_reports
+from report_generator import generate_koc_report_text, generate_content_calendar_text, generate_task_summary_text, generate_general_summary_text, generate_dashboard_report_text, generate_cheng_report_text, generate_trend_report_text, generate_content_detail_report_from_summary, generate_week_breakdown_text, generate_koc_channel_text, generate_top_koc_range_text, get_render_cache_stats
 from notes_manager import check_note_command, handle_note_command, get_notes_manager
-from daily_booking_report import send_daily_booking_reports, BOOKING_GROUP_CHAT_ID
+from daily_booking_report import send_daily_booking_reports, resume_daily_booking_reports, BOOKING_GROUP_CHAT_ID
+from booking_histogram import apply_booking_change, ensure_booking_histogram
+from lark_messenger import broadcast_to_chats
+from outbox import enqueue_message, get_outbox
+from reply_jobs import get_reply_jobs
+from event_workers import get_event_pool
+from message_dedup import get_message_dedup, is_duplicate_event, mark_event_processed
+from local_store import check_data_dir
+from inbound_queue import BUSY_TEXT, INBOUND_PUMP_SECONDS, get_inbound_queue, pump_inbound_events
 from contract_generator import generate_contract, parse_lark_record_to_contract_data
 from google_drive_client import get_drive_client
 from seeding_notification import (
@@ -64,6 +84,8 @@ LARK_APP_ID = os.getenv("LARK_APP_ID")
 LARK_APP_SECRET = os.getenv("LARK_APP_SECRET")
 LARK_ENCRYPT_KEY = os.getenv("LARK_ENCRYPT_KEY")
 LARK_VERIFICATION_TOKEN = os.getenv("LARK_VERIFICATION_TOKEN")
+# v5.9.0: Secret dùng chung với Lark Base Automation cho /webhook/table-changed (header X-Webhook-Secret)
+TABLE_WEBHOOK_SECRET = os.getenv("TABLE_WEBHOOK_SECRET")
 
 LARK_API_BASE = "https://open.larksuite.com/open-apis"
 TENANT_ACCESS_TOKEN_URL = f"{LARK_API_BASE}/auth/v3/tenant_access_token/internal"
@@ -95,25 +117,6 @@ def register_group(chat_id: str, chat_type: str, group_name: str = None):
 def get_discovered_groups():
     return _discovered_groups
 
-_processed_messages = {}
-MESSAGE_CACHE_TTL = 600
-
-def is_message_processed(message_id: str) -> bool:
-    now = time.time()
-    expired = [mid for mid, ts in _processed_messages.items() if now - ts > MESSAGE_CACHE_TTL]
-    for mid in expired:
-        del _processed_messages[mid]
-    if message_id in _processed_messages:
-        return True
-    return False
-
-def mark_message_processed(message_id: str):
-    _processed_messages[message_id] = time.time()
-    if message_id in _processed_messages:
-        return True
-    _processed_messages[message_id] = time.time()
-    return False
-
 app = FastAPI(title="Jarvis - Lark AI Report Assistant")
 
 class LarkDecryptor:
@@ -147,16 +150,11 @@ async def get_tenant_access_token() -> str:
             raise Exception(f"Failed to get token: {data}")
 
 async def send_lark_message(chat_id: str, text: str):
-    token = await get_tenant_access_token()
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            SEND_MESSAGE_URL,
-            params={"receive_id_type": "chat_id"},
-            headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
-            json={"receive_id": chat_id, "msg_type": "text", "content": json.dumps({"text": text})},
-            timeout=30.0
-        )
-        return response.json()
+    """
+    v5.9.0: Ghi tin vào outbox (SQLite) rồi worker nền gửi đi (FIFO theo chat, retry, dead letter)
+    → IM API chậm / lỗi không làm mất câu trả lời đã tính
+    """
+    return {"queued": enqueue_message(chat_id, text)}
 
 GROUP_NAME_MAPPING = {
     "booking": "booking_sep", "booking sếp": "booking_sep", "booking sep": "booking_sep",
@@ -262,31 +260,29 @@ async def handle_custom_message_to_groups(params: Dict) -> str:
     
     formatted_message = f"📢 **THÔNG BÁO**\n\n{message}"
     results = []
-    success_count = 0
     
-    for group_key in target_groups:
-        if group_key == "all":
-            for gk, chat_id in GROUP_CHATS.items():
-                try:
-                    await send_lark_message(chat_id, formatted_message)
-                    results.append(f"✅ {GROUP_DISPLAY_NAMES.get(gk, gk)}")
-                    success_count += 1
-                except Exception as e:
-                    results.append(f"❌ {GROUP_DISPLAY_NAMES.get(gk, gk)}: {str(e)}")
-            break
+    # v5.9.0: render 1 lần, broadcast song song tới các nhóm (rate limit + retry)
+    group_keys = list(GROUP_CHATS) if "all" in target_groups else target_groups
+    targets = []
+    for group_key in group_keys:
+        chat_id = GROUP_CHATS.get(group_key)
+        if chat_id:
+            targets.append((GROUP_DISPLAY_NAMES.get(group_key, group_key), chat_id))
         else:
-            chat_id = GROUP_CHATS.get(group_key)
-            if chat_id:
-                try:
-                    await send_lark_message(chat_id, formatted_message)
-                    results.append(f"✅ {GROUP_DISPLAY_NAMES.get(group_key, group_key)}")
-                    success_count += 1
-                except Exception as e:
-                    results.append(f"❌ {GROUP_DISPLAY_NAMES.get(group_key, group_key)}: {str(e)}")
-            else:
-                results.append(f"❌ Không tìm thấy nhóm: {group_key}")
+            results.append(f"❌ Không tìm thấy nhóm: {group_key}")
     
-    return f"📤 Đã gửi thông báo đến {success_count}/{len(results)} nhóm:\n" + "\n".join(results)
+    delivery = await broadcast_to_chats(targets, [formatted_message])
+    results.extend(_delivery_lines(delivery))
+    
+    return f"📤 Đã gửi thông báo đến {delivery['delivered']}/{len(results)} nhóm:\n" + "\n".join(results)
+
+
+def _delivery_lines(delivery: Dict) -> List[str]:
+    """Báo cáo gửi từng nhóm: ✅ tên (latency) / ❌ tên: lỗi"""
+    return [
+        f"✅ {entry['label']} ({entry['latency_ms']:.0f}ms)" if entry["ok"] else f"❌ {entry['label']}: {entry['error']}"
+        for entry in delivery["report"]
+    ]
 
 
 def check_send_report_command(text: str) -> Optional[Dict]:
@@ -298,13 +294,17 @@ def check_send_report_command(text: str) -> Optional[Dict]:
     if not any(kw in text_lower for kw in group_keywords):
         return None
     
-    report_type = "dashboard"
+    # v5.9.0: 1 lệnh có thể gửi nhiều loại báo cáo ("gửi kpi và top koc cho nhóm ...")
+    report_types = []
     if "kpi" in text_lower:
-        report_type = "kpi"
-    elif "top koc" in text_lower or "doanh số" in text_lower:
-        report_type = "top_koc"
-    elif "cảnh báo" in text_lower or "canh bao" in text_lower or "warning" in text_lower:
-        report_type = "canh_bao"
+        report_types.append("kpi")
+    if "top koc" in text_lower or "doanh số" in text_lower:
+        report_types.append("top_koc")
+    if "cảnh báo" in text_lower or "canh bao" in text_lower or "warning" in text_lower:
+        report_types.append("canh_bao")
+    if "đầy đủ" in text_lower or "dashboard" in text_lower or not report_types:
+        report_types.insert(0, "dashboard")
+    report_type = report_types[0]
     
     month = datetime.now().month
     month_match = re.search(r'tháng\s*(\d+)|thang\s*(\d+)', text_lower)
@@ -320,46 +320,49 @@ def check_send_report_command(text: str) -> Optional[Dict]:
     if not target_group:
         return None
     
-    return {"report_type": report_type, "month": month, "target_group": target_group}
+    return {"report_type": report_type, "report_types": report_types, "month": month, "target_group": target_group}
+
+
+# Loại báo cáo trong lệnh gửi nhóm → report_type của dashboard renderer
+SEND_REPORT_TYPES = {
+    "dashboard": "full",
+    "kpi": "kpi_nhan_su",
+    "top_koc": "top_koc",
+    "canh_bao": "canh_bao",
+}
 
 
 async def handle_send_report_to_group(params: Dict) -> str:
-    from lark_base import generate_dashboard_summary
-    from report_generator import generate_dashboard_report_text
-    
-    report_type = params.get("report_type", "dashboard")
+    report_types = params.get("report_types") or [params.get("report_type", "dashboard")]
     month = params.get("month", datetime.now().month)
     target_group = params.get("target_group")
     
+    if target_group == "all":
+        targets = list(GROUP_CHATS.items())
+    else:
+        chat_id = GROUP_CHATS.get(target_group)
+        if not chat_id:
+            return f"❌ Không tìm thấy nhóm '{target_group}'. Các nhóm có sẵn: {', '.join(GROUP_CHATS.keys())}"
+        targets = [(target_group, chat_id)]
+    
     try:
-        dashboard_data = await generate_dashboard_summary(month=month)
-        
-        if report_type == "kpi":
-            report = await generate_dashboard_report_text(dashboard_data, report_type="kpi_nhan_su")
-        elif report_type == "top_koc":
-            report = await generate_dashboard_report_text(dashboard_data, report_type="top_koc")
-        elif report_type == "canh_bao":
-            report = await generate_dashboard_report_text(dashboard_data, report_type="canh_bao")
-        else:
-            report = await generate_dashboard_report_text(dashboard_data, report_type="full")
-        
-        if target_group == "all":
-            results = []
-            for group_name, chat_id in GROUP_CHATS.items():
-                try:
-                    await send_lark_message(chat_id, report)
-                    results.append(f"✅ {group_name}")
-                except Exception as e:
-                    results.append(f"❌ {group_name}: {str(e)}")
-            return f"📤 Đã gửi báo cáo {report_type.upper()} tháng {month} đến:\n" + "\n".join(results)
-        else:
-            chat_id = GROUP_CHATS.get(target_group)
-            if not chat_id:
-                return f"❌ Không tìm thấy nhóm '{target_group}'. Các nhóm có sẵn: {', '.join(GROUP_CHATS.keys())}"
-            await send_lark_message(chat_id, report)
-            return f"✅ Đã gửi báo cáo {report_type.upper()} tháng {month} đến nhóm {target_group}"
+        # v5.9.0: Tất cả loại báo cáo render từ 1 lượt dữ liệu
+        requests = {rt: ReportRequest(brand="KALLE", report_type=SEND_REPORT_TYPES.get(rt, "full"), month=month)
+                    for rt in report_types}
+        reports = await generate_reports(requests.values())
     except Exception as e:
         return f"❌ Lỗi khi gửi báo cáo: {str(e)}"
+    
+    label = ", ".join(rt.upper() for rt in report_types)
+    # v5.9.0: các nhóm nhận song song, mỗi nhóm nhận đủ các loại báo cáo theo đúng thứ tự
+    delivery = await broadcast_to_chats(targets, [reports[requests[rt]] for rt in report_types])
+    if target_group != "all" and delivery["failed"]:
+        return f"❌ Lỗi khi gửi báo cáo: {delivery['report'][0]['error']}"
+    results = _delivery_lines(delivery)
+    
+    if target_group == "all":
+        return f"📤 Đã gửi báo cáo {label} tháng {month} đến:\n" + "\n".join(results)
+    return f"✅ Đã gửi báo cáo {label} tháng {month} đến nhóm {target_group}"
 
 
 def get_bot_introduction() -> str:
@@ -389,6 +392,16 @@ Xin chào! Tôi là Jarvis, trợ lý ảo hỗ trợ team Marketing.
 Gõ `help` để xem lại hướng dẫn này 🚀"""
 
 
+async def _top_koc_range_report(brand: str, intent_result: Dict, force_refresh: bool = False):
+    """v5.9.0: Top KOC nhiều tháng - cộng từ ledger kênh × tháng"""
+    start_month = intent_result.get("start_month")
+    end_month = intent_result.get("end_month")
+    ranking = await ensure_koc_ranking(brand, force_refresh=force_refresh)
+    top_koc = ranking.rank_range(brand, start_month, end_month, 10)
+    data = {"brand": brand, "start_month": start_month, "end_month": end_month, "top_koc": top_koc}
+    return data, await generate_top_koc_range_text(top_koc, brand, start_month, end_month)
+
+
 async def process_jarvis_query(text: str, chat_id: str = "") -> str:
     print(f"🔍 Processing query: {text}")
     
@@ -410,7 +423,21 @@ async def process_jarvis_query(text: str, chat_id: str = "") -> str:
     if send_report_result:
         return await handle_send_report_to_group(send_report_result)
     
-    intent_result = classify_intent(text)
+    # v5.9.0: "làm mới" / "refresh" → bỏ qua report cache
+    force_refresh = has_bypass_keyword(text)
+    if force_refresh:
+        text = strip_bypass_keyword(text)
+        print(f"🔄 Cache bypass requested")
+    
+    # v5.9.0: Câu hỏi có ID kênh KOC → tra ledger; chỉ route KOC_CHANNEL khi tra ra kênh
+    channel_lookup = None
+    if parse_koc_channel(text):
+        try:
+            channel_lookup = (await ensure_koc_ranking()).find_channels
+        except Exception as e:
+            print(f"⚠️ KOC channel lookup unavailable: {e}")
+    
+    intent_result = classify_intent(text, channel_lookup=channel_lookup)
     intent = intent_result.get("intent")
     
     print(f"🎯 Intent: {intent}")
@@ -423,23 +450,37 @@ async def process_jarvis_query(text: str, chat_id: str = "") -> str:
             group_by = intent_result.get("group_by", "product")
             product_filter = intent_result.get("product_filter")
             
-            summary_data = await generate_koc_summary(month=month, week=week, group_by=group_by, product_filter=product_filter)
-            report = await generate_koc_report_text(summary_data)
-            return report
+            async def build_koc_report():
+                summary_data = await get_koc_summary(month=month, week=week, group_by=group_by, product_filter=product_filter, force_refresh=force_refresh)
+                return summary_data, await generate_koc_report_text(summary_data)
+            
+            cache_key = make_report_key(intent, brand="KALLE", month=month, week=week,
+                                        group_by=group_by, product_filter=product_filter)
+            entry = await get_or_compute_report(cache_key, build_koc_report, tables=KALLE_KOC_TABLE_IDS, force_refresh=force_refresh)
+            return entry.text + format_data_age_note(entry)
         
         elif intent == INTENT_CHENG_REPORT:
             # ===== FIXED v5.7.2: Support nhan_su_filter for CHENG =====
             month = intent_result.get("month")
             week = intent_result.get("week")
+            year = intent_result.get("year")  # "tuần trước" vào tháng 1 → tháng 12 năm trước
             report_type = intent_result.get("report_type", "full")
             nhan_su = intent_result.get("nhan_su")  # Tên nhân sự cụ thể (nếu có)
             
-            from lark_base import generate_cheng_koc_summary
-            summary_data = await generate_cheng_koc_summary(month=month, week=week)
+            async def build_cheng_report():
+                if report_type == "top_koc_range":
+                    return await _top_koc_range_report("CHENG", intent_result, force_refresh)
+                if report_type == "theo_tuan":
+                    breakdown = await get_week_breakdown("CHENG", month, force_refresh=force_refresh, year=year)
+                    return breakdown, await generate_week_breakdown_text(breakdown, week=week)
+                summary_data = await get_cheng_summary(month=month, week=week, force_refresh=force_refresh, year=year)
+                # Sinh báo cáo với nhan_su_filter nếu có
+                return summary_data, await generate_cheng_report_text(summary_data, report_type=report_type, nhan_su_filter=nhan_su)
             
-            # Sinh báo cáo với nhan_su_filter nếu có
-            report = await generate_cheng_report_text(summary_data, report_type=report_type, nhan_su_filter=nhan_su)
-            return report
+            cache_key = make_report_key(intent, brand="CHENG", month=month, week=week, report_type=report_type, nhan_su=nhan_su,
+                                        start_month=intent_result.get("start_month"), end_month=intent_result.get("end_month"))
+            entry = await get_or_compute_report(cache_key, build_cheng_report, tables=CHENG_REPORT_TABLE_IDS, force_refresh=force_refresh)
+            return entry.text + format_data_age_note(entry)
         
         elif intent == INTENT_CONTENT_CALENDAR:
             start_date = intent_result.get("start_date")
@@ -448,36 +489,87 @@ async def process_jarvis_query(text: str, chat_id: str = "") -> str:
             vi_tri = intent_result.get("vi_tri_filter")
             month = intent_result.get("month")
             
-            calendar_data = await generate_content_calendar(start_date=start_date, end_date=end_date, month=month, team=team, vi_tri=vi_tri)
-            report = await generate_content_calendar_text(calendar_data)
-            return report
+            async def build_calendar_report():
+                calendar_data = await get_content_calendar_summary(start_date=start_date, end_date=end_date, month=month, team=team, vi_tri=vi_tri, force_refresh=force_refresh)
+                return calendar_data, await generate_content_calendar_text(calendar_data)
+            
+            cache_key = make_report_key(intent, month=month, start_date=start_date, end_date=end_date, team=team, vi_tri=vi_tri)
+            entry = await get_or_compute_report(cache_key, build_calendar_report, tables=TASK_TABLE_IDS, force_refresh=force_refresh)
+            return entry.text + format_data_age_note(entry)
         
         elif intent == INTENT_TASK_SUMMARY:
             month = intent_result.get("month")
             vi_tri = intent_result.get("vi_tri")
             
-            task_data = await generate_task_summary(month=month, vi_tri=vi_tri)
-            report = await generate_task_summary_text(task_data)
-            return report
+            async def build_task_report():
+                task_data = await get_task_summary(month=month, vi_tri=vi_tri, force_refresh=force_refresh)
+                return task_data, await generate_task_summary_text(task_data)
+            
+            cache_key = make_report_key(intent, month=month, vi_tri=vi_tri)
+            entry = await get_or_compute_report(cache_key, build_task_report, tables=TASK_TABLE_IDS, force_refresh=force_refresh)
+            return entry.text + format_data_age_note(entry)
         
         elif intent == INTENT_GENERAL_SUMMARY:
             month = intent_result.get("month")
             week = intent_result.get("week")
             
-            koc_data = await generate_koc_summary(month=month, week=week)
-            content_data = await generate_content_calendar(month=month)
-            report = await generate_general_summary_text(koc_data, content_data)
-            return report
+            async def build_general_report():
+                koc_data = await get_koc_summary(month=month, week=week, force_refresh=force_refresh)
+                content_data = await get_content_calendar_summary(month=month, force_refresh=force_refresh)
+                return {"koc": koc_data, "content": content_data}, await generate_general_summary_text(koc_data, content_data)
+            
+            cache_key = make_report_key(intent, brand="KALLE", month=month, week=week)
+            entry = await get_or_compute_report(cache_key, build_general_report, tables=KALLE_KOC_TABLE_IDS + TASK_TABLE_IDS, force_refresh=force_refresh)
+            return entry.text + format_data_age_note(entry)
+        
+        elif intent == INTENT_TREND:
+            # v5.9.0: Xu hướng nhiều tháng - đọc từ lịch sử cục bộ, không gọi Lark
+            trend = get_kpi_trend(
+                brand=intent_result.get("brand", "KALLE"),
+                months=intent_result.get("months", 6),
+                end_year=intent_result.get("year"),
+                end_month=intent_result.get("end_month"),
+                nhan_su=intent_result.get("nhan_su"),
+            )
+            return await generate_trend_report_text(trend)
+        
+        elif intent == INTENT_KOC_CHANNEL:
+            # v5.9.0: GMV 1 kênh qua các tháng - tra ledger, không quét bảng doanh thu
+            brand = intent_result.get("brand")
+            ranking = await ensure_koc_ranking(*([brand] if brand else []), force_refresh=force_refresh)
+            query = intent_result.get("channel", "")
+            matches = ranking.find_channels(query)
+            channel_data = None
+            if len(matches) == 1:
+                channel_data = ranking.channel_summary(
+                    matches[0], brand=brand,
+                    start_month=intent_result.get("start_month", 1),
+                    end_month=intent_result.get("end_month", 12),
+                )
+            return await generate_koc_channel_text(channel_data, query=query, candidates=matches if len(matches) > 1 else None)
         
         elif intent == INTENT_DASHBOARD:
             month = intent_result.get("month")
             week = intent_result.get("week")
+            year = intent_result.get("year")
             report_type = intent_result.get("report_type", "full")
             nhan_su = intent_result.get("nhan_su")
             
-            dashboard_data = await generate_dashboard_summary(month=month, week=week)
-            report = await generate_dashboard_report_text(dashboard_data, report_type=report_type, nhan_su_filter=nhan_su)
-            return report
+            async def build_dashboard_report():
+                if report_type == "top_koc_range":
+                    return await _top_koc_range_report("KALLE", intent_result, force_refresh)
+                if report_type == "theo_tuan":
+                    breakdown = await get_week_breakdown("KALLE", month, force_refresh=force_refresh, year=year)
+                    return breakdown, await generate_week_breakdown_text(breakdown, week=week)
+                dashboard_data = await get_kalle_dashboard_summary(month=month, week=week, force_refresh=force_refresh, year=year)
+                if report_type == "content_detail":
+                    return dashboard_data, generate_content_detail_report_from_summary(dashboard_data, month=month)
+                return dashboard_data, await generate_dashboard_report_text(dashboard_data, report_type=report_type, nhan_su_filter=nhan_su)
+            
+            cache_key = make_report_key(intent, brand="KALLE", month=month, week=week, report_type=report_type, nhan_su=nhan_su,
+                                        start_month=intent_result.get("start_month"), end_month=intent_result.get("end_month"))
+            entry = await get_or_compute_report(cache_key, build_dashboard_report, tables=KALLE_DASHBOARD_TABLE_IDS, force_refresh=force_refresh)
+            return entry.text + format_data_age_note(entry)
         
         else:
             return intent_result.get("suggestion", 
@@ -526,22 +618,45 @@ async def handle_lark_events(request: Request):
     event_type = header.get("event_type")
     
     if event_type == "im.message.receive_v1":
-        await handle_message_event(event)
+        # v5.9.0: lọc trùng + ghi event xuống inbound queue (SQLite) rồi mới trả 200;
+        # worker nền xử lý câu hỏi, restart giữa chừng thì event được chạy lại
+        message_id = event.get("message", {}).get("message_id")
+        event_id = header.get("event_id")
+        inbound = get_inbound_queue()
+        # Chỉ đánh dấu đã xử lý sau khi event đã được ghi xuống inbound queue (hoặc đã trả lời "bận"):
+        # ghi lỗi → trả 500, Lark gửi lại event không bị coi là trùng
+        if is_duplicate_event(event_id, message_id):
+            print(f"⏭️ Duplicate message {message_id or event_id}, skipping")
+        elif inbound.is_busy():
+            # Backpressure: không nhận thêm việc, báo user hỏi lại sau
+            inbound.note_busy_rejection()
+            print(f"🚦 Inbound queue busy, rejected {message_id}")
+            if _is_addressed_to_bot(event):
+                enqueue_message(event.get("message", {}).get("chat_id"), BUSY_TEXT)
+            mark_event_processed(event_id, message_id)
+        else:
+            if inbound.accept(message_id or event_id, event) is None:
+                print(f"⏭️ Duplicate message {message_id} (inbound queue), skipping")
+            mark_event_processed(event_id, message_id)
     
     return JSONResponse(content={"code": 0, "msg": "success"})
 
 
-async def handle_message_event(event: dict):
+def _is_addressed_to_bot(event: dict) -> bool:
+    """Tin nhắn riêng hoặc tin group có mention / gọi "jarvis"""
+    message = event.get("message", {})
+    if message.get("chat_type") != "group" or message.get("mentions"):
+        return True
+    try:
+        text = json.loads(message.get("content", "{}")).get("text", "")
+    except Exception:
+        text = message.get("content", "")
+    return "jarvis" in str(text).lower()
+
+
+async def process_message_event(event: dict):
+    """Xử lý 1 tin nhắn đã qua lọc trùng (chạy trong event worker)"""
     message = event.get("message", {})
-    message_id = message.get("message_id")
-    
-    if message_id and is_message_processed(message_id):
-        print(f"⏭️ Duplicate message {message_id}, skipping")
-        return
-    
-    if message_id:
-        mark_message_processed(message_id)
-    
     chat_id = message.get("chat_id")
     chat_type = message.get("chat_type")
     message_type = message.get("message_type")
@@ -577,12 +692,10 @@ async def handle_message_event(event: dict):
         mention_key = mention.get("key", "")
         clean_text = clean_text.replace(mention_key, "").strip()
     
-    response_text = await process_jarvis_query(clean_text or text, chat_id=chat_id)
-    
-    if message_id and is_message_processed(message_id):
-        pass
-    
-    await send_lark_message(chat_id, response_text)
+    # v5.9.0: câu hỏi chậm → tin "đang tổng hợp…" ngay rồi update thành kết quả;
+    # hỏi lại đúng câu đang tính trong cùng chat → không tính lần 2
+    query = clean_text or text
+    await get_reply_jobs().reply(chat_id, query, lambda: process_jarvis_query(query, chat_id=chat_id))
     print(f"✅ Response sent")
 
 
@@ -642,6 +755,9 @@ async def check_and_send_reminders():
 
 @app.on_event("startup")
 async def startup_event():
+    # v5.9.0 - Hàng đợi / outbox / checkpoint cần JARVIS_DATA_DIR nằm trên volume
+    check_data_dir()
+    
     # Job 1: Nhắc nhở daily (theo config REMINDER_HOUR)
     scheduler.add_job(
         check_and_send_reminders,
@@ -666,8 +782,61 @@ async def startup_event():
         replace_existing=True
     )
     print(f"📊 Daily Booking Report scheduled: Everyday at 9:00 AM (until 2026-02-14)")
+    
+    # Job 3b: v5.9.0 - Restart giữa lượt gửi báo cáo hàng ngày → gửi tiếp người chưa nhận
+    scheduler.add_job(
+        resume_daily_booking_reports,
+        DateTrigger(timezone=TIMEZONE),
+        id="daily_booking_report_resume",
+        replace_existing=True
+    )
+    
+    # Job 4: v5.9.0 - Tính lại top KOC để kiểm tra drift
+    scheduler.add_job(
+        verify_koc_ranking,
+        IntervalTrigger(hours=KOC_RANKING_VERIFY_HOURS, timezone=TIMEZONE),
+        id="koc_ranking_verify",
+        replace_existing=True
+    )
+    
+    # Job 5: v5.9.0 - Pre-warm summary tháng hiện tại trước giờ làm việc
+    if PREWARM_ENABLED:
+        scheduler.add_job(
+            prewarm_current_month,
+            CronTrigger(hour=PREWARM_HOUR, minute=PREWARM_MINUTE, timezone=TIMEZONE),
+            id="prewarm_current_month",
+            replace_existing=True
+        )
+        print(f"🔥 Pre-warm scheduled: Everyday at {PREWARM_HOUR}:{PREWARM_MINUTE:02d}")
+    
+    # Job 6: v5.9.0 - Chốt số liệu KPI tháng trước vào lịch sử (ngày 1 hàng tháng)
+    scheduler.add_job(
+        close_previous_month,
+        CronTrigger(day=1, hour=7, minute=0, timezone=TIMEZONE),
+        id="kpi_history_close_month",
+        replace_existing=True
+    )
+    
+    # Job 7: v5.9.0 - Đưa các event còn tồn / hết lease trong inbound queue vào worker pool
+    scheduler.add_job(
+        pump_inbound_events,
+        IntervalTrigger(seconds=INBOUND_PUMP_SECONDS, timezone=TIMEZONE),
+        id="inbound_queue_pump",
+        replace_existing=True
+    )
         
     scheduler.start()
+    
+    # v5.9.0: Worker gửi tin từ outbox (gửi tiếp các tin còn tồn từ lần chạy trước)
+    get_outbox().ensure_worker()
+    get_event_pool().start()
+    # v5.9.0: Chạy lại các event đã nhận nhưng chưa xử lý xong trước khi restart
+    inbound = get_inbound_queue()
+    inbound.set_handler(process_message_event)
+    recovered = inbound.recover()
+    if recovered:
+        print(f"📥 Inbound queue: recovered {recovered} interrupted events")
+    inbound.pump()
     print(f"🚀 Scheduler started. Daily reminder at 9:00 & 17:00 {TIMEZONE}")
     
     # Pre-initialize Google Drive client (avoid cold start on first contract)
@@ -682,6 +851,8 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     scheduler.shutdown()
+    await get_outbox().stop()
+    await get_event_pool().stop()
     print("🛑 Scheduler stopped")
 
 
@@ -703,17 +874,178 @@ async def test_intent(q: str = "tóm tắt KOC tháng 12"):
     result = classify_intent(q)
     return result
 
+@app.get("/test/report-cache")
+async def test_report_cache():
+    """Xem thống kê report cache + render cache"""
+    return {**get_report_cache().stats(), "render": get_render_cache_stats(), "details": get_detail_store().stats()}
+
+
+@app.post("/webhook/table-changed")
+async def handle_table_changed_webhook(request: Request):
+    """
+    Webhook từ Lark Base Automation khi record trong bảng thay đổi
+    Body: {"table_id": "tbl...", "record_id": "rec...", "action": "create|update|delete"}
+    → invalidate các báo cáo cache phụ thuộc vào bảng đó
+    → nếu là bảng Booking / Doanh thu KOC: đọc lại record từ Lark rồi áp dụng delta vào booking histogram / top KOC
+      ("fields" trong body bị bỏ qua)
+    Header bắt buộc: X-Webhook-Secret = TABLE_WEBHOOK_SECRET
+    """
+    # v5.9.0: Không có secret → không cho invalidate cache / kích hoạt fetch lại Lark
+    if not TABLE_WEBHOOK_SECRET:
+        print("❌ TABLE_WEBHOOK_SECRET chưa cấu hình, từ chối /webhook/table-changed")
+        raise HTTPException(status_code=503, detail="Webhook secret not configured")
+    if not hmac.compare_digest(request.headers.get("X-Webhook-Secret", ""), TABLE_WEBHOOK_SECRET):
+        print("❌ Table webhook secret verification failed")
+        raise HTTPException(status_code=401, detail="Invalid webhook secret")
+    
+    try:
+        body = await request.json()
+    except Exception:
+        return {"success": False, "error": "Invalid JSON"}
+    
+    table_id = body.get("table_id")
+    if not table_id:
+        return {"success": False, "error": "Missing table_id"}
+    
+    invalidated = get_report_cache().invalidate_table(table_id)
+    get_detail_store().invalidate_table(table_id)
+    
+    # v5.9.0: Booking thay đổi → áp dụng delta vào booking histogram thay vì quét lại
+    record_id = body.get("record_id")
+    if table_id == BOOKING_BASE["table_id"] and record_id:
+        try:
+            await apply_booking_change(body.get("action", "update"), record_id)
+        except Exception as e:
+            print(f"⚠️ Booking histogram delta failed: {e}")
+    
+    # v5.9.0: Doanh thu KOC thay đổi → cập nhật top KOC theo delta
+    if table_id in RANKING_TABLES and record_id:
+        try:
+            await apply_revenue_change(table_id, body.get("action", "update"), record_id)
+        except Exception as e:
+            print(f"⚠️ KOC ranking delta failed: {e}")
+    
+    return {"success": True, "table_id": table_id, "invalidated": invalidated}
+
+
+@app.get("/test/booking-histogram")
+async def test_booking_histogram(
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    staff: Optional[str] = None,
+    backfill: bool = False,
+):
+    """
+    Số air / deal theo khoảng ngày từ booking histogram (không quét lại Booking)
+    start / end: YYYY-MM-DD (gồm cả 2 đầu); staff: lọc 1 nhân sự
+    backfill=true: số liệu từng ngày × nhân sự + thiếu KPI
+    """
+    from datetime import date as _date
+    from daily_booking_report import normalize_staff_name_for_aggregation
+    
+    histogram = await ensure_booking_histogram()
+    if not start:
+        return histogram.stats()
+    try:
+        start_day = _date.fromisoformat(start)
+        end_day = _date.fromisoformat(end) if end else start_day
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}
+    
+    staff_list = [normalize_staff_name_for_aggregation(staff)] if staff else None
+    if backfill:
+        return {"start": start, "end": end_day.isoformat(), "rows": histogram.backfill(start_day, end_day, staff_list)}
+    
+    names = staff_list or histogram.staff_names()
+    return {
+        "start": start,
+        "end": end_day.isoformat(),
+        "staff": {
+            name: {
+                "air": histogram.range_count(name, "air", start_day, end_day),
+                "deal": histogram.range_count(name, "deal", start_day, end_day),
+                "month_to_date": histogram.month_to_date(name, end_day),
+            }
+            for name in names
+        },
+    }
+
+
+@app.get("/test/outbox")
+async def test_outbox(requeue_dead: bool = False):
+    """Metrics hàng đợi gửi tin; requeue_dead=true để gửi lại các dead letter"""
+    outbox = get_outbox()
+    requeued = outbox.requeue_dead() if requeue_dead else 0
+    return {**outbox.metrics(), "requeued": requeued}
+
+
+@app.get("/test/event-queue")
+async def test_event_queue():
+    """Metrics hàng đợi event Lark: độ sâu, thời gian chờ / xử lý, job lỗi"""
+    return get_event_pool().metrics()
+
+
+@app.get("/test/inbound-queue")
+async def test_inbound_queue():
+    """Metrics inbound queue: độ sâu, event chờ lâu nhất, event bị từ chối vì bận / chạy lại"""
+    return get_inbound_queue().metrics()
+
+
+@app.get("/test/dedup")
+async def test_dedup():
+    """Thống kê lọc event trùng: số key đang giữ, hit / miss, hết hạn / bị đẩy ra"""
+    return get_message_dedup().stats()
+
+
+@app.get("/test/reply-jobs")
+async def test_reply_jobs():
+    """Thống kê trả lời: gửi thẳng / placeholder / update / gắn vào job đang chạy"""
+    return get_reply_jobs().stats()
+
+
+@app.get("/test/koc-ranking")
+async def test_koc_ranking():
+    """Xem trạng thái index top KOC"""
+    return get_koc_ranking().stats()
+
+
+@app.get("/test/prewarm")
+async def test_prewarm(run: bool = False, force: bool = False):
+    """Xem trạng thái pre-warm; run=true để chạy ngay"""
+    if run:
+        return await prewarm_current_month(force=force)
+    return get_prewarm_status()
+
+
+@app.get("/test/kpi-history")
+async def test_kpi_history(close_year: Optional[int] = None, close_month_num: Optional[int] = None):
+    """
+    Xem thống kê lịch sử KPI
+    close_year + close_month_num: chốt (backfill) thủ công 1 tháng từ Lark
+    """
+    if close_year and close_month_num:
+        try:
+            saved = await close_month(close_year, close_month_num)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return {"closed": saved, "stats": get_history_stats()}
+    return get_history_stats()
+
+
 @app.get("/groups")
 async def list_groups():
     return {"registered_groups": GROUP_CHATS, "discovered_groups": get_discovered_groups()}
 
 
 @app.get("/test/daily-booking")
-async def test_daily_booking():
-    """Test endpoint để trigger daily booking report manually"""
+async def test_daily_booking(force: bool = False):
+    """
+    Test endpoint để trigger daily booking report manually
+    Mặc định tiếp tục lượt hôm nay (chỉ gửi người chưa nhận); force=true: tính lại + gửi lại tất cả
+    """
     try:
-        await send_daily_booking_reports()
-        return {"status": "ok", "message": "Daily booking reports sent"}
+        summary = await send_daily_booking_reports(force=force)
+        return {"status": "ok", "message": "Daily booking reports sent", "summary": summary}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
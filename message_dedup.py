@@ -0,0 +1,101 @@
+"""
+Message Dedup Module
+Lọc event Lark gửi trùng (retry khi ack chậm, gửi lại sau timeout...)
+Version 5.9.0
+
+- OrderedDict theo thứ tự thời điểm đánh dấu → key hết hạn luôn nằm đầu dict,
+  dọn bằng popitem từ đầu: kiểm tra + đánh dấu O(1) amortized (không quét toàn bộ mỗi event)
+- Giới hạn DEDUP_MAX_ENTRIES key: đầy → bỏ key cũ nhất
+- Khoá theo cả event_id (header) lẫn message_id: Lark gửi lại cùng event_id,
+  còn cùng 1 tin có thể đến qua event_id khác
+- Thống kê hit / miss / hết hạn / bị đẩy ra
+"""
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+# ============ CONFIG ============
+DEDUP_TTL_SECONDS = int(os.getenv("DEDUP_TTL_SECONDS", "600"))  # 10 phút
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "20000"))
+
+
+class TTLDedup:
+    """Tập key đã thấy, mỗi key sống `ttl` giây kể từ lần đánh dấu cuối"""
+
+    def __init__(self, ttl: float = DEDUP_TTL_SECONDS, max_entries: int = DEDUP_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def _expire(self, now: float):
+        cutoff = now - self.ttl
+        while self._seen:
+            key, marked_at = next(iter(self._seen.items()))
+            if marked_at > cutoff:
+                break
+            self._seen.popitem(last=False)
+            self.expired += 1
+
+    def contains(self, key: str) -> bool:
+        """Key đã thấy trong TTL chưa (không đánh dấu, không tính thống kê)"""
+        self._expire(time.time())
+        return key in self._seen
+
+    def mark(self, key: str):
+        now = time.time()
+        self._expire(now)
+        self._seen[key] = now
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+            self.evicted += 1
+
+    def seen(self, *keys: Optional[str]) -> bool:
+        """True nếu 1 trong các key đã thấy trong TTL (trùng); không đánh dấu. Key None / rỗng được bỏ qua"""
+        keys = [k for k in keys if k]
+        if not keys:
+            return False
+        self._expire(time.time())
+        if any(k in self._seen for k in keys):
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._seen),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+
+_message_dedup = TTLDedup()
+
+
+def get_message_dedup() -> TTLDedup:
+    return _message_dedup
+
+
+def _event_keys(event_id: Optional[str], message_id: Optional[str]):
+    return (f"event:{event_id}" if event_id else None, f"message:{message_id}" if message_id else None)
+
+
+def is_duplicate_event(event_id: Optional[str] = None, message_id: Optional[str] = None) -> bool:
+    """True nếu event_id hoặc message_id đã xử lý (chỉ kiểm tra, gọi mark_event_processed sau khi đã nhận event)"""
+    return _message_dedup.seen(*_event_keys(event_id, message_id))
+
+
+def mark_event_processed(event_id: Optional[str] = None, message_id: Optional[str] = None):
+    for key in _event_keys(event_id, message_id):
+        if key:
+            _message_dedup.mark(key)
@@ -0,0 +1,294 @@
+"""
+Outbox Module
+Hàng đợi tin nhắn gửi đi, lưu trên SQLite cục bộ
+Version 5.9.0
+
+- Tin trả lời / báo cáo được ghi vào outbox trước khi gửi → API IM chậm / lỗi không làm mất
+  báo cáo đã tính (không phải tính lại khi user hỏi lại)
+- FIFO theo từng chat: tin sau chỉ gửi khi tin trước của cùng chat đã gửi xong / bị loại
+- Gửi lỗi → retry với backoff luỹ thừa; quá OUTBOX_MAX_ATTEMPTS lần → dead letter
+- Restart giữa chừng → tin đang gửi dở quay về pending, worker gửi tiếp
+- Metrics: backlog, tuổi tin cũ nhất, dead letter, latency từ lúc vào hàng đến lúc gửi xong
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from local_store import get_connection
+from lark_messenger import MESSAGE_SEND_TIMEOUT, OutgoingMessage, send_with_retry
+
+# ============ CONFIG ============
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "2"))
+OUTBOX_RETRY_MAX_SECONDS = float(os.getenv("OUTBOX_RETRY_MAX_SECONDS", "600"))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+OUTBOX_RETENTION_HOURS = float(os.getenv("OUTBOX_RETENTION_HOURS", "24"))
+
+# Worker tự thức dậy tối thiểu mỗi chừng này giây (khi không có tín hiệu enqueue)
+_POLL_SECONDS = 30
+
+_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        receive_id TEXT NOT NULL,
+        receive_id_type TEXT NOT NULL,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        created_at REAL NOT NULL,
+        sent_at REAL,
+        message_id TEXT,
+        last_error TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (status, receive_id, id)",
+)
+
+# Tin đầu hàng của mỗi chat (pending / đang gửi) đã tới giờ gửi
+_DUE_HEADS_SQL = """
+SELECT o.* FROM outbox o
+JOIN (
+    SELECT receive_id, MIN(id) AS head FROM outbox
+    WHERE status IN ('pending', 'sending') GROUP BY receive_id
+) h ON o.id = h.head
+WHERE o.status = 'pending' AND o.next_attempt_at <= ?
+ORDER BY o.id LIMIT ?
+"""
+
+
+def _db():
+    conn = get_connection("outbox")
+    for statement in _SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+def retry_delay(attempts: int) -> float:
+    """Thời gian chờ trước lần gửi tiếp theo sau `attempts` lần lỗi"""
+    return min(OUTBOX_RETRY_MAX_SECONDS, OUTBOX_RETRY_BASE_SECONDS * (2 ** (attempts - 1)))
+
+
+class Outbox:
+    """Hàng đợi gửi tin bền vững + worker nền"""
+
+    def __init__(self):
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._latencies_ms: deque = deque(maxlen=500)
+        self._last_cleanup = 0.0
+        # outbox id → các future chờ tin được gửi xong (message_id, None nếu dead / bị huỷ)
+        self._waiters: Dict[int, List[asyncio.Future]] = {}
+        self.sent = 0
+        self.retried = 0
+        self.dead = 0
+
+    # ----- Producer -----
+
+    def enqueue(self, receive_id: str, text: str, receive_id_type: str = "chat_id") -> int:
+        """Ghi tin vào outbox (commit xuống disk) rồi đánh thức worker, trả về id"""
+        now = time.time()
+        conn = _db()
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO outbox (receive_id, receive_id_type, text, next_attempt_at, created_at) "
+                "VALUES (?,?,?,?,?)",
+                (receive_id, receive_id_type, text, now, now)
+            )
+        self.ensure_worker()
+        self._wake.set()
+        return cursor.lastrowid
+
+    def cancel_pending(self, outbox_id: int) -> bool:
+        """Huỷ tin chưa gửi (còn pending); False nếu tin đang gửi / đã gửi / không tồn tại"""
+        conn = _db()
+        with conn:
+            cancelled = conn.execute("DELETE FROM outbox WHERE id=? AND status='pending'", (outbox_id,)).rowcount
+        if cancelled:
+            self._resolve(outbox_id, None)
+        return bool(cancelled)
+
+    async def wait_delivered(self, outbox_id: int) -> Optional[str]:
+        """Chờ tin được gửi xong, trả về message_id (None nếu dead letter / không còn trong outbox)"""
+        row = _db().execute("SELECT status, message_id FROM outbox WHERE id=?", (outbox_id,)).fetchone()
+        if row is None or row["status"] == "dead":
+            return None
+        if row["status"] == "sent":
+            return row["message_id"]
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(outbox_id, []).append(future)
+        self.ensure_worker()
+        return await future
+
+    def _resolve(self, outbox_id: int, message_id: Optional[str]):
+        for future in self._waiters.pop(outbox_id, []):
+            if not future.done():
+                future.set_result(message_id)
+
+    # ----- Worker -----
+
+    def ensure_worker(self):
+        """Chạy worker nền nếu chưa chạy (cần event loop đang chạy)"""
+        if self._task is not None and not self._task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # Chưa có event loop → worker sẽ được start khi app startup
+        self._wake = asyncio.Event()
+        self._task = loop.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        # Tin đang gửi dở khi process dừng → gửi lại (có thể trùng 1 lần, không bao giờ mất)
+        conn = _db()
+        with conn:
+            recovered = conn.execute("UPDATE outbox SET status='pending' WHERE status='sending'").rowcount
+        if recovered:
+            print(f"📮 Outbox: recovered {recovered} in-flight messages")
+        print("📮 Outbox worker started")
+
+        async with httpx.AsyncClient(timeout=MESSAGE_SEND_TIMEOUT) as client:
+            while True:
+                try:
+                    self._wake.clear()
+                    heads = _db().execute(_DUE_HEADS_SQL, (time.time(), OUTBOX_CONCURRENCY)).fetchall()
+                    if heads:
+                        await self._deliver(client, heads)
+                        continue
+                    self._cleanup()
+                    await self._sleep_until_due()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"⚠️ Outbox worker error: {e}")
+                    await asyncio.sleep(1)
+
+    async def _sleep_until_due(self):
+        row = _db().execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status='pending'").fetchone()
+        timeout = _POLL_SECONDS
+        if row[0] is not None:
+            timeout = max(0.05, min(timeout, row[0] - time.time()))
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _deliver(self, client: httpx.AsyncClient, heads: List[Any]):
+        conn = _db()
+        with conn:
+            conn.executemany("UPDATE outbox SET status='sending' WHERE id=?", [(row["id"],) for row in heads])
+
+        async def send(row):
+            message = OutgoingMessage(row["receive_id"], row["text"], row["receive_id_type"])
+            return row, await send_with_retry(client, message, retries=0)
+
+        outcomes = await asyncio.gather(*(send(row) for row in heads))
+
+        now = time.time()
+        with conn:
+            for row, result in outcomes:
+                attempts = row["attempts"] + 1
+                if result.ok:
+                    conn.execute(
+                        "UPDATE outbox SET status='sent', attempts=?, sent_at=?, message_id=?, last_error=NULL "
+                        "WHERE id=?", (attempts, now, result.message_id, row["id"])
+                    )
+                    self.sent += 1
+                    self._latencies_ms.append((now - row["created_at"]) * 1000)
+                    self._resolve(row["id"], result.message_id)
+                elif attempts >= OUTBOX_MAX_ATTEMPTS:
+                    conn.execute(
+                        "UPDATE outbox SET status='dead', attempts=?, last_error=? WHERE id=?",
+                        (attempts, result.error, row["id"])
+                    )
+                    self.dead += 1
+                    self._resolve(row["id"], None)
+                    print(f"☠️ Outbox: message {row['id']} to {row['receive_id']} dead-lettered: {result.error}")
+                else:
+                    conn.execute(
+                        "UPDATE outbox SET status='pending', attempts=?, next_attempt_at=?, last_error=? WHERE id=?",
+                        (attempts, now + retry_delay(attempts), result.error, row["id"])
+                    )
+                    self.retried += 1
+                    print(f"🔁 Outbox: message {row['id']} to {row['receive_id']} failed "
+                          f"({attempts}/{OUTBOX_MAX_ATTEMPTS}), retry in {retry_delay(attempts):.0f}s")
+
+    def _cleanup(self):
+        """Xoá tin đã gửi quá OUTBOX_RETENTION_HOURS (tối đa 1 lần / giờ)"""
+        now = time.time()
+        if now - self._last_cleanup < 3600:
+            return
+        self._last_cleanup = now
+        conn = _db()
+        with conn:
+            conn.execute("DELETE FROM outbox WHERE status='sent' AND sent_at < ?",
+                         (now - OUTBOX_RETENTION_HOURS * 3600,))
+
+    # ----- Quản trị -----
+
+    def requeue_dead(self) -> int:
+        """Đưa toàn bộ dead letter về hàng đợi (gửi lại từ đầu)"""
+        conn = _db()
+        with conn:
+            count = conn.execute(
+                "UPDATE outbox SET status='pending', attempts=0, next_attempt_at=? WHERE status='dead'",
+                (time.time(),)
+            ).rowcount
+        if count:
+            self.ensure_worker()
+            self._wake.set()
+        return count
+
+    def metrics(self) -> Dict[str, Any]:
+        conn = _db()
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+        oldest = conn.execute(
+            "SELECT MIN(created_at) FROM outbox WHERE status IN ('pending', 'sending')"
+        ).fetchone()[0]
+        backlog_by_chat = dict(conn.execute(
+            "SELECT receive_id, COUNT(*) FROM outbox WHERE status IN ('pending', 'sending') "
+            "GROUP BY receive_id ORDER BY COUNT(*) DESC LIMIT 10"
+        ).fetchall())
+        latencies = sorted(self._latencies_ms)
+        return {
+            "worker_running": self._task is not None and not self._task.done(),
+            "backlog": counts.get("pending", 0) + counts.get("sending", 0),
+            "backlog_by_chat": backlog_by_chat,
+            "oldest_pending_age_s": round(time.time() - oldest, 1) if oldest else 0,
+            "dead_letters": counts.get("dead", 0),
+            "stored_sent": counts.get("sent", 0),
+            "sent": self.sent,
+            "retried": self.retried,
+            "dead": self.dead,
+            "latency_ms": {
+                "count": len(latencies),
+                "avg": round(sum(latencies) / len(latencies), 1) if latencies else 0,
+                "p50": round(latencies[len(latencies) // 2], 1) if latencies else 0,
+                "p95": round(latencies[int(len(latencies) * 0.95)], 1) if latencies else 0,
+            },
+        }
+
+
+_outbox = Outbox()
+
+
+def get_outbox() -> Outbox:
+    return _outbox
+
+
+def enqueue_message(receive_id: str, text: str, receive_id_type: str = "chat_id") -> int:
+    return _outbox.enqueue(receive_id, text, receive_id_type)
@@ -0,0 +1,137 @@
+"""
+Pre-warm Module
+Tính sẵn summary của tháng hiện tại trước giờ làm việc
+Version 5.9.0
+
+- Dashboard KALLE, tổng hợp CHENG (cả tháng + tuần hiện tại + từng tuần) cho từng brand đã đăng ký
+- Lịch content tháng hiện tại + tuần này, tham số lấy từ classify_intent để trùng cache key với câu hỏi thật
+- Ghi lại thời gian warm từng mục; bỏ qua nếu dữ liệu trong cache vẫn còn mới
+"""
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, List
+
+import pytz
+
+from intent_classifier import classify_intent, parse_week
+from summaries import (
+    BRAND_SUMMARIES,
+    get_content_calendar_summary,
+    get_summary_age,
+    get_week_breakdown,
+)
+
+# ============ CONFIG ============
+PREWARM_ENABLED = os.getenv("PREWARM_ENABLED", "true").lower() == "true"
+PREWARM_HOUR = int(os.getenv("PREWARM_HOUR", "8"))
+PREWARM_MINUTE = int(os.getenv("PREWARM_MINUTE", "30"))
+# TTL của summary đã warm - đủ dài để dùng hết buổi sáng
+PREWARM_TTL = int(os.getenv("PREWARM_TTL", "3600"))
+# Summary còn trẻ hơn ngưỡng này (giây) thì không warm lại
+PREWARM_FRESH_SECONDS = int(os.getenv("PREWARM_FRESH_SECONDS", "1800"))
+
+VN_TZ = pytz.timezone("Asia/Ho_Chi_Minh")
+
+# Mã summary (theo summaries.summary_key) của từng brand
+BRAND_SUMMARY_NAMES = {
+    "KALLE": "kalle_dashboard",
+    "CHENG": "cheng_koc",
+}
+
+_prewarm_status: Dict[str, Any] = {
+    "last_run": None,
+    "last_duration": None,
+    "skipped": None,
+    "items": [],
+}
+
+
+def get_prewarm_status() -> Dict[str, Any]:
+    return dict(_prewarm_status)
+
+
+def _prewarm_targets(now: datetime) -> List[Dict[str, Any]]:
+    """Danh sách summary cần warm: (tên, hàm lấy, tham số)"""
+    month = now.month
+    week = parse_week("tuần này")
+
+    targets = []
+    for brand, getter in BRAND_SUMMARIES.items():
+        name = BRAND_SUMMARY_NAMES.get(brand, brand.lower())
+        for w in (None, week):
+            label = f"{brand} tháng {month}" if w is None else f"{brand} tuần {w}/{month}"
+            params = {"month": month, "week": w}
+            targets.append({"label": label, "name": name, "getter": getter,
+                            "params": params, "key_params": {**params, "brand": brand}})
+        # Từng tuần của tháng (1 lượt quét, dùng cho "theo tuần" / so sánh tuần)
+        params = {"brand": brand, "month": month}
+        targets.append({"label": f"{brand} từng tuần {month}", "name": "week_breakdown",
+                        "getter": get_week_breakdown, "params": params, "key_params": params})
+
+    # Lịch content: đúng tham số mà câu hỏi "lịch content tháng N" / "lịch content" tạo ra
+    for label in (f"Lịch content tháng {month}", "Lịch content"):
+        intent = classify_intent(label.lower())
+        params = {"start_date": intent.get("start_date"), "end_date": intent.get("end_date"),
+                  "month": intent.get("month"), "team": intent.get("team_filter"),
+                  "vi_tri": intent.get("vi_tri_filter")}
+        targets.append({"label": label, "name": "content_calendar",
+                        "getter": get_content_calendar_summary, "params": params, "key_params": params})
+    return targets
+
+
+async def prewarm_current_month(force: bool = False) -> Dict[str, Any]:
+    """
+    Scheduler job: warm các summary của tháng hiện tại
+
+    force=True: warm lại kể cả khi cache còn mới
+    """
+    if not PREWARM_ENABLED and not force:
+        return get_prewarm_status()
+
+    now = datetime.now(VN_TZ)
+    targets = _prewarm_targets(now)
+
+    # Bỏ qua cả lượt nếu mọi summary đều còn mới
+    ages = {t["label"]: get_summary_age(t["name"], **t["key_params"]) for t in targets}
+    if not force and all(age is not None and age < PREWARM_FRESH_SECONDS for age in ages.values()):
+        print(f"⏭️ Pre-warm skipped: all {len(targets)} summaries are fresh")
+        _prewarm_status["skipped"] = now.isoformat()
+        return get_prewarm_status()
+
+    print(f"🔥 Pre-warming {len(targets)} summaries for {now.strftime('%m/%Y')}...")
+    started = time.perf_counter()
+    items = []
+
+    # Warm token trước để các request sau không phải chờ lấy token
+    try:
+        from lark_base import get_tenant_access_token
+        await get_tenant_access_token()
+    except Exception as e:
+        print(f"⚠️ Pre-warm token failed: {e}")
+
+    for target in targets:
+        age = ages[target["label"]]
+        if not force and age is not None and age < PREWARM_FRESH_SECONDS:
+            items.append({"label": target["label"], "status": "fresh", "age": round(age)})
+            continue
+
+        item_started = time.perf_counter()
+        try:
+            await target["getter"](**target["params"], force_refresh=True, ttl=PREWARM_TTL)
+            status = "ok"
+        except Exception as e:
+            print(f"❌ Pre-warm {target['label']} failed: {e}")
+            status = f"error: {e}"
+        duration = round(time.perf_counter() - item_started, 2)
+        items.append({"label": target["label"], "status": status, "duration": duration})
+        print(f"   • {target['label']}: {status} ({duration}s)")
+
+    total = round(time.perf_counter() - started, 2)
+    _prewarm_status.update({
+        "last_run": now.isoformat(),
+        "last_duration": total,
+        "items": items,
+    })
+    print(f"✅ Pre-warm done in {total}s")
+    return get_prewarm_status()
@@ -0,0 +1,108 @@
+"""
+Reply Jobs Module
+Trả lời câu hỏi chậm: tin "đang tổng hợp…" ngay, xong thì sửa chính tin đó thành kết quả
+Version 5.9.0
+
+- Câu trả lời có trong REPLY_PLACEHOLDER_DELAY giây (cache hit, lệnh nhanh) → gửi thẳng như cũ
+- Quá thời gian đó → gửi placeholder qua outbox (giữ thứ tự FIFO với các tin trước của chat),
+  tính xong thì update tin placeholder (Lark message update API)
+- Placeholder chưa kịp gửi khi đã có kết quả (chat còn tin trước đang chờ) → huỷ placeholder, gửi thẳng kết quả
+- Placeholder lưu kèm inbound job → job chạy lại sau restart sửa đúng tin cũ, không gửi placeholder thứ 2
+- Cùng chat hỏi lại đúng câu đang tính → gắn vào job đang chạy, không tính lại lần 2 và không gửi thêm tin
+  (kết quả vẫn vào placeholder / tin của lần hỏi đầu)
+- Update lỗi (tin quá cũ, API lỗi...) → gửi kết quả thành tin mới qua outbox
+"""
+import asyncio
+import os
+import re
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from inbound_queue import get_job_placeholder, set_job_placeholder
+from lark_messenger import update_text_message
+from outbox import enqueue_message, get_outbox
+
+# ============ CONFIG ============
+REPLY_PLACEHOLDER_DELAY = float(os.getenv("REPLY_PLACEHOLDER_DELAY", "1.5"))
+
+PLACEHOLDER_TEXT = "⏳ Jarvis đang tổng hợp… (kết quả sẽ cập nhật vào tin nhắn này)"
+
+
+def normalize_query(text: str) -> str:
+    return re.sub(r'\s+', ' ', (text or "").strip().lower())
+
+
+class ReplyJobs:
+    """Các job trả lời đang chạy, khoá theo (chat_id, câu hỏi đã chuẩn hoá)"""
+
+    def __init__(self):
+        self._inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+        self.direct = 0
+        self.placeholders = 0
+        self.placeholders_reused = 0
+        self.placeholders_cancelled = 0
+        self.updated = 0
+        self.update_fallbacks = 0
+        self.attached = 0
+
+    async def reply(self, chat_id: str, text: str, compute: Callable[[], Awaitable[str]]):
+        """Tính câu trả lời bằng compute() và gửi vào chat (placeholder nếu lâu)"""
+        key = (chat_id, normalize_query(text))
+        running = self._inflight.get(key)
+        if running is not None and not running.done():
+            self.attached += 1
+            print(f"🔗 Repeat question in {chat_id} attached to in-flight job")
+            return
+
+        task = asyncio.create_task(compute())
+        self._inflight[key] = task
+        try:
+            placeholder_outbox_id = get_job_placeholder()
+            if placeholder_outbox_id is None:
+                done, _ = await asyncio.wait({task}, timeout=REPLY_PLACEHOLDER_DELAY)
+                if task in done:
+                    self.direct += 1
+                    enqueue_message(chat_id, task.result())
+                    return
+                placeholder_outbox_id = enqueue_message(chat_id, PLACEHOLDER_TEXT)
+                set_job_placeholder(placeholder_outbox_id)
+                self.placeholders += 1
+            else:
+                # Job chạy lại sau restart → dùng lại placeholder đã gửi
+                self.placeholders_reused += 1
+            result = await task
+
+            outbox = get_outbox()
+            if outbox.cancel_pending(placeholder_outbox_id):
+                self.placeholders_cancelled += 1
+                enqueue_message(chat_id, result)
+                return
+            placeholder_id = await outbox.wait_delivered(placeholder_outbox_id)
+            if placeholder_id and await update_text_message(placeholder_id, result):
+                self.updated += 1
+                print(f"✏️ Placeholder {placeholder_id} updated with result")
+                return
+            if placeholder_id:
+                self.update_fallbacks += 1
+            enqueue_message(chat_id, result)
+        finally:
+            if self._inflight.get(key) is task:
+                del self._inflight[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._inflight),
+            "direct": self.direct,
+            "placeholders": self.placeholders,
+            "placeholders_reused": self.placeholders_reused,
+            "placeholders_cancelled": self.placeholders_cancelled,
+            "updated": self.updated,
+            "update_fallbacks": self.update_fallbacks,
+            "attached": self.attached,
+        }
+
+
+_reply_jobs = ReplyJobs()
+
+
+def get_reply_jobs() -> ReplyJobs:
+    return _reply_jobs
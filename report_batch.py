@@ -0,0 +1,74 @@
+"""
+Report Batch Module
+Sinh nhiều báo cáo (brand × tháng × loại báo cáo) trong 1 lượt dữ liệu
+Version 5.9.0
+
+- Gom các yêu cầu theo (brand, tháng, tuần) → mỗi nhóm lấy summary đúng 1 lần
+- Các get_all_records trùng nhau trong lượt chạy dùng chung 1 lần fetch (shared_fetches)
+- Mọi loại báo cáo (full, kpi_team, top_koc, lien_he, canh_bao...) render từ summary chung
+"""
+import asyncio
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from lark_base import shared_fetches
+from summaries import BRAND_SUMMARIES
+from report_generator import generate_dashboard_report_text, generate_cheng_report_text
+
+# brand → hàm render report text (summary, report_type, nhan_su_filter)
+BRAND_RENDERERS = {
+    "KALLE": generate_dashboard_report_text,
+    "CHENG": generate_cheng_report_text,
+}
+
+
+@dataclass(frozen=True)
+class ReportRequest:
+    """1 báo cáo cần sinh"""
+    brand: str = "KALLE"
+    report_type: str = "full"
+    month: Optional[int] = None
+    week: Any = None
+    nhan_su: Optional[str] = None
+
+    @property
+    def group_key(self) -> Tuple:
+        return (self.brand.upper(), self.month, self.week)
+
+
+async def generate_reports(
+    requests: Iterable[ReportRequest],
+    force_refresh: bool = False,
+) -> Dict[ReportRequest, str]:
+    """
+    Sinh text cho tất cả báo cáo được yêu cầu
+
+    Returns:
+        {ReportRequest: report text} (lỗi của 1 nhóm → text "❌ ..." cho các báo cáo của nhóm đó)
+    """
+    groups: Dict[Tuple, List[ReportRequest]] = {}
+    for request in requests:
+        groups.setdefault(request.group_key, []).append(request)
+
+    async def load_summary(brand: str, month, week) -> Dict[str, Any]:
+        getter = BRAND_SUMMARIES.get(brand)
+        if getter is None:
+            raise ValueError(f"Brand chưa hỗ trợ: {brand}")
+        return await getter(month=month, week=week, force_refresh=force_refresh)
+
+    with shared_fetches():
+        keys = list(groups)
+        summaries = await asyncio.gather(*(load_summary(*key) for key in keys), return_exceptions=True)
+
+    results: Dict[ReportRequest, str] = {}
+    for key, summary in zip(keys, summaries):
+        brand = key[0]
+        for request in groups[key]:
+            if isinstance(summary, Exception):
+                results[request] = f"❌ Lỗi khi tổng hợp {brand}: {summary}"
+                continue
+            renderer = BRAND_RENDERERS[brand]
+            results[request] = await renderer(summary, report_type=request.report_type, nhan_su_filter=request.nhan_su)
+
+    print(f"📦 Batch reports: {len(results)} reports from {len(groups)} summaries")
+    return results
@@ -0,0 +1,379 @@
+"""
+Report Cache Module
+Cache kết quả báo cáo (summary dict + text đã render) theo tham số intent đã chuẩn hoá
+Version 5.9.0
+
+- Key: (intent, brand, month, week, report_type, nhân sự) + tham số phụ (group_by, product_filter...)
+- TTL theo từng intent
+- Invalidate theo bảng Lark khi dữ liệu thay đổi (webhook từ Lark Base Automation)
+- Từ khoá "làm mới" / "refresh" để bỏ qua cache
+- Stale-while-revalidate: entry hết hạn nhưng chưa quá REPORT_CACHE_MAX_STALE → trả ngay, refresh nền
+- Lark lỗi hoàn toàn → dùng lại kết quả cũ thay vì báo lỗi
+"""
+import asyncio
+import contextvars
+import os
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, Iterable, Optional, Tuple
+
+# ============ CONFIG ============
+REPORT_CACHE_TTL = int(os.getenv("REPORT_CACHE_TTL", "300"))  # 5 phút
+REPORT_CACHE_MAX_ENTRIES = int(os.getenv("REPORT_CACHE_MAX_ENTRIES", "256"))
+# Tuổi tối đa (giây) của dữ liệu cũ còn được trả ngay trong lúc refresh nền
+REPORT_CACHE_MAX_STALE = int(os.getenv("REPORT_CACHE_MAX_STALE", "900"))  # 15 phút
+
+# TTL riêng theo intent (giây) - override REPORT_CACHE_TTL
+INTENT_TTLS = {
+    "DASHBOARD": REPORT_CACHE_TTL,
+    "CHENG_REPORT": REPORT_CACHE_TTL,
+    "KOC_REPORT": REPORT_CACHE_TTL,
+    "GENERAL_SUMMARY": REPORT_CACHE_TTL,
+    "CONTENT_CALENDAR_SUMMARY": 600,
+    "TASK_SUMMARY": 600,
+}
+
+# Từ khoá để user yêu cầu dữ liệu mới (bỏ qua cache)
+BYPASS_KEYWORDS = [
+    "làm mới", "lam moi", "dữ liệu mới", "du lieu moi",
+    "refresh", "no cache", "nocache",
+]
+
+_BYPASS_PATTERN = re.compile(
+    "|".join(re.escape(kw) for kw in sorted(BYPASS_KEYWORDS, key=len, reverse=True)),
+    re.IGNORECASE
+)
+
+
+def has_bypass_keyword(text: str) -> bool:
+    """Kiểm tra user có yêu cầu dữ liệu mới không"""
+    return bool(text) and _BYPASS_PATTERN.search(text) is not None
+
+
+def strip_bypass_keyword(text: str) -> str:
+    """Loại bỏ từ khoá bypass khỏi câu hỏi trước khi phân loại intent"""
+    if not text:
+        return text
+    return re.sub(r'\s{2,}', ' ', _BYPASS_PATTERN.sub('', text)).strip()
+
+
+def _normalize_param(value: Any) -> Any:
+    """Chuẩn hoá 1 tham số để 2 câu hỏi giống nhau cho cùng 1 key"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.strip().lower()
+        return value or None
+    return value
+
+
+def make_report_key(
+    intent: str,
+    brand: Optional[str] = None,
+    month: Optional[int] = None,
+    week: Optional[Any] = None,
+    report_type: Optional[str] = None,
+    nhan_su: Optional[str] = None,
+    **extra: Any
+) -> Tuple:
+    """
+    Tạo cache key từ tham số intent đã chuẩn hoá
+
+    extra: các tham số ảnh hưởng tới kết quả (group_by, product_filter, start_date...)
+    """
+    extra_items = tuple(sorted(
+        (k, _normalize_param(v)) for k, v in extra.items() if v is not None
+    ))
+    return (
+        intent,
+        _normalize_param(brand),
+        month,
+        _normalize_param(week),
+        _normalize_param(report_type),
+        _normalize_param(nhan_su),
+        extra_items,
+    )
+
+
+@dataclass
+class CacheEntry:
+    """Một kết quả báo cáo đã cache"""
+    key: Tuple
+    summary: Any
+    text: str
+    tables: FrozenSet[str]
+    created_at: float
+    expires_at: float
+    hits: int = 0
+    # Thời điểm dữ liệu gốc được lấy từ Lark (cũ hơn created_at nếu build từ summary cũ)
+    data_at: float = 0.0
+    # True nếu được build từ summary đang stale
+    stale: bool = False
+    # True nếu là kết quả cũ trả thay vì lỗi khi gọi Lark thất bại (không lưu vào cache)
+    upstream_failed: bool = False
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.created_at
+
+    @property
+    def data_age(self) -> float:
+        return time.time() - (self.data_at or self.created_at)
+
+    def is_fresh(self, now: Optional[float] = None) -> bool:
+        return (now or time.time()) < self.expires_at
+
+
+class ReportCache:
+    """
+    LRU cache cho kết quả báo cáo
+    Mỗi entry ghi nhớ các table_id nó phụ thuộc để invalidate khi bảng thay đổi
+    """
+
+    def __init__(self, max_entries: int = REPORT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple, CacheEntry]" = OrderedDict()
+        self._by_table: Dict[str, set] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.stale_hits = 0
+        self.fallbacks = 0
+        self.revalidations = 0
+
+    def get(self, key: Tuple) -> Optional[CacheEntry]:
+        """Lấy entry còn hạn (None nếu không có hoặc đã hết hạn)"""
+        entry = self._entries.get(key)
+        if entry is None or not entry.is_fresh():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        entry.hits += 1
+        self.hits += 1
+        return entry
+
+    def get_stale(self, key: Tuple, max_age: Optional[float] = None) -> Optional[CacheEntry]:
+        """
+        Lấy entry đã hết hạn nhưng vẫn còn trong cache
+        max_age: chỉ trả về nếu tuổi dữ liệu <= max_age (None = không giới hạn)
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if max_age is not None and entry.data_age > max_age:
+            return None
+        entry.hits += 1
+        self.stale_hits += 1
+        return entry
+
+    def peek(self, key: Tuple) -> Optional[CacheEntry]:
+        """Như get() nhưng không tính vào hits/misses và không đổi thứ tự LRU"""
+        entry = self._entries.get(key)
+        if entry is None or not entry.is_fresh():
+            return None
+        return entry
+
+    def set(
+        self,
+        key: Tuple,
+        summary: Any,
+        text: str,
+        tables: Iterable[str] = (),
+        ttl: Optional[int] = None,
+        data_at: Optional[float] = None,
+        stale: bool = False
+    ) -> CacheEntry:
+        """Lưu kết quả vào cache"""
+        if ttl is None:
+            ttl = INTENT_TTLS.get(key[0], REPORT_CACHE_TTL)
+        now = time.time()
+        entry = CacheEntry(
+            key=key,
+            summary=summary,
+            text=text,
+            tables=frozenset(t for t in tables if t),
+            created_at=now,
+            expires_at=now + ttl,
+            data_at=data_at or now,
+            stale=stale,
+        )
+        self._remove(key)
+        self._entries[key] = entry
+        for table_id in entry.tables:
+            self._by_table.setdefault(table_id, set()).add(key)
+
+        while len(self._entries) > self.max_entries:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+
+        return entry
+
+    def _remove(self, key: Tuple) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        for table_id in entry.tables:
+            keys = self._by_table.get(table_id)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._by_table[table_id]
+        return True
+
+    def invalidate(self, key: Tuple) -> bool:
+        removed = self._remove(key)
+        if removed:
+            self.invalidations += 1
+        return removed
+
+    def invalidate_table(self, table_id: str) -> int:
+        """Xoá mọi entry phụ thuộc vào bảng table_id"""
+        keys = list(self._by_table.get(table_id, ()))
+        for key in keys:
+            self._remove(key)
+        self.invalidations += len(keys)
+        if keys:
+            print(f"🧹 Report cache: invalidated {len(keys)} entries for table {table_id}")
+        return len(keys)
+
+    def clear(self) -> int:
+        count = len(self._entries)
+        self._entries.clear()
+        self._by_table.clear()
+        self.invalidations += count
+        return count
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total * 100, 1) if total else 0,
+            "invalidations": self.invalidations,
+            "stale_hits": self.stale_hits,
+            "fallbacks": self.fallbacks,
+            "revalidations": self.revalidations,
+            "tables_tracked": len(self._by_table),
+        }
+
+
+_report_cache = ReportCache()
+
+
+def get_report_cache() -> ReportCache:
+    return _report_cache
+
+
+# Theo dõi dữ liệu gốc khi build 1 entry từ các entry khác (report text ← summary)
+_data_trace: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("report_data_trace", default=None)
+# True khi đang chạy trong lượt refresh nền → entry bên trong phải lấy dữ liệu mới
+_revalidating: contextvars.ContextVar[bool] = contextvars.ContextVar("report_revalidating", default=False)
+# Các key đang được refresh nền (tránh refresh trùng)
+_revalidating_keys: set = set()
+
+
+def _trace(entry: CacheEntry, stale: bool):
+    """Ghi nhận entry vừa dùng vào entry đang được build ở tầng ngoài (nếu có)"""
+    trace = _data_trace.get()
+    if trace is None:
+        return
+    data_at = entry.data_at or entry.created_at
+    trace["data_at"] = min(trace["data_at"], data_at)
+    trace["stale"] = trace["stale"] or stale or entry.stale
+    trace["upstream_failed"] = trace["upstream_failed"] or entry.upstream_failed
+
+
+async def _compute_and_store(key, compute, tables, ttl) -> CacheEntry:
+    trace = {"data_at": time.time(), "stale": False, "upstream_failed": False}
+    token = _data_trace.set(trace)
+    try:
+        summary, text = await compute()
+    finally:
+        _data_trace.reset(token)
+    if trace["stale"]:
+        # Build từ summary cũ → không giữ lâu, lượt sau sẽ refresh lại
+        ttl = 0
+    entry = get_report_cache().set(key, summary, text, tables=tables, ttl=ttl,
+                                   data_at=trace["data_at"], stale=trace["stale"])
+    if trace["upstream_failed"]:
+        entry = replace(entry, upstream_failed=True)
+    return entry
+
+
+async def _revalidate(key, compute, tables, ttl):
+    """Refresh nền 1 entry stale"""
+    _revalidating.set(True)
+    cache = get_report_cache()
+    try:
+        await _compute_and_store(key, compute, tables, ttl)
+        cache.revalidations += 1
+        print(f"🔄 Report cache revalidated: {key[0]}")
+    except Exception as e:
+        print(f"⚠️ Report cache revalidate failed for {key[0]}: {e}")
+    finally:
+        _revalidating_keys.discard(key)
+
+
+async def get_or_compute_report(
+    key: Tuple,
+    compute: Callable[[], Awaitable[Tuple[Any, str]]],
+    tables: Iterable[str] = (),
+    force_refresh: bool = False,
+    ttl: Optional[int] = None
+) -> CacheEntry:
+    """
+    Trả về entry từ cache, hoặc chạy compute() -> (summary, text) rồi lưu lại
+
+    force_refresh=True: bỏ qua cache (user gõ "làm mới")
+    Entry hết hạn nhưng chưa quá REPORT_CACHE_MAX_STALE → trả ngay + refresh nền
+    compute() lỗi → trả entry cũ (nếu còn) thay vì raise
+    """
+    cache = get_report_cache()
+    revalidating = _revalidating.get()
+
+    if not force_refresh:
+        entry = cache.get(key)
+        if entry is not None:
+            print(f"⚡ Report cache HIT: {key[0]} (age {entry.age:.0f}s)")
+            _trace(entry, stale=False)
+            return entry
+
+        if not revalidating:
+            entry = cache.get_stale(key, max_age=REPORT_CACHE_MAX_STALE)
+            if entry is not None:
+                print(f"♻️ Report cache STALE: {key[0]} (data age {entry.data_age:.0f}s), refreshing in background")
+                if key not in _revalidating_keys:
+                    _revalidating_keys.add(key)
+                    asyncio.create_task(_revalidate(key, compute, tables, ttl))
+                _trace(entry, stale=True)
+                return entry
+
+    try:
+        entry = await _compute_and_store(key, compute, tables, ttl)
+    except Exception as e:
+        fallback = cache.get_stale(key)
+        if fallback is None:
+            raise
+        cache.fallbacks += 1
+        print(f"⚠️ Upstream failed for {key[0]} ({e}), serving stale result (data age {fallback.data_age:.0f}s)")
+        fallback = replace(fallback, upstream_failed=True)
+        _trace(fallback, stale=True)
+        return fallback
+
+    _trace(entry, stale=False)
+    return entry
+
+
+def format_data_age_note(entry: CacheEntry) -> str:
+    """Ghi chú tuổi dữ liệu cho reply khi trả kết quả cũ ("" nếu dữ liệu mới)"""
+    if entry.is_fresh() and not entry.stale:
+        return ""
+    minutes = int(entry.data_age // 60)
+    age_text = f"{minutes} phút" if minutes else f"{int(entry.data_age)} giây"
+    if entry.upstream_failed:
+        return f"\n\n🕒 Dữ liệu cập nhật cách đây {age_text} - Lark đang phản hồi chậm, số liệu có thể chưa mới nhất"
+    return f"\n\n🕒 Dữ liệu cập nhật cách đây {age_text}"
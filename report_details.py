@@ -0,0 +1,132 @@
+"""
+Report Details Module
+Tách danh sách record chi tiết ra khỏi summary, lấy lại khi cần (lazy drill-down)
+Version 5.9.0
+
+- Summary chỉ giữ số liệu tổng hợp + 1 DetailHandle
+- Record chi tiết nằm trong store riêng: hết DETAIL_CACHE_TTL là bị xoá ngay (không nằm chờ LRU
+  của report cache), tối đa DETAIL_CACHE_MAX_ENTRIES bộ, invalidate theo bảng như summary
+- Hết hạn / bị xoá → load_details() chạy lại hàm tổng hợp đã đăng ký để lấy lại
+"""
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, Iterable, Optional, Tuple
+
+from report_cache import make_report_key
+
+# ============ CONFIG ============
+DETAIL_CACHE_TTL = int(os.getenv("DETAIL_CACHE_TTL", "120"))
+DETAIL_CACHE_MAX_ENTRIES = int(os.getenv("DETAIL_CACHE_MAX_ENTRIES", "16"))
+
+DETAIL_PREFIX = "DETAIL:"
+
+# kind → hàm tổng hợp (gọi lại với đúng params sẽ lưu lại details)
+_loaders: Dict[str, Callable[..., Awaitable[Any]]] = {}
+
+
+@dataclass(frozen=True)
+class DetailHandle:
+    """Tham chiếu tới record chi tiết của 1 summary"""
+    kind: str
+    params: Tuple[Tuple[str, Any], ...]
+
+    @property
+    def key(self) -> Tuple:
+        return make_report_key(DETAIL_PREFIX + self.kind, **dict(self.params))
+
+
+class DetailStore:
+    """
+    Record chi tiết theo key, mỗi bộ sống `ttl` giây kể từ lần lưu
+
+    OrderedDict theo thời điểm lưu → bộ hết hạn luôn nằm đầu dict, dọn bằng popitem từ đầu
+    """
+
+    def __init__(self, ttl: float = DETAIL_CACHE_TTL, max_entries: int = DETAIL_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[Tuple, Tuple[float, FrozenSet[str], Dict[str, Any]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def _expire(self, now: float):
+        while self._entries:
+            expires_at = next(iter(self._entries.values()))[0]
+            if expires_at > now:
+                break
+            self._entries.popitem(last=False)
+            self.expired += 1
+
+    def set(self, key: Tuple, details: Dict[str, Any], tables: Iterable[str] = ()):
+        now = time.time()
+        self._expire(now)
+        self._entries[key] = (now + self.ttl, frozenset(tables), details)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evicted += 1
+
+    def get(self, key: Tuple) -> Optional[Dict[str, Any]]:
+        self._expire(time.time())
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[2]
+
+    def invalidate_table(self, table_id: str) -> int:
+        """Xoá mọi bộ chi tiết phụ thuộc vào bảng table_id"""
+        keys = [key for key, (_, tables, _) in self._entries.items() if table_id in tables]
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        self._expire(time.time())
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+
+_detail_store = DetailStore()
+
+
+def get_detail_store() -> DetailStore:
+    return _detail_store
+
+
+def register_detail_loader(kind: str, loader: Callable[..., Awaitable[Any]]):
+    _loaders[kind] = loader
+
+
+def store_details(kind: str, details: Dict[str, Any], tables: Iterable[str] = (), **params: Any) -> DetailHandle:
+    """Lưu record chi tiết vào detail store, trả về handle để gắn vào summary"""
+    handle = DetailHandle(kind=kind, params=tuple(sorted(params.items())))
+    _detail_store.set(handle.key, details, tables=tables)
+    return handle
+
+
+async def load_details(handle: Optional[DetailHandle]) -> Dict[str, Any]:
+    """Lấy record chi tiết theo handle (tính lại nếu đã hết hạn)"""
+    if handle is None:
+        return {}
+    details = _detail_store.get(handle.key)
+    if details is None:
+        loader = _loaders.get(handle.kind)
+        if loader is None:
+            return {}
+        print(f"🔎 Details '{handle.kind}' expired, reloading...")
+        await loader(**dict(handle.params))
+        details = _detail_store.get(handle.key)
+    return details or {}
@@ -6,15 +6,87 @@
 # - chat_with_gpt
 
 import os
+import json
+import hashlib
 import logging
+import functools
+import inspect
+from collections import OrderedDict
 from typing import Dict, Any, List, Optional
 from datetime import datetime
 
+from week_breakdown import week_over_week
+
 logger = logging.getLogger(__name__)
 
 # OpenAI config
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 
+# v5.9.0: Render cache - đổi FORMATTER_VERSION khi sửa format báo cáo để bỏ cache cũ
+FORMATTER_VERSION = "5.9.0"
+RENDER_CACHE_MAX_ENTRIES = int(os.getenv("RENDER_CACHE_MAX_ENTRIES", "128"))
+
+_render_cache: "OrderedDict[tuple, str]" = OrderedDict()
+_render_stats = {"hits": 0, "misses": 0}
+
+
+def summary_content_hash(summary: Any) -> str:
+    """Hash ổn định của nội dung summary (không phụ thuộc thứ tự key)"""
+    payload = json.dumps(summary, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def render_cached(func):
+    """
+    Cache text đã render theo (hàm, hash nội dung summary, tham số, FORMATTER_VERSION)
+    Cùng 1 summary gửi nhiều nhóm / hỏi lại → không render lại
+    """
+    signature = inspect.signature(func)
+    summary_param = next(iter(signature.parameters))
+    
+    @functools.wraps(func)
+    async def wrapper(summary, *args, **kwargs):
+        try:
+            # Chuẩn hoá tham số (positional / keyword / mặc định) → cùng 1 key
+            bound = signature.bind(summary, *args, **kwargs)
+            bound.apply_defaults()
+            params = sorted((k, v) for k, v in bound.arguments.items() if k != summary_param)
+            key = (
+                func.__name__,
+                summary_content_hash(summary),
+                json.dumps(params, ensure_ascii=False, default=str),
+                FORMATTER_VERSION,
+            )
+        except (TypeError, ValueError):
+            return await func(summary, *args, **kwargs)
+        
+        text = _render_cache.get(key)
+        if text is not None:
+            _render_cache.move_to_end(key)
+            _render_stats["hits"] += 1
+            return text
+        
+        _render_stats["misses"] += 1
+        text = await func(summary, *args, **kwargs)
+        _render_cache[key] = text
+        while len(_render_cache) > RENDER_CACHE_MAX_ENTRIES:
+            _render_cache.popitem(last=False)
+        return text
+    
+    return wrapper
+
+
+def get_render_cache_stats() -> Dict[str, Any]:
+    total = _render_stats["hits"] + _render_stats["misses"]
+    return {
+        "entries": len(_render_cache),
+        "max_entries": RENDER_CACHE_MAX_ENTRIES,
+        "hits": _render_stats["hits"],
+        "misses": _render_stats["misses"],
+        "hit_rate": round(_render_stats["hits"] / total * 100, 1) if total else 0,
+        "formatter_version": FORMATTER_VERSION,
+    }
+
 # ============================================================================
 # FORMATTING UTILITIES
 # ============================================================================
@@ -108,6 +180,7 @@ async def chat_with_gpt(question: str) -> str:
 # KALLE REPORTS
 # ============================================================================
 
+@render_cached
 async def generate_koc_report_text(summary: Dict[str, Any]) -> str:
     """
     Generate KPI report text for KALLE
@@ -165,6 +238,7 @@ async def generate_koc_report_text(summary: Dict[str, Any]) -> str:
     return "\n".join(lines)
 
 
+@render_cached
 async def generate_dashboard_report_text(
     data: Dict[str, Any],
     report_type: str = "full",
@@ -175,12 +249,13 @@ async def generate_dashboard_report_text(
     """
     month = data.get("month", datetime.now().month)
     brand = data.get("brand", "KALLE")
+    # v5.9.0: %, tiến độ, trạng thái, cảnh báo đã tính sẵn trong kpi_vector
     staff_list = data.get("staff_list", [])
     totals = data.get("totals", {})
     
     # Filter by staff if specified
     if nhan_su_filter:
-        staff_list = [s for s in staff_list if nhan_su_filter.lower() in s.get("name", "").lower()]
+        staff_list = [s for s in staff_list if nhan_su_filter.lower() in (s.get("name") or "").lower()]
         
         if staff_list:
             staff = staff_list[0]
@@ -196,20 +271,8 @@ async def generate_dashboard_report_text(
                 if content_parts:
                     content_text = " và ".join(content_parts[:5])  # Limit to 5 items
             
-            # Calculate progress and status
-            video_percent = staff.get('video_percent', 0)
-            budget_percent = staff.get('budget_percent', 0)
-            avg_percent = (video_percent + budget_percent) / 2 if (video_percent + budget_percent) > 0 else 0
-            
-            # Determine status
-            if avg_percent >= 100:
-                status = "🟢 Đạt"
-            elif avg_percent >= 80:
-                status = "🟢 Gần đạt"
-            elif avg_percent >= 50:
-                status = "🟡 Đang tiến hành"
-            else:
-                status = "🔴 Cần cố gắng"
+            avg_percent = staff.get("progress", 0)
+            status = staff.get("status", "")
             
             lines = [
                 f"🧴 **KPI CÁ NHÂN - {brand}**",
@@ -224,6 +287,7 @@ async def generate_dashboard_report_text(
                 f"   • KPI: {staff.get('video_kpi', 0)} video",
                 f"   • Đã air: {staff.get('video_done', 0)} video",
                 f"   • Tỷ lệ: **{staff.get('video_percent', 0)}%**",
+                f"   • Còn thiếu: {staff.get('video_remaining', 0)} video",
             ]
             
             # Add content breakdown if available
@@ -300,16 +364,8 @@ async def generate_dashboard_report_text(
             else:
                 content_text = ", ".join(content_parts[:2]) + f" và {len(sorted_content) - 2} loại khác"
         
-        # Calculate status
-        avg_percent = (total_video_percent + total_budget_percent) / 2 if (total_video_percent + total_budget_percent) > 0 else 0
-        if avg_percent >= 100:
-            status = "🟢 Đạt"
-        elif avg_percent >= 80:
-            status = "🟢 Gần đạt"
-        elif avg_percent >= 50:
-            status = "🟡 Đang tiến hành"
-        else:
-            status = "🔴 Cần cố gắng"
+        avg_percent = totals.get("progress", 0)
+        status = totals.get("status", "")
         
         # Aggregate contact info
         total_contact = sum(s.get("contact_total", 0) for s in staff_list)
@@ -364,19 +420,42 @@ async def generate_dashboard_report_text(
             video_done = staff.get("video_done", 0)
             video_kpi = staff.get("video_kpi", 0)
             video_percent = staff.get("video_percent", 0)
-            
-            # Status icon
-            if video_percent >= 100:
-                icon = "🟢"
-            elif video_percent >= 80:
-                icon = "🟡"
-            else:
-                icon = "🔴"
+            icon = staff.get("icon", "")
             
             lines.append(f"   {icon} {name}: {video_done}/{video_kpi} ({video_percent}%)")
         
         return "\n".join(lines)
     
+    # v5.9.0: Cảnh báo - nhân sự có tiến độ dưới ngưỡng
+    if report_type == "canh_bao":
+        warned = [s for s in staff_list if s.get("canh_bao")]
+        lines = [
+            f"⚠️ **CẢNH BÁO KPI - {brand}**",
+            "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━",
+            f"📅 Tháng {month}",
+            "",
+        ]
+        if not warned:
+            lines.append("✅ Không có nhân sự nào dưới ngưỡng cảnh báo.")
+            return "\n".join(lines)
+        
+        lines.append(f"🔴 **{len(warned)}/{len(staff_list)} nhân sự cần chú ý:**")
+        lines.append("")
+        for staff in warned:
+            lines.append(f"👤 **{staff.get('name', 'Unknown')}** - {staff.get('status', '')}")
+            lines.append(
+                f"   📦 Video: {staff.get('video_done', 0)}/{staff.get('video_kpi', 0)} "
+                f"({staff.get('video_percent', 0)}%) - còn thiếu {staff.get('video_remaining', 0)}"
+            )
+            lines.append(
+                f"   💰 Ngân sách: {format_number_vn(staff.get('budget_done', 0))}/{format_number_vn(staff.get('budget_kpi', 0))} "
+                f"({staff.get('budget_percent', 0)}%)"
+            )
+            lines.append(f"   {generate_progress_bar(staff.get('progress', 0), 8)} {staff.get('progress', 0)}%")
+            lines.append("")
+        
+        return "\n".join(lines)
+    
     # Full dashboard report
     lines = [
         f"📊 **DASHBOARD {brand} - Tháng {month}**",
@@ -427,6 +506,7 @@ async def generate_dashboard_report_text(
 # CHENG REPORTS
 # ============================================================================
 
+@render_cached
 async def generate_cheng_report_text(
     summary: Dict[str, Any],
     report_type: str = "full",
@@ -735,6 +815,193 @@ async def generate_general_summary_text(
     return "\n".join(lines)
 
 
+# ============================================================================
+# TREND REPORT (v5.9.0) - đọc từ lịch sử KPI cục bộ
+# ============================================================================
+
+def _trend_arrow(current: float, previous: Optional[float]) -> str:
+    if previous is None:
+        return ""
+    if current > previous:
+        return " ⬆️"
+    if current < previous:
+        return " ⬇️"
+    return " ➡️"
+
+
+async def generate_trend_report_text(trend: Dict[str, Any]) -> str:
+    """
+    Generate multi-month KPI trend report
+    Required by main.py for INTENT_TREND
+    """
+    brand = trend.get("brand", "KALLE")
+    nhan_su = trend.get("nhan_su")
+    periods = trend.get("periods", [])
+    missing = trend.get("missing", [])
+    start_year, start_month = trend.get("start", (None, None))
+    end_year, end_month = trend.get("end", (None, None))
+    
+    title = f"📈 **XU HƯỚNG KPI - {brand}**"
+    if nhan_su:
+        title += f" - {nhan_su}"
+    
+    lines = [
+        title,
+        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━",
+        f"📅 Từ {start_month}/{start_year} đến {end_month}/{end_year}",
+        "",
+    ]
+    
+    if not periods:
+        lines.append("📭 Chưa có dữ liệu lịch sử cho khoảng thời gian này.")
+        lines.append("💡 Lịch sử được lưu khi chốt tháng (đầu mỗi tháng).")
+        return "\n".join(lines)
+    
+    prev = None
+    for p in periods:
+        marker = "" if p.get("closed") else " (đang chạy)"
+        lines.append(f"🗓️ **Tháng {p['month']}/{p['year']}**{marker}")
+        lines.append(
+            f"   🎬 Video: {p['so_luong_air']}/{p['kpi_so_luong']} "
+            f"({p['pct_kpi_so_luong']}%){_trend_arrow(p['pct_kpi_so_luong'], prev and prev['pct_kpi_so_luong'])}"
+        )
+        lines.append(
+            f"   💰 Ngân sách: {format_number_vn(p['ngan_sach_air'])}/{format_number_vn(p['kpi_ngan_sach'])} "
+            f"({p['pct_kpi_ngan_sach']}%)"
+        )
+        if not nhan_su and p.get("gmv"):
+            lines.append(f"   🛒 GMV: {format_currency_vn(p['gmv'])}{_trend_arrow(p['gmv'], prev and prev['gmv'])}")
+        lines.append(f"   {generate_progress_bar(p['pct_kpi_so_luong'])}")
+        lines.append("")
+        prev = p
+    
+    if len(periods) >= 2:
+        avg_pct = sum(p["pct_kpi_so_luong"] for p in periods) / len(periods)
+        best = max(periods, key=lambda p: p["pct_kpi_so_luong"])
+        lines.extend([
+            "───────────────────────────",
+            f"📊 TB % KPI video: {avg_pct:.1f}%",
+            f"🏆 Tháng tốt nhất: {best['month']}/{best['year']} ({best['pct_kpi_so_luong']}%)",
+        ])
+    
+    if missing:
+        missing_text = ", ".join(f"{m}/{y}" for y, m in missing)
+        lines.append(f"⚠️ Chưa có dữ liệu: {missing_text}")
+    
+    return "\n".join(lines)
+
+
+def _delta_text(delta_pct: Optional[float]) -> str:
+    if delta_pct is None:
+        return ""
+    sign = "+" if delta_pct >= 0 else ""
+    return f" ({sign}{delta_pct}% so với tuần trước)"
+
+
+@render_cached
+async def generate_week_breakdown_text(breakdown: Dict[str, Any], week: Optional[int] = None) -> str:
+    """
+    Generate week-by-week report (hoặc 1 tuần + so sánh tuần trước)
+    Required by main.py for report_type "theo_tuan"
+    """
+    brand = breakdown.get("brand", "KALLE")
+    month = breakdown.get("month")
+    rows = week_over_week(breakdown)
+    totals = breakdown.get("month_totals", {})
+    
+    if week:
+        rows = [r for r in rows if r["week"] == week]
+        if not rows:
+            return f"📭 Chưa có dữ liệu tuần {week} tháng {month} ({brand})."
+    
+    lines = [
+        f"📆 **{brand} - TỪNG TUẦN THÁNG {month}**" if not week else f"📆 **{brand} - TUẦN {week} THÁNG {month}**",
+        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━",
+        "",
+    ]
+    
+    if not rows:
+        lines.append("📭 Chưa có dữ liệu theo tuần cho tháng này.")
+        return "\n".join(lines)
+    
+    weeks = breakdown.get("weeks", {})
+    for r in rows:
+        bucket = weeks.get(r["week"], {})
+        lines.append(f"🗓️ **Tuần {r['week']}**")
+        lines.append(f"   🛒 GMV: {format_currency_vn(r['gmv'])}{_delta_text(r['gmv_delta_pct'])}")
+        lines.append(f"   🎬 Video có doanh thu: {r['so_video']}{_delta_text(r['so_video_delta_pct'])}")
+        if r["tong_lien_he"]:
+            lines.append(
+                f"   📞 Liên hệ: {r['tong_lien_he']} - deal {r['da_deal']} ({bucket.get('ty_le_deal', 0)}%)"
+                f"{_delta_text(r['tong_lien_he_delta_pct'])}"
+            )
+        top_koc = bucket.get("top_koc") or []
+        if top_koc:
+            id_kenh, gmv = top_koc[0]
+            lines.append(f"   🏆 Top KOC: {id_kenh} ({format_currency_vn(gmv)})")
+        lines.append("")
+    
+    if not week:
+        lines.extend([
+            "───────────────────────────",
+            f"📊 **Cả tháng:** GMV {format_currency_vn(totals.get('gmv', 0))} | "
+            f"{totals.get('so_video', 0)} video | {totals.get('tong_lien_he', 0)} liên hệ",
+        ])
+    
+    return "\n".join(lines)
+
+
+async def generate_koc_channel_text(channel_data: Optional[Dict[str, Any]], query: str = "",
+                                    candidates: Optional[List[str]] = None) -> str:
+    """
+    Generate GMV report of 1 KOC channel across months
+    Required by main.py for INTENT_KOC_CHANNEL
+    """
+    if not channel_data:
+        lines = [f"📭 Không tìm thấy doanh thu của kênh **{query}**."]
+        if candidates:
+            lines.append("💡 Có phải bạn muốn hỏi: " + ", ".join(candidates))
+        return "\n".join(lines)
+    
+    months = channel_data.get("months", [])
+    best = channel_data.get("best_month", {})
+    lines = [
+        f"🎥 **KÊNH KOC: {channel_data.get('channel')}**",
+        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━",
+        f"🛒 Tổng GMV: **{format_currency_vn(channel_data.get('total_gmv', 0))}** "
+        f"({channel_data.get('share', 0)}% GMV KOC cùng kỳ)",
+        f"🏆 Tháng tốt nhất: {best.get('month')} ({best.get('brand')}) - {format_currency_vn(best.get('gmv', 0))}",
+        "",
+    ]
+    for m in months:
+        lines.append(
+            f"🗓️ Tháng {m['month']} ({m['brand']}): {format_currency_vn(m['gmv'])} "
+            f"| {m['videos']} video | {m['share']}%"
+        )
+    return "\n".join(lines)
+
+
+async def generate_top_koc_range_text(top_koc: List, brand: str, start_month: int, end_month: int) -> str:
+    """
+    Generate top KOC report over a month range
+    Required by main.py for report_type "top_koc_range"
+    """
+    lines = [
+        f"🏆 **TOP KOC {brand} - THÁNG {start_month} → {end_month}**",
+        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━",
+        "",
+    ]
+    if not top_koc:
+        lines.append("📭 Chưa có dữ liệu doanh thu KOC cho khoảng tháng này.")
+        return "\n".join(lines)
+    
+    medals = ["🥇", "🥈", "🥉"]
+    for i, (id_kenh, gmv) in enumerate(top_koc):
+        icon = medals[i] if i < len(medals) else f"{i + 1}."
+        lines.append(f"{icon} {id_kenh}: {format_currency_vn(gmv)}")
+    return "\n".join(lines)
+
+
 # ============================================================================
 # CONTENT DETAIL REPORT
 # ============================================================================
@@ -789,6 +1056,18 @@ def generate_content_detail_report(
     return "\n".join(lines)
 
 
+def generate_content_detail_report_from_summary(
+    summary: Dict[str, Any],
+    month: int = None,
+    brand: str = "KALLE"
+) -> str:
+    """v5.9.0: Chi tiết content từ content_breakdown của từng nhân sự trong staff_list"""
+    content_breakdown = {
+        s.get("name"): s.get("content_breakdown", {}) for s in summary.get("staff_list", [])
+    }
+    return generate_content_detail_report(content_breakdown, month=month or summary.get("month"), brand=brand)
+
+
 # ============================================================================
 # GENERIC REPORT DISPATCHER
 # ============================================================================
@@ -0,0 +1,138 @@
+"""
+Report Runs Module
+Checkpoint cho các lượt gửi báo cáo định kỳ: mỗi lượt khoá theo (ngày, job)
+Version 5.9.0
+
+- Tin đã soạn (số liệu đã tính) + trạng thái gửi từng người nhận lưu trong SQLite cục bộ
+- Container restart / chạy lại tay → chỉ gửi tiếp người chưa nhận, không tính lại, không gửi trùng
+- Lượt đã hoàn tất thì bỏ qua (trừ khi force)
+"""
+import json
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from local_store import get_connection
+from lark_messenger import OutgoingMessage
+
+_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS report_runs (
+        run_date TEXT NOT NULL,
+        job TEXT NOT NULL,
+        status TEXT NOT NULL,
+        payload TEXT,
+        created_at REAL,
+        updated_at REAL,
+        PRIMARY KEY (run_date, job)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS report_deliveries (
+        run_date TEXT NOT NULL,
+        job TEXT NOT NULL,
+        recipient TEXT NOT NULL,
+        receive_id_type TEXT NOT NULL,
+        label TEXT,
+        message TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER DEFAULT 0,
+        message_id TEXT,
+        error TEXT,
+        updated_at REAL,
+        PRIMARY KEY (run_date, job, recipient)
+    )
+    """,
+)
+
+RUN_SENDING = "sending"
+RUN_COMPLETED = "completed"
+
+
+def _db():
+    conn = get_connection("report_runs")
+    for statement in _SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+def get_run(run_date: str, job: str) -> Optional[Dict[str, Any]]:
+    """Lượt chạy đã lưu (+ payload, đếm trạng thái gửi) hoặc None"""
+    conn = _db()
+    row = conn.execute(
+        "SELECT * FROM report_runs WHERE run_date=? AND job=?", (run_date, job)
+    ).fetchone()
+    if row is None:
+        return None
+    counts = dict(conn.execute(
+        "SELECT status, COUNT(*) FROM report_deliveries WHERE run_date=? AND job=? GROUP BY status",
+        (run_date, job)
+    ).fetchall())
+    return {
+        "run_date": run_date,
+        "job": job,
+        "status": row["status"],
+        "payload": json.loads(row["payload"]) if row["payload"] else None,
+        "deliveries": counts,
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+    }
+
+
+def save_run(run_date: str, job: str, messages: Iterable[OutgoingMessage], payload: Any = None):
+    """Lưu checkpoint 1 lượt mới: số liệu đã tính + toàn bộ tin cần gửi (trạng thái pending)"""
+    now = time.time()
+    conn = _db()
+    with conn:
+        conn.execute("DELETE FROM report_deliveries WHERE run_date=? AND job=?", (run_date, job))
+        conn.execute(
+            "INSERT OR REPLACE INTO report_runs (run_date, job, status, payload, created_at, updated_at) "
+            "VALUES (?,?,?,?,?,?)",
+            (run_date, job, RUN_SENDING, json.dumps(payload, ensure_ascii=False, default=str), now, now)
+        )
+        conn.executemany(
+            "INSERT INTO report_deliveries (run_date, job, recipient, receive_id_type, label, message, seq, "
+            "updated_at) VALUES (?,?,?,?,?,?,?,?)",
+            [(run_date, job, m.receive_id, m.receive_id_type, m.label, m.text, seq, now)
+             for seq, m in enumerate(messages)]
+        )
+
+
+def pending_messages(run_date: str, job: str) -> List[OutgoingMessage]:
+    """Các tin chưa gửi được (pending / failed) của 1 lượt, theo thứ tự ban đầu"""
+    rows = _db().execute(
+        "SELECT recipient, receive_id_type, label, message FROM report_deliveries "
+        "WHERE run_date=? AND job=? AND status != 'sent' ORDER BY seq",
+        (run_date, job)
+    ).fetchall()
+    return [OutgoingMessage(r["recipient"], r["message"], r["receive_id_type"], r["label"] or "") for r in rows]
+
+
+def record_results(run_date: str, job: str, results: Iterable[Dict[str, Any]]):
+    """Ghi kết quả gửi (results của fan_out_messages) → người đã nhận không bị gửi lại"""
+    now = time.time()
+    conn = _db()
+    with conn:
+        conn.executemany(
+            "UPDATE report_deliveries SET status=?, attempts=attempts+?, message_id=?, error=?, updated_at=? "
+            "WHERE run_date=? AND job=? AND recipient=?",
+            [("sent" if r["ok"] else "failed", r["attempts"], r.get("message_id"), r.get("error"), now,
+              run_date, job, r["receive_id"]) for r in results]
+        )
+        remaining = conn.execute(
+            "SELECT COUNT(*) FROM report_deliveries WHERE run_date=? AND job=? AND status != 'sent'",
+            (run_date, job)
+        ).fetchone()[0]
+        conn.execute(
+            "UPDATE report_runs SET status=?, updated_at=? WHERE run_date=? AND job=?",
+            (RUN_SENDING if remaining else RUN_COMPLETED, now, run_date, job)
+        )
+
+
+def incomplete_runs(job: str, since: str) -> List[str]:
+    """Ngày (run_date >= since) của các lượt chưa gửi xong"""
+    rows = _db().execute(
+        "SELECT run_date FROM report_runs WHERE job=? AND status=? AND run_date >= ? ORDER BY run_date",
+        (job, RUN_SENDING, since)
+    ).fetchall()
+    return [r["run_date"] for r in rows]
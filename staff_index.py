@@ -0,0 +1,167 @@
+"""
+Staff Alias Index Module
+Index tên nhân sự → staff ID, build 1 lần từ config
+Version 5.9.0
+
+Mỗi nhân sự được index theo:
+- Tên đầy đủ (lowercase), tên gốc (bỏ " - PR Booking", bỏ "(vịt)"), bản không dấu
+- Biệt danh: short_name, phần trong ngoặc, "aliases" trong config
+- Token (từng từ) → khớp khi có >= 2 từ chung
+- Trigram → khớp gần đúng khi các cách trên đều không ra
+Kết quả resolve được nhớ lại (tối đa RESOLVE_CACHE_MAX tên) nên mỗi tên chỉ phải phân tích 1 lần.
+"""
+import re
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+# Ngưỡng Jaccard trigram để coi là cùng 1 người
+TRIGRAM_THRESHOLD = 0.6
+
+# Số tên đã resolve được nhớ lại (tên lấy từ dữ liệu Lark nên không giới hạn sẵn)
+RESOLVE_CACHE_MAX = 4096
+
+_PAREN_RE = re.compile(r'\s*\(([^)]*)\)')
+_SPACE_RE = re.compile(r'\s+')
+
+
+def strip_diacritics(text: str) -> str:
+    """Bỏ dấu tiếng Việt: "Thuỳ Dương" → "Thuy Duong" """
+    text = text.replace("đ", "d").replace("Đ", "D")
+    decomposed = unicodedata.normalize("NFD", text)
+    return "".join(c for c in decomposed if unicodedata.category(c) != "Mn")
+
+
+def base_name(name: str) -> str:
+    """Tên gốc: bỏ phần sau " - ", bỏ phần trong ngoặc, lowercase"""
+    name = name.split(" - ")[0]
+    name = _PAREN_RE.sub("", name)
+    return _SPACE_RE.sub(" ", name).strip().lower()
+
+
+def _trigrams(text: str) -> Set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class StaffAliasIndex:
+    """
+    staff: Dict[staff_id, {"name", "dashboard_names", "short_name", "aliases"?}]
+    """
+
+    def __init__(self, staff: Dict[str, Dict]):
+        self.staff = staff
+        self._exact: Dict[str, str] = {}
+        self._tokens: Dict[str, Set[str]] = {}
+        self._trigrams: Dict[str, Set[str]] = {}
+        self._alias_trigrams: Dict[str, Set[str]] = {}
+        self._alias_owner: Dict[str, str] = {}
+        self._dashboard_exact: Dict[str, str] = {}
+        self._resolved: "OrderedDict[str, Optional[str]]" = OrderedDict()
+
+        for staff_id, info in staff.items():
+            full_names = [info.get("name", "")] + list(info.get("dashboard_names", []))
+            nicknames = [info.get("short_name", "")] + list(info.get("aliases", []))
+            for dashboard_name in info.get("dashboard_names", []):
+                self._dashboard_exact.setdefault(dashboard_name.strip().lower(), staff_id)
+
+            for full in filter(None, full_names):
+                for key in self._full_keys(full):
+                    self._exact.setdefault(key, staff_id)
+                for nick in _PAREN_RE.findall(full):
+                    nicknames.append(nick)
+
+                base = strip_diacritics(base_name(full))
+                for token in base.split():
+                    self._tokens.setdefault(token, set()).add(staff_id)
+                if base not in self._alias_owner:
+                    self._alias_owner[base] = staff_id
+                    grams = _trigrams(base)
+                    self._alias_trigrams[base] = grams
+                    for gram in grams:
+                        self._trigrams.setdefault(gram, set()).add(base)
+
+            for nick in filter(None, (n.strip().lower() for n in nicknames)):
+                self._exact.setdefault(nick, staff_id)
+                self._exact.setdefault(strip_diacritics(nick), staff_id)
+
+    @staticmethod
+    def _full_keys(name: str) -> List[str]:
+        lower = _SPACE_RE.sub(" ", name.strip().lower())
+        base = base_name(name)
+        return [lower, strip_diacritics(lower), base, strip_diacritics(base)]
+
+    def _resolve_uncached(self, name: str) -> Optional[str]:
+        # 1. Tên đầy đủ / tên gốc / không dấu / biệt danh
+        for key in self._full_keys(name):
+            staff_id = self._exact.get(key)
+            if staff_id:
+                return staff_id
+
+        base = strip_diacritics(base_name(name))
+        if not base:
+            return None
+
+        # 2. >= 2 từ chung với đúng 1 nhân sự
+        counts: Dict[str, int] = {}
+        for token in set(base.split()):
+            for staff_id in self._tokens.get(token, ()):
+                counts[staff_id] = counts.get(staff_id, 0) + 1
+        candidates = [sid for sid, c in counts.items() if c >= 2]
+        if len(candidates) == 1:
+            return candidates[0]
+
+        # 3. Trigram gần đúng
+        grams = _trigrams(base)
+        overlap: Dict[str, int] = {}
+        for gram in grams:
+            for alias in self._trigrams.get(gram, ()):
+                overlap[alias] = overlap.get(alias, 0) + 1
+        best_id, best_score = None, 0.0
+        for alias, common in overlap.items():
+            score = common / (len(grams) + len(self._alias_trigrams[alias]) - common)
+            if score > best_score:
+                best_id, best_score = self._alias_owner[alias], score
+        if best_score >= TRIGRAM_THRESHOLD:
+            return best_id
+        return None
+
+    def resolve(self, name: Optional[str]) -> Optional[str]:
+        """Staff ID của 1 tên (None nếu không nhận ra)"""
+        if not name:
+            return None
+        if name in self._resolved:
+            self._resolved.move_to_end(name)
+            return self._resolved[name]
+        staff_id = self._resolved[name] = self._resolve_uncached(name)
+        if len(self._resolved) > RESOLVE_CACHE_MAX:
+            self._resolved.popitem(last=False)
+        return staff_id
+
+    def resolve_exact(self, name: Optional[str]) -> Optional[str]:
+        """Chỉ khớp đúng 1 tên trong dashboard_names (không phân biệt hoa thường, không biệt danh / không dấu)"""
+        if not name:
+            return None
+        return self._dashboard_exact.get(name.strip().lower())
+
+    def canonical_name(self, staff_id: str) -> Optional[str]:
+        """Tên chuẩn (dashboard_names[0]) của nhân sự"""
+        info = self.staff.get(staff_id)
+        if not info:
+            return None
+        names = info.get("dashboard_names") or [info.get("name")]
+        return names[0]
+
+    def lookup(self, staff_id: str, data: Dict[str, Any]) -> Optional[Any]:
+        """Giá trị trong dict {tên: ...} thuộc về nhân sự staff_id (key đầu tiên khớp)"""
+        for key, value in data.items():
+            if self.resolve(key) == staff_id:
+                return value
+        return None
+
+    def resolve_any(self, names: Iterable[str]) -> Optional[str]:
+        for name in names:
+            staff_id = self.resolve(name)
+            if staff_id:
+                return staff_id
+        return None
@@ -0,0 +1,198 @@
+"""
+Summary Service Module
+Lấy summary dict của từng loại báo cáo qua report cache
+Version 5.9.0
+
+Các report text (full, kpi_ca_nhan, kpi_team, top_koc...) cùng dùng chung 1 summary
+→ cache ở mức summary để nhiều loại báo cáo / pre-warm dùng lại được.
+
+Summary theo tuần của KALLE / CHENG được tính trong 1 lượt quét cả tháng (shared_fetches):
+week breakdown + summary cả tháng + summary từng tuần dùng chung 1 lần fetch mỗi bảng,
+các câu hỏi tuần khác của tháng đó đọc thẳng từ cache.
+"""
+import asyncio
+from typing import Any, Dict, Optional
+
+from lark_base import (
+    shared_fetches,
+    generate_koc_summary,
+    generate_content_calendar,
+    generate_task_summary,
+    generate_dashboard_summary,
+    generate_cheng_koc_summary,
+    KALLE_KOC_TABLE_IDS,
+    KALLE_DASHBOARD_TABLE_IDS,
+    CHENG_REPORT_TABLE_IDS,
+    TASK_TABLE_IDS,
+)
+from report_cache import make_report_key, get_or_compute_report, get_report_cache
+from kpi_history import latest_year_of_month, record_current_month
+from week_breakdown import compute_week_breakdown
+
+# Prefix cho intent key của summary (phân biệt với key của report text)
+SUMMARY_PREFIX = "SUMMARY:"
+
+
+def summary_key(name: str, **params: Any):
+    """Cache key của 1 summary"""
+    return make_report_key(SUMMARY_PREFIX + name, **params)
+
+
+async def _cached_summary(name: str, compute, tables, force_refresh: bool = False,
+                          ttl: Optional[int] = None, **params) -> Dict[str, Any]:
+    async def build():
+        return await compute(), ""
+
+    entry = await get_or_compute_report(
+        summary_key(name, **params), build, tables=tables, force_refresh=force_refresh, ttl=ttl
+    )
+    return entry.summary
+
+
+def _with_history(brand: str, month, week, compute):
+    """Sau khi tính summary cả tháng hiện tại → cập nhật lịch sử KPI"""
+    async def run():
+        summary = await compute()
+        record_current_month(brand, month, week, summary)
+        return summary
+    return run
+
+
+def check_data_year(month: Optional[int], year: Optional[int]):
+    """
+    Các bảng báo cáo không có cột năm, chỉ lọc theo tháng → chỉ có số liệu của lần gần nhất
+    của tháng đó ("tuần trước" hỏi vào tháng 1 → tháng 12 năm trước là hợp lệ)
+    """
+    if month and year and year < latest_year_of_month(month):
+        raise ValueError(f"Không còn số liệu tháng {month}/{year} (bảng báo cáo chỉ giữ tháng {month} gần nhất)")
+
+
+async def _kalle_dashboard(month: Optional[int], week, force_refresh: bool, ttl: Optional[int]) -> Dict[str, Any]:
+    return await _cached_summary(
+        "kalle_dashboard",
+        _with_history("KALLE", month, week, lambda: generate_dashboard_summary(month=month, week=week)),
+        KALLE_DASHBOARD_TABLE_IDS, force_refresh, ttl,
+        brand="KALLE", month=month, week=week,
+    )
+
+
+async def _cheng_koc(month: Optional[int], week, force_refresh: bool, ttl: Optional[int]) -> Dict[str, Any]:
+    return await _cached_summary(
+        "cheng_koc",
+        _with_history("CHENG", month, week, lambda: generate_cheng_koc_summary(month=month, week=week)),
+        CHENG_REPORT_TABLE_IDS, force_refresh, ttl,
+        brand="CHENG", month=month, week=week,
+    )
+
+
+# brand → summary 1 (tháng, tuần) qua cache
+_BRAND_SUMMARY = {
+    "KALLE": _kalle_dashboard,
+    "CHENG": _cheng_koc,
+}
+
+
+async def _brand_summary(brand: str, month: Optional[int], week, force_refresh: bool,
+                         ttl: Optional[int], year: Optional[int]) -> Dict[str, Any]:
+    """
+    Summary cả tháng: tính riêng
+    Summary 1 tuần: 1 lượt quét cả tháng - week breakdown, summary cả tháng và mọi tuần
+    trong breakdown dùng chung fetch, mỗi kết quả lưu cache riêng (câu hỏi tuần sau không quét lại)
+    """
+    check_data_year(month, year)
+    summary = _BRAND_SUMMARY[brand]
+    if week is None or month is None:
+        return await summary(month, week, force_refresh, ttl)
+
+    with shared_fetches():
+        breakdown = await get_week_breakdown(brand, month, force_refresh=force_refresh, ttl=ttl)
+        weeks = sorted(set(breakdown.get("weeks", {})) | {week})
+        results = await asyncio.gather(
+            summary(month, None, force_refresh, ttl),
+            *(summary(month, w, force_refresh, ttl) for w in weeks),
+        )
+    return results[1 + weeks.index(week)]
+
+
+async def get_kalle_dashboard_summary(month: Optional[int] = None, week=None,
+                                      force_refresh: bool = False, ttl: Optional[int] = None,
+                                      year: Optional[int] = None) -> Dict[str, Any]:
+    """Dashboard KALLE (KPI nhân sự, top KOC, liên hệ, content)"""
+    return await _brand_summary("KALLE", month, week, force_refresh, ttl, year)
+
+
+async def get_cheng_summary(month: Optional[int] = None, week: Optional[int] = None,
+                            force_refresh: bool = False, ttl: Optional[int] = None,
+                            year: Optional[int] = None) -> Dict[str, Any]:
+    """Tổng hợp KOC CHENG"""
+    return await _brand_summary("CHENG", month, week, force_refresh, ttl, year)
+
+
+async def get_koc_summary(month: int, week: Optional[int] = None, group_by: str = "product",
+                          product_filter: Optional[str] = None,
+                          force_refresh: bool = False, ttl: Optional[int] = None) -> Dict[str, Any]:
+    """Tổng hợp KOC KALLE từ Booking"""
+    return await _cached_summary(
+        "kalle_koc",
+        lambda: generate_koc_summary(month=month, week=week, group_by=group_by, product_filter=product_filter),
+        KALLE_KOC_TABLE_IDS, force_refresh, ttl,
+        brand="KALLE", month=month, week=week, group_by=group_by, product_filter=product_filter,
+    )
+
+
+async def get_content_calendar_summary(start_date: Optional[str] = None, end_date: Optional[str] = None,
+                                       month: Optional[int] = None, team: Optional[str] = None,
+                                       vi_tri: Optional[str] = None,
+                                       force_refresh: bool = False, ttl: Optional[int] = None) -> Dict[str, Any]:
+    """Lịch content theo tháng hoặc khoảng ngày"""
+    return await _cached_summary(
+        "content_calendar",
+        lambda: generate_content_calendar(start_date=start_date, end_date=end_date, month=month, team=team, vi_tri=vi_tri),
+        TASK_TABLE_IDS, force_refresh, ttl,
+        month=month, start_date=start_date, end_date=end_date, team=team, vi_tri=vi_tri,
+    )
+
+
+async def get_task_summary(month: Optional[int] = None, vi_tri: Optional[str] = None,
+                           force_refresh: bool = False, ttl: Optional[int] = None) -> Dict[str, Any]:
+    """Phân tích task theo vị trí"""
+    return await _cached_summary(
+        "task_summary",
+        lambda: generate_task_summary(month=month, vi_tri=vi_tri),
+        TASK_TABLE_IDS, force_refresh, ttl,
+        month=month, vi_tri=vi_tri,
+    )
+
+
+# Các bảng mà summary của từng brand đọc
+BRAND_TABLE_IDS = {
+    "KALLE": KALLE_DASHBOARD_TABLE_IDS,
+    "CHENG": CHENG_REPORT_TABLE_IDS,
+}
+
+
+async def get_week_breakdown(brand: str, month: int,
+                             force_refresh: bool = False, ttl: Optional[int] = None,
+                             year: Optional[int] = None) -> Dict[str, Any]:
+    """Tổng tháng + từng tuần của tháng (1 lượt quét) - mọi câu hỏi theo tuần dùng chung"""
+    check_data_year(month, year)
+    brand = brand.upper()
+    return await _cached_summary(
+        "week_breakdown",
+        lambda: compute_week_breakdown(brand, month),
+        BRAND_TABLE_IDS[brand], force_refresh, ttl,
+        brand=brand, month=month,
+    )
+
+
+# Các brand đã đăng ký: brand → hàm lấy summary theo (month, week)
+BRAND_SUMMARIES = {
+    "KALLE": get_kalle_dashboard_summary,
+    "CHENG": get_cheng_summary,
+}
+
+
+def get_summary_age(name: str, **params: Any) -> Optional[float]:
+    """Tuổi (giây) của summary trong cache, None nếu chưa có / đã hết hạn"""
+    entry = get_report_cache().peek(summary_key(name, **params))
+    return entry.age if entry else None
@@ -0,0 +1,69 @@
+"""
+VN Day Module
+Số ngày (int) theo giờ Việt Nam cho các field thời gian của Lark
+Version 5.9.0
+
+- Timestamp (ms / s) → số ngày kể từ 1970-01-01 giờ VN bằng phép cộng offset cố định
+  (+7h: VN không có DST, offset cố định từ 1975 — đủ cho mọi dữ liệu Lark)
+- Decode 1 lần khi đọc record; lọc / bucket theo ngày không cần tạo datetime
+"""
+from datetime import date
+from typing import Any, Optional, Tuple
+
+VN_UTC_OFFSET_SECONDS = 7 * 3600
+SECONDS_PER_DAY = 86400
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def ts_to_day(ts: float) -> int:
+    """Timestamp ms hoặc s → số ngày giờ VN"""
+    seconds = int(ts // 1000) if ts > 1e12 else int(ts)
+    return (seconds + VN_UTC_OFFSET_SECONDS) // SECONDS_PER_DAY
+
+
+def day_of(d: date) -> int:
+    return d.toordinal() - _EPOCH_ORDINAL
+
+
+def day_to_date(day: int) -> date:
+    return date.fromordinal(day + _EPOCH_ORDINAL)
+
+
+def day_to_ymd(day: int) -> Tuple[int, int, int]:
+    """Số ngày → (năm, tháng, ngày), chỉ dùng phép tính số nguyên (civil-from-days)"""
+    z = day + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    d = doy - (153 * mp + 2) // 5 + 1
+    m = mp + 3 if mp < 10 else mp - 9
+    y = yoe + era * 400 + (1 if m <= 2 else 0)
+    return y, m, d
+
+
+def parse_vn_day(value: Any) -> Optional[int]:
+    """
+    Field ngày của Lark → số ngày giờ VN
+    Hỗ trợ: timestamp ms/s, timestamp dạng chuỗi, "YYYY/MM/DD", "YYYY-MM-DD", "DD/MM/YYYY"
+    """
+    if not value:
+        return None
+
+    try:
+        if isinstance(value, (int, float)):
+            return ts_to_day(value)
+
+        if isinstance(value, str):
+            value = value.strip()
+            if value.isdigit():
+                return ts_to_day(int(value))
+            if len(value) >= 10 and value[4] in "/-":
+                return day_of(date(int(value[0:4]), int(value[5:7]), int(value[8:10])))
+            if len(value) >= 10 and value[2] == '/':
+                return day_of(date(int(value[6:10]), int(value[3:5]), int(value[0:2])))
+    except (ValueError, OverflowError):
+        return None
+
+    return None
@@ -0,0 +1,133 @@
+"""
+Week Breakdown Module
+Số liệu từng tuần của 1 tháng, tính trong cùng 1 lượt quét với tổng tháng
+Version 5.9.0
+
+- Các bảng tuần (doanh thu KOC, doanh thu tổng, liên hệ) chỉ lấy + lọc theo tháng 1 lần
+- Mỗi record được cộng vào bucket tuần của nó ("Tuần báo cáo") và tổng tháng cùng lúc
+- Hỏi tuần 1, tuần 2... hay so sánh các tuần đều đọc từ kết quả này (cache qua summaries)
+"""
+import re
+from typing import Any, Dict, List, Optional
+
+from lark_base import (
+    safe_number,
+    get_doanh_thu_koc_records,
+    get_lien_he_records,
+    get_cheng_doanh_thu_records,
+    get_cheng_doanh_thu_tong_records,
+    get_cheng_lien_he_records,
+)
+
+# Số KOC top của mỗi tuần giữ lại
+TOP_KOC_PER_WEEK = 5
+
+# brand → hàm lấy record tuần (month, week=None)
+#   koc: doanh thu theo kênh KOC, gmv: doanh thu tổng (None → cộng từ koc), lien_he: liên hệ KOC
+BRAND_WEEK_SOURCES = {
+    "KALLE": {"koc": get_doanh_thu_koc_records, "gmv": None, "lien_he": get_lien_he_records},
+    "CHENG": {"koc": get_cheng_doanh_thu_records, "gmv": get_cheng_doanh_thu_tong_records,
+              "lien_he": get_cheng_lien_he_records},
+}
+
+
+def week_number(tuan: Any) -> Optional[int]:
+    """"Tuần 2" / 2 / [{"text": "Tuần 2"}] → 2"""
+    if tuan is None:
+        return None
+    if isinstance(tuan, (int, float)):
+        return int(tuan)
+    if isinstance(tuan, list):
+        if not tuan:
+            return None
+        first = tuan[0]
+        tuan = (first.get("text") or first.get("name")) if isinstance(first, dict) else first
+        return week_number(tuan)
+    match = re.search(r'\d+', str(tuan))
+    return int(match.group()) if match else None
+
+
+def _empty_bucket() -> Dict[str, Any]:
+    return {
+        "gmv": 0.0,
+        "so_video": 0,
+        "tong_lien_he": 0,
+        "da_deal": 0,
+        "dang_trao_doi": 0,
+        "tu_choi": 0,
+        "koc_gmv": {},
+    }
+
+
+def _finish_bucket(bucket: Dict[str, Any]) -> Dict[str, Any]:
+    koc_gmv = bucket.pop("koc_gmv")
+    bucket["top_koc"] = sorted(koc_gmv.items(), key=lambda x: x[1], reverse=True)[:TOP_KOC_PER_WEEK]
+    bucket["so_koc"] = len(koc_gmv)
+    total = bucket["tong_lien_he"]
+    bucket["ty_le_deal"] = round(bucket["da_deal"] / total * 100, 1) if total else 0
+    return bucket
+
+
+async def compute_week_breakdown(brand: str, month: int) -> Dict[str, Any]:
+    """
+    Tổng tháng + bucket từng tuần của 1 brand trong 1 lượt quét mỗi bảng
+
+    Returns:
+        {"brand", "month", "weeks": {số tuần: bucket}, "month_totals": bucket}
+        (record không xác định được tuần chỉ cộng vào tổng tháng)
+    """
+    brand = brand.upper()
+    sources = BRAND_WEEK_SOURCES[brand]
+    weeks: Dict[int, Dict[str, Any]] = {}
+    totals = _empty_bucket()
+
+    def targets(tuan) -> List[Dict[str, Any]]:
+        week = week_number(tuan)
+        if week is None:
+            return [totals]
+        return [totals, weeks.setdefault(week, _empty_bucket())]
+
+    for r in await sources["koc"](month=month):
+        gmv = safe_number(r.get("gmv"))
+        id_kenh = r.get("id_kenh")
+        for bucket in targets(r.get("tuan")):
+            bucket["so_video"] += 1
+            if sources["gmv"] is None:
+                bucket["gmv"] += gmv
+            if id_kenh:
+                bucket["koc_gmv"][id_kenh] = bucket["koc_gmv"].get(id_kenh, 0) + gmv
+
+    if sources["gmv"] is not None:
+        for r in await sources["gmv"](month=month):
+            for bucket in targets(r.get("tuan_num") or r.get("tuan")):
+                bucket["gmv"] += safe_number(r.get("gmv"))
+
+    for r in await sources["lien_he"](month=month):
+        for bucket in targets(r.get("tuan")):
+            for field in ("tong_lien_he", "da_deal", "dang_trao_doi", "tu_choi"):
+                bucket[field] += int(safe_number(r.get(field)))
+
+    return {
+        "brand": brand,
+        "month": month,
+        "weeks": {week: _finish_bucket(weeks[week]) for week in sorted(weeks)},
+        "month_totals": _finish_bucket(totals),
+    }
+
+
+def _delta_pct(current: float, previous: float) -> Optional[float]:
+    return round((current - previous) / previous * 100, 1) if previous else None
+
+
+def week_over_week(breakdown: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Thay đổi của mỗi tuần so với tuần liền trước (GMV, video, liên hệ, deal)"""
+    result = []
+    previous = None
+    for week, bucket in breakdown.get("weeks", {}).items():
+        row = {"week": int(week)}
+        for field in ("gmv", "so_video", "tong_lien_he", "da_deal"):
+            row[field] = bucket.get(field, 0)
+            row[f"{field}_delta_pct"] = _delta_pct(bucket.get(field, 0), previous.get(field, 0)) if previous else None
+        result.append(row)
+        previous = bucket
+    return result